@@ -10,7 +10,14 @@ import calendar
 import collections
 import subprocess
 import csv
-from geopy import distance
+import json
+import hashlib
+import threading
+import multiprocessing
+import shutil
+import tempfile
+import atexit
+from multiprocessing.pool import ThreadPool
 from osgeo import gdal, osr
 from dateutil.relativedelta import relativedelta
 import matplotlib.pyplot as plt
@@ -74,42 +81,505 @@ def set_classes_to_value(fih, lu_fih, classes, value):
     create_geotiff(fih, alpha, *geo_info)
 
 
-def calc_mean_std(fihs):
+_ZONES_CACHE = dict()
+
+def encode_classes(lu):
+    """
+    Encode a landusemap into a compact array with a class-index for each pixel,
+    so that statistics for all classes can be calculated in one pass. Encodings
+    of maps opened from a filehandle are cached.
+
+    Parameters
+    ----------
+    lu : str or ndarray or tuple
+        Filehandle pointing to a landusemap, an array with landuse classes or an
+        already encoded landusemap.
+
+    Returns
+    -------
+    zones : tuple
+        Tuple with a flattened array with the class-index of each pixel and an
+        array with the sorted landuse classes. Pixels without a valid class have
+        index len(classes).
+    """
+    if isinstance(lu, tuple):
+        return lu
+
+    if isinstance(lu, np.ndarray):
+        return _encode_classes(lu)
+
+    key = (os.path.abspath(lu), os.path.getmtime(lu))
+    if key not in _ZONES_CACHE:
+        _ZONES_CACHE[key] = _encode_classes(open_as_array(lu, nan_values=True, cache=True))
+    return _ZONES_CACHE[key]
+
+
+def _encode_classes(lulc):
+    lulc = np.asarray(lulc).ravel()
+    valid = np.isfinite(lulc) if lulc.dtype.kind == 'f' else np.ones(lulc.shape, dtype=bool)
+    values = lulc[valid]
+
+    if values.size > 0 and np.all(np.mod(values, 1) == 0) and np.ptp(values) < 2**16:
+        offset = np.min(values).astype(np.int64)
+        shifted = values.astype(np.int64) - offset
+        present = np.bincount(shifted) > 0
+        classes = (np.flatnonzero(present) + offset).astype(lulc.dtype)
+        lookup = np.cumsum(present) - 1
+        codes = lookup[shifted]
+    else:
+        classes, codes = np.unique(values, return_inverse=True)
+
+    dtype = np.uint8 if classes.size < 2**8 - 1 else np.uint16 if classes.size < 2**16 - 1 else np.uint32
+    index = np.full(lulc.shape, classes.size, dtype=dtype)
+    index[valid] = codes
+    return index, classes
+
+
+def sum_per_class(zones, data, area=None, scale=None):
+    """
+    Calculate the sum and the amount of valid pixels of a map for each
+    landuse class using a single bincount pass.
+
+    Parameters
+    ----------
+    zones : str or ndarray or tuple
+        Landusemap, see encode_classes.
+    data : ndarray
+        Array with the values to be summed, should have same dimensions as the
+        landusemap.
+    area : ndarray, optional
+        Area of each pixel, values are multiplied by it before summation.
+    scale : float, optional
+        Factor with which the values are multiplied before summation.
+
+    Returns
+    -------
+    sums : ndarray
+        Nan-ignoring sum per class in zones[1].
+    counts : ndarray
+        Amount of non-nan pixels per class in zones[1].
+    """
+    index, classes = encode_classes(zones)
+    weights, valid = _bincount_weights(data, area, scale)
+    sums = np.bincount(index, weights=weights, minlength=classes.size + 1)[:classes.size]
+    counts = np.bincount(index, weights=valid, minlength=classes.size + 1)[:classes.size]
+    return sums, counts
+
+
+def _bincount_weights(data, area, scale):
+    data = np.asarray(data, dtype=np.float64).ravel()
+    valid = ~np.isnan(data)
+    weights = np.where(valid, data, 0.0)
+    if area is not None:
+        weights *= np.asarray(area).ravel()
+    if scale is not None:
+        weights *= scale
+    weights[np.isnan(weights)] = 0.0
+    return weights, valid
+
+
+def label_masks(source_file, mask_fhs, overlap='first'):
+    """
+    Combine a list of masks (e.g. the subbasins in metadata['masks']) into one
+    map with the index of the mask each pixel belongs to. The masks are matched
+    with source_file first, see match_static_layer.
+
+    Parameters
+    ----------
+    source_file : str
+        The file to match the projection, resolution and ndv with.
+    mask_fhs : list
+        Filehandles pointing to the masks, pixels equal to 1 are inside a mask.
+    overlap : str, optional
+        How to handle pixels inside more than one mask. 'first' assigns them to
+        the first of those masks in mask_fhs, 'last' to the last and 'raise'
+        raises a ValueError. Default is 'first'.
+
+    Returns
+    -------
+    labels : ndarray
+        Integer map with the index into mask_fhs for each pixel, pixels outside
+        all masks have value len(mask_fhs).
+    """
+    assert overlap in ['first', 'last', 'raise'], "overlap should be 'first', 'last' or 'raise'"
+    outside = len(mask_fhs)
+    labels = None
+    for i, mask_fh in enumerate(mask_fhs):
+        mask = open_as_array(match_static_layer(mask_fh, source_file), nan_values=True) == 1
+        if labels is None:
+            labels = np.full(mask.shape, outside, dtype=np.int32)
+        overlapping = mask & (labels != outside)
+        if np.any(overlapping):
+            if overlap == 'raise':
+                raise ValueError('{0} pixels of {1} are inside a previous mask'.format(np.sum(overlapping), mask_fh))
+            print('Warning, {0} pixels of {1} are inside a previous mask, assigning them to the {2} mask'.format(np.sum(overlapping), mask_fh, overlap))
+            if overlap == 'first':
+                mask &= ~overlapping
+        labels[mask] = i
+    return labels
+
+
+def sum_per_label_class(labels, zones, data, nlabels, area=None, scale=None):
+    """
+    Calculate the sum and the amount of valid pixels of a map for each
+    combination of label (e.g. subbasin, see label_masks) and landuse class
+    using a single bincount pass.
+
+    Parameters
+    ----------
+    labels : ndarray
+        Integer array with a label for each pixel, should have the same
+        dimensions as the landusemap. Pixels with label nlabels are ignored.
+    zones : str or ndarray or tuple
+        Landusemap, see encode_classes.
+    data : ndarray
+        Array with the values to be summed.
+    nlabels : int
+        Amount of labels.
+    area : ndarray, optional
+        Area of each pixel, values are multiplied by it before summation.
+    scale : float, optional
+        Factor with which the values are multiplied before summation.
+
+    Returns
+    -------
+    sums : ndarray
+        Nan-ignoring sums with shape (nlabels, zones[1].size).
+    counts : ndarray
+        Amount of non-nan pixels with shape (nlabels, zones[1].size).
+    """
+    index, classes = encode_classes(zones)
+    weights, valid = _bincount_weights(data, area, scale)
+    shape = (nlabels + 1, classes.size + 1)
+    joint = np.asarray(labels).ravel() * shape[1] + index
+    sums = np.bincount(joint, weights=weights, minlength=shape[0] * shape[1])
+    counts = np.bincount(joint, weights=valid, minlength=shape[0] * shape[1])
+    return sums.reshape(shape)[:nlabels, :classes.size], counts.reshape(shape)[:nlabels, :classes.size]
+
+
+def aggregate_per_categories(zones, data, categories, area=None, scale=None, statistic='sum'):
+    """
+    Calculate the sum or mean of a map for each category of landuse classes.
+
+    Parameters
+    ----------
+    zones : str or ndarray or tuple
+        Landusemap, see encode_classes.
+    data : ndarray
+        Array with the values to be aggregated.
+    categories : dict
+        Dictionary with a list of landuse classes per category.
+    area : ndarray, optional
+        Area of each pixel, values are multiplied by it before summation.
+    scale : float, optional
+        Factor with which the values are multiplied before summation.
+    statistic : str, optional
+        Either 'sum' (nansum) or 'mean' (nanmean), default is 'sum'.
+
+    Returns
+    -------
+    aggregated : dict
+        Dictionary with the sum or mean per category. Categories without
+        valid pixels have a sum of 0 or a mean of np.nan.
+
+    Examples
+    --------
+    >>> aggregate_per_categories(lu_fh, ET, {'Forests': [1, 8, 9], 'Shrubland': [2, 12]})
+    """
+    zones = encode_classes(zones)
+    sums, counts = sum_per_class(zones, data, area=area, scale=scale)
+    aggregated = dict()
+    for category, lu_classes in categories.items():
+        positions = class_positions(zones, lu_classes)
+        if statistic == 'mean':
+            total = np.sum(counts[positions])
+            aggregated[category] = np.sum(sums[positions]) / total if total > 0 else np.nan
+        else:
+            aggregated[category] = np.sum(sums[positions])
+    return aggregated
+
+
+_BASIN_PIXELS = dict()
+
+def basin_pixels(lu_fih, mask_fih=None):
+    """
+    Find the pixels inside a basin, so that maps can be stored as 1-D vectors
+    containing only those pixels. Results are cached.
+
+    Parameters
+    ----------
+    lu_fih : str
+        Filehandle pointing to the landusemap, pixels with a no-data-value are
+        outside the basin.
+    mask_fih : str, optional
+        Filehandle pointing to a basin mask (e.g. metadata['full_basin_mask'])
+        with the same dimensions as lu_fih, only pixels equal to 1 are inside
+        the basin. Default is None.
+
+    Returns
+    -------
+    pixels : tuple
+        Tuple with the flat indices of the pixels inside the basin and the
+        (ysize, xsize) shape of the maps.
+
+    Examples
+    --------
+    >>> pixels = basin_pixels(metadata['lu'])
+    >>> P = open_as_vector(p_fh, pixels)
+    >>> create_geotiff(fh, scatter_pixels(P * 2, pixels), *get_geoinfo(metadata['lu']))
+    """
+    key = (os.path.abspath(lu_fih), os.path.getmtime(lu_fih), mask_fih)
+    if key not in _BASIN_PIXELS:
+        lulc = open_as_array(lu_fih, nan_values=True, cache=True)
+        inside = ~np.isnan(lulc)
+        if mask_fih is not None:
+            inside &= open_as_array(mask_fih, nan_values=True, cache=True) == 1
+        indices = np.flatnonzero(inside)
+        indices.setflags(write=False)
+        _BASIN_PIXELS[key] = (indices, lulc.shape)
+    return _BASIN_PIXELS[key]
+
+
+def gather_pixels(array, pixels):
+    """
+    Select the pixels inside the basin from a map.
+
+    Parameters
+    ----------
+    array : ndarray
+        Map with shape pixels[1], or a (ysize, 1) array with one value per row
+        (see map_pixel_area_km).
+    pixels : tuple
+        Pixels inside the basin, see basin_pixels.
+
+    Returns
+    -------
+    vector : ndarray
+        1-D array with the values of the pixels inside the basin.
+    """
+    indices, shape = pixels
+    if np.shape(array) == (shape[0], 1):
+        return array[indices // shape[1], 0]
+    return np.ravel(array)[indices]
+
+
+def scatter_pixels(vector, pixels, fill=np.nan):
+    """
+    Convert a vector with values for the pixels inside the basin back into a
+    map, e.g. to save it with create_geotiff.
+
+    Parameters
+    ----------
+    vector : ndarray
+        1-D array as returned by gather_pixels.
+    pixels : tuple
+        Pixels inside the basin, see basin_pixels.
+    fill : float, optional
+        Value of the pixels outside the basin, default is np.nan.
+
+    Returns
+    -------
+    array : ndarray
+        Map with shape pixels[1].
+    """
+    indices, shape = pixels
+    vector = np.asarray(vector)
+    dtype = vector.dtype if vector.dtype.kind == 'f' else np.float64
+    array = np.full(shape[0] * shape[1], fill, dtype=dtype)
+    array[indices] = vector
+    return array.reshape(shape)
+
+
+def open_as_vector(fih, pixels, nan_values=True):
+    """
+    Open a map and select the pixels inside the basin.
+
+    Parameters
+    ----------
+    fih : str
+        Filehandle pointing to the map.
+    pixels : tuple
+        Pixels inside the basin, see basin_pixels.
+    nan_values : boolean, optional
+        Convert the no-data-values into np.nan values, default is True.
+
+    Returns
+    -------
+    vector : ndarray
+        1-D array with the values of the pixels inside the basin.
+    """
+    return gather_pixels(open_as_array(fih, nan_values=nan_values), pixels)
+
+
+def gather_zones(zones, pixels):
+    """
+    Select the pixels inside the basin from an encoded landusemap, so that
+    the zonal statistics (e.g. aggregate_per_categories) can be calculated
+    on vectors.
+
+    Parameters
+    ----------
+    zones : str or ndarray or tuple
+        Landusemap, see encode_classes.
+    pixels : tuple
+        Pixels inside the basin, see basin_pixels.
+
+    Returns
+    -------
+    zones : tuple
+        Encoded landusemap of the pixels inside the basin.
+    """
+    index, classes = encode_classes(zones)
+    return index[pixels[0]], classes
+
+
+def class_positions(zones, lu_classes):
+    """
+    Find the positions of landuse classes in an encoded landusemap.
+
+    Parameters
+    ----------
+    zones : tuple
+        Encoded landusemap, see encode_classes.
+    lu_classes : list
+        Landuse classes to look up, classes not present on the map are ignored.
+
+    Returns
+    -------
+    positions : ndarray
+        Unique indices into zones[1].
+    """
+    classes = zones[1]
+    lu_classes = np.unique(np.asarray(lu_classes, dtype=np.float64))
+    positions = np.searchsorted(classes, lu_classes)
+    positions = positions[positions < classes.size]
+    return np.unique(positions[np.isin(classes[positions], lu_classes)])
+
+
+def calc_mean_std(fihs, block_rows=None, statistics=False):
     """
     Calculate the mean and the standard deviation per pixel for a serie of maps.
+    The maps are read once, the mean and std are updated with Welford's online
+    algorithm.
 
     Parameters
     ----------
     fihs : ndarray
         Array with filehandles pointing to maps to be used.
+    block_rows : int, optional
+        Number of rows to process at once. Memory use is then limited to the
+        output maps plus a few blocks, at the cost of reading each map in
+        several parts. Default is None, which processes the maps as a whole.
+    statistics : boolean, optional
+        Also return the count of valid values, the minimum and the maximum per
+        pixel. Default is False.
 
     Returns
     -------
     std : ndarray
-        Array with the standard deviation for each pixel.
+        Array with the standard deviation for each pixel, np.nan for pixels
+        with missing values in one of the maps.
     mean : ndarray
         Array with the mean for each pixel.
+    count : ndarray
+        Array with the number of valid values for each pixel, only returned
+        if statistics is True.
+    minimum : ndarray
+        Array with the minimum for each pixel, only returned if statistics
+        is True.
+    maximum : ndarray
+        Array with the maximum for each pixel, only returned if statistics
+        is True.
     """
-    data_sum = data_count = np.zeros_like(open_as_array(fihs[0]))
-
-    for fih in fihs:
-        data = open_as_array(fih)
-        data_sum = np.nansum([data_sum, data], axis=0)
+    if block_rows is None:
+        blocks = [None]
+    else:
+        ysize = raster_header(fihs[0])[3]
+        blocks = [(row, block_rows) for row in range(0, ysize, block_rows)]
+
+    results = list()
+    for block in blocks:
+        moments = None
+        for fih in fihs:
+            data = open_as_array(fih, rows=block)
+            if moments is None:
+                moments = _init_moments(data.shape)
+                minimum = np.full(data.shape, np.nan)
+                maximum = np.full(data.shape, np.nan)
+            _update_moments(moments, data)
+            if statistics:
+                np.fmin(minimum, data, out=minimum)
+                np.fmax(maximum, data, out=maximum)
+        std, mean = _finalize_moments(moments)
+        results.append((std, mean, moments[0], minimum, maximum))
+
+    results = [np.concatenate(stat) for stat in zip(*results)]
+    if statistics:
+        return tuple(results)
+    return results[0], results[1]
+
+
+def _init_moments(shape):
+    return [np.zeros(shape), np.zeros(shape), np.zeros(shape), np.ones(shape, dtype=bool)]
+
+
+def _update_moments(moments, data):
+    count, mean, m2, complete = moments
+    valid = ~np.isnan(data)
+    count += valid
+    delta = np.where(valid, data - mean, 0.0)
+    mean += delta / np.maximum(count, 1)
+    m2 += np.where(valid, delta * (data - mean), 0.0)
+    complete &= valid
+
+
+def _finalize_moments(moments):
+    count, mean, m2, complete = moments
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, mean, np.nan)
+        std = np.where(complete, np.sqrt(m2 / count), np.nan)
+    return std, mean
 
-        count = np.ones_like(data)
-        count[np.isnan(data)] = 0
-        data_count += count
 
-    mean = data_sum / data_count
-    data_sum = np.zeros_like(data)
+_CLIMATOLOGIES = dict()
 
-    for fih in fihs:
-        data = (open_as_array(fih) - mean)**2 / data_count
-        data_sum += data
+def monthly_climatology(fihs, dates):
+    """
+    Calculate the mean and the standard deviation per pixel for each calendar
+    month of a serie of maps, reading every map only once. Results are
+    cached per set of files, so repeated calls for the same serie (e.g.
+    once for every date) do not read the maps again.
 
-    std = np.sqrt(data_sum)
+    Parameters
+    ----------
+    fihs : ndarray
+        Array with filehandles pointing to maps to be used.
+    dates : ndarray
+        Array with datetime.date objects corresponding to fihs.
 
-    return std, mean
+    Returns
+    -------
+    climatology : dict
+        Dictionary with for each month (1-12) a tuple with the (read-only)
+        standard deviation and mean, like calc_mean_std.
+    """
+    months = tuple(date.month for date in dates)
+    key = (tuple((os.path.abspath(fih), os.path.getmtime(fih)) for fih in fihs), months)
+    if key not in _CLIMATOLOGIES:
+        moments = dict()
+        for fih, month in zip(fihs, months):
+            data = open_as_array(fih)
+            if month not in moments:
+                moments[month] = _init_moments(data.shape)
+            _update_moments(moments[month], data)
+        climatology = dict()
+        for month in moments:
+            std, mean = _finalize_moments(moments[month])
+            std.flags.writeable = False
+            mean.flags.writeable = False
+            climatology[month] = (std, mean)
+        _CLIMATOLOGIES[key] = climatology
+    return _CLIMATOLOGIES[key]
 
 
 def get_gdalwarp_info(fih, subdataset=0):
@@ -134,22 +604,15 @@ def get_gdalwarp_info(fih, subdataset=0):
     ndv : str
         No-Data-Value of the fih.
     """
-    dataset = gdal.Open(fih, gdal.GA_ReadOnly)
-    tpe = dataset.GetDriver().ShortName
-    if tpe == 'HDF4':
-        dataset = gdal.Open(dataset.GetSubDatasets()[subdataset][0])
-    ndv = str(dataset.GetRasterBand(1).GetNoDataValue())
+    ndv, xsize, ysize, geot, srs = raster_header(fih, subdataset, ('HDF4',))[1:]
+    ndv = str(ndv)
     if ndv == 'None':
         ndv = 'nan'
-    srs = dataset.GetProjectionRef()
     if not srs:
         srs = osr.SpatialReference()
         srs.ImportFromEPSG(4326).ExportToPrettyWkt()
         print("srs not defined, using EPSG4326.")
-    xsize = dataset.RasterXSize
-    ysize = dataset.RasterYSize
     res = ' '.join([str(xsize), str(ysize)])
-    geot = dataset.GetGeoTransform()
     xmin = geot[0]
     ymin = geot[3] + geot[5] * ysize
     xmax = geot[0] + geot[1] * xsize
@@ -187,36 +650,45 @@ def average_series(tifs, dates, length, output_folder, para_name='Average',
     Returns
     -------
     output_tifs : ndarray
-        Array with paths to the new maps.
+        Array with paths to the new maps. When length is 1, no new maps are
+        created and tifs is returned.
     dates : ndarray
         Array with datetime.date object reffering to the dates of output_tifs.
     """
     assert_missing_dates(dates, timescale=timescale)
 
-    masked_average = False
+    if not isinstance(length, dict) and length == 1:
+        return tifs, dates
 
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
     if isinstance(length, dict):
-        max_length = np.max(length.values())
-        masked_average = True
         assert_same_keys([length, categories])
         assert_proj_res_ndv([tifs, np.array(lu_fih)])
+        lengths = sorted(set(int(value) for value in length.values()))
+        lulc = open_as_array(lu_fih, cache=True)
+        masks = dict()
+        for value in lengths:
+            classes = [lu_class for key in length.keys() if int(length[key]) == value
+                       for lu_class in np.ravel(categories[key])]
+            masks[value] = np.isin(lulc, classes)
     else:
-        max_length = length
         assert_proj_res_ndv([tifs])
+        lengths = [int(length)]
+    max_length = lengths[-1]
 
     geo_info = get_geoinfo(tifs[0])
 
     output_tifs = np.array([])
 
-    for date in dates[(max_length-1):]:
-        if masked_average:
-            array = masked_moving_average(date, tifs, dates,
-                                          lu_fih, length, categories)
-        if not masked_average:
-            array = moving_average(date, tifs, dates, moving_avg_length=length)
+    for date, averages in zip(dates[(max_length-1):], _running_averages(tifs, lengths)):
+        if isinstance(length, dict):
+            array = np.zeros(averages[max_length].shape, dtype=averages[max_length].dtype) * np.nan
+            for value in lengths:
+                array[masks[value]] = averages[value][masks[value]]
+        else:
+            array = averages[max_length]
         tif = os.path.join(output_folder,
                            '{0}_{1}{2}.tif'.format(para_name, date.year, str(date.month).zfill(2)))
         create_geotiff(tif, array, *geo_info)
@@ -225,6 +697,40 @@ def average_series(tifs, dates, length, output_folder, para_name='Average',
     return output_tifs, dates[(max_length-1):]
 
 
+def _running_averages(tifs, lengths):
+    """
+    Yield the trailing averages of a serie of maps for several window lengths,
+    starting at the first map for which the longest window is complete. Every
+    map is read once and kept in a ring buffer, the sum of each window is
+    updated by adding the newest and subtracting the oldest map. Pixels with
+    a missing value inside a window are np.nan, like in moving_average.
+    """
+    max_length = max(lengths)
+    window = collections.deque()
+    sums = missing = None
+    for tif in tifs:
+        data = open_as_array(tif)
+        nans = np.isnan(data)
+        data[nans] = 0.0
+        window.append((data, nans))
+        if sums is None:
+            sums = dict((length, np.zeros(data.shape)) for length in lengths)
+            missing = dict((length, np.zeros(data.shape, dtype=int)) for length in lengths)
+        for length in lengths:
+            sums[length] += data
+            missing[length] += nans
+            if len(window) > length:
+                old_data, old_nans = window[-length-1]
+                sums[length] -= old_data
+                missing[length] -= old_nans
+        if len(window) > max_length:
+            window.popleft()
+        if len(window) == max_length:
+            yield dict((length, np.where(missing[length] > 0, np.nan,
+                                         sums[length] / length).astype(data.dtype))
+                       for length in lengths)
+
+
 def moving_average(date, filehandles, filedates,
                    moving_avg_length=5, method='tail'):
     """
@@ -413,6 +919,148 @@ def sort_files(input_dir, year_position, month_position=None,
     return filehandles, dates, years, months, days
 
 
+class TimeSeriesCatalog(tuple):
+    """
+    Filehandles of a time series of maps together with their dates. Behaves
+    like the (filehandles, dates) tuple returned by sort_files[0:2], but files
+    can be looked up by date in constant time.
+
+    Parameters
+    ----------
+    filehandles : ndarray
+        Array with filehandles.
+    dates : ndarray
+        Array with datetime.date objects corresponding to the filehandles.
+
+    Examples
+    --------
+    >>> p = TimeSeriesCatalog(*sort_files(p_folder, [-10,-6], month_position=[-6,-4])[0:2])
+    >>> fhs, dates = p
+    >>> p.get(datetime.date(2010, 1, 1))
+    """
+    def __new__(cls, filehandles, dates):
+        filehandles = np.array(filehandles)
+        dates = np.array(dates)
+        assert filehandles.size == dates.size, "Amount of filehandles and dates do not match"
+        catalog = tuple.__new__(cls, (filehandles, dates))
+        catalog.index = dict((_date_key(date), i) for i, date in enumerate(dates))
+        catalog.cube = None
+        return catalog
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    @property
+    def filehandles(self):
+        return self[0]
+
+    @property
+    def dates(self):
+        return self[1]
+
+    def has(self, date):
+        """
+        Check if a map is available for date.
+        """
+        return _date_key(date) in self.index
+
+    def get(self, date, default=None):
+        """
+        Get the filehandle belonging to date, default if not available.
+        """
+        i = self.index.get(_date_key(date))
+        return default if i is None else self[0][i]
+
+    def select(self, dates):
+        """
+        Get the filehandles belonging to multiple dates, raises a KeyError if
+        one of the dates is not available.
+        """
+        return self[0][np.array([self.index[_date_key(date)] for date in dates], dtype=int)]
+
+    def attach_cube(self, cube_fh):
+        """
+        Use a cube (see write_cube) to read the maps of this catalog. The cube
+        is only attached when it contains all the dates of the catalog.
+
+        Returns
+        -------
+        attached : boolean
+            True if the cube has been attached.
+        """
+        if not os.path.exists(cube_fh):
+            return False
+        cube_dates = open_cube(cube_fh)[1]
+        if not set(_date_key(date) for date in self[1]).issubset(_date_key(date) for date in cube_dates):
+            return False
+        self.cube = cube_fh
+        return True
+
+    def array(self, date):
+        """
+        Get the map belonging to date as an array with nan as no-data-value.
+        When a cube is attached a read-only view on the cube is returned.
+        """
+        if self.cube is not None:
+            return cube_map(self.cube, date)
+        return open_as_array(self.get(date), nan_values=True)
+
+    def vector(self, date, pixels):
+        """
+        Get the pixels inside the basin (see basin_pixels) of the map
+        belonging to date.
+        """
+        return gather_pixels(self.array(date), pixels)
+
+    def subset(self, dates):
+        """
+        Create a new catalog containing only the dates that are also in dates.
+        """
+        dates = [date for date in dates if self.has(date)]
+        catalog = TimeSeriesCatalog(self.select(dates), dates)
+        catalog.cube = self.cube
+        return catalog
+
+    def water_years(self, start_month=1, complete=True):
+        """
+        Group the catalog per water year.
+
+        Parameters
+        ----------
+        start_month : int, optional
+            First month of the water year, default is 1. Water years are named
+            after the calendar year in which they start.
+        complete : boolean, optional
+            Only return water years for which all 12 months are available,
+            default is True.
+
+        Returns
+        -------
+        years : OrderedDict
+            Dictionary with a TimeSeriesCatalog per water year.
+        """
+        groups = collections.OrderedDict()
+        for date in sorted(self[1]):
+            groups.setdefault(water_year(date, start_month), []).append(date)
+        years = collections.OrderedDict()
+        for year, dates in groups.items():
+            if not complete or len(set(_date_key(date)[:2] for date in dates)) == 12:
+                years[year] = self.subset(dates)
+        return years
+
+
+def _date_key(date):
+    return (date.year, date.month, date.day)
+
+
+def water_year(date, start_month=1):
+    """
+    Get the water year of a date, named after the calendar year in which the
+    water year starts.
+    """
+    return date.year if date.month >= start_month else date.year - 1
+
+
 def common_dates(dates_list):
     """
     Checks for common dates between multiple lists of datetime.date objects.
@@ -420,19 +1068,69 @@ def common_dates(dates_list):
     Parameters
     ----------
     dates_list : list
-        Contains lists with datetime.date objects.
+        Contains lists with datetime.date objects or TimeSeriesCatalogs.
 
     Returns
     -------
     com_dates : ndarray
         Array with datetime.date objects for common dates.
     """
+    dates_list = [dates.dates if isinstance(dates, TimeSeriesCatalog) else dates for dates in dates_list]
     com_dates = dates_list[0]
+    if len(dates_list) == 1:
+        return com_dates
+    ordinals = dict((date.toordinal(), date) for date in com_dates)
+    common = np.array(list(ordinals.keys()), dtype=np.int64)
     for date_list in dates_list[1:]:
-        com_dates = np.sort(list(set(com_dates).intersection(date_list)))
+        common = np.intersect1d(common, np.array([date.toordinal() for date in date_list], dtype=np.int64))
+    com_dates = np.array([ordinals[ordinal] for ordinal in common])
     return com_dates
 
 
+def in_selection(dates, selection=None):
+    """
+    Check which dates are part of a selection of months, e.g. the new months
+    in an incremental run.
+
+    Parameters
+    ----------
+    dates : list
+        Contains datetime.date objects.
+    selection : list, optional
+        Contains datetime.date objects, only the year and month are compared.
+        When None, all dates are selected. Default is None.
+
+    Returns
+    -------
+    selected : ndarray
+        Boolean array, True for the dates in selection.
+    """
+    if selection is None:
+        return np.ones(len(dates), dtype=bool)
+    months = set((date.year, date.month) for date in selection)
+    return np.array([(date.year, date.month) in months for date in dates], dtype=bool)
+
+
+def water_years(dates, start_month):
+    """
+    Find the water years the dates belong to, named after the calendar year in
+    which the water year starts (as in hyperloop.create_csv_yearly).
+
+    Parameters
+    ----------
+    dates : list
+        Contains datetime.date objects.
+    start_month : int
+        First month of the water year.
+
+    Returns
+    -------
+    years : list
+        Sorted list with the water years.
+    """
+    return sorted(set(date.year - 1 if date.month < start_month else date.year for date in dates))
+
+
 def assert_missing_dates(dates, timescale='months', quantity=1):
     """
     Checks if a list of dates is continuous, i.e. are there temporal gaps in the dates.
@@ -482,7 +1180,8 @@ def convert_datetime_date(dates, out=None):
     return dates
 
 
-def match_proj_res_ndv(source_file, target_fihs, output_dir, dtype='Float32'):
+def match_proj_res_ndv(source_file, target_fihs, output_dir, dtype='Float32',
+                       resample='near', index_dir=None, jobs=1, overwrite=True):
     """
     Matches the projection, resolution and no-data-value of a list of target-files
     with a source-file and saves the new maps in output_dir.
@@ -495,37 +1194,561 @@ def match_proj_res_ndv(source_file, target_fihs, output_dir, dtype='Float32'):
         The files to be reprojected.
     output_dir : str
         Folder to store the output.
-    resample : str, optional
-        Resampling method to use, default is 'near' (nearest neighbour).
     dtype : str, optional
         Datatype of output, default is 'float32'.
-    scale : int, optional
-        Multiple all maps with this value, default is None.
+    resample : str, optional
+        Resampling method to use when index_dir is given, either 'near'
+        (nearest neighbour) or 'bilinear'. Default is 'near'.
+    index_dir : str, optional
+        Folder to cache reprojection index maps in. When given, the mapping
+        from each distinct target grid to the source grid is calculated once
+        (see reprojection_index) and applied to the maps as an array lookup
+        instead of calling gdal.Warp for every file. Default is None.
+    jobs : int, optional
+        Number of files to reproject at the same time, default is 1. Files
+        are handled by a pool of threads, gdal.Warp and the array lookups
+        release the GIL. A file that fails does not stop the others, the
+        failures are reported together after all files have been processed.
+    overwrite : boolean, optional
+        Reproject files that already exist in output_dir, default is True. Set
+        to False to only reproject new files.
 
     Returns
     -------
     output_files : ndarray
-        Filehandles of the created files.
+        Filehandles of the created files, in the same order as target_fihs.
     """
-    ndv, xsize, ysize, geot, projection = get_geoinfo(source_file)[1:]
-    type_dict = {gdal.GetDataTypeName(i): i for i in range(1, 12)}
-    output_files = np.array([])
+    geo_info = get_geoinfo(source_file)
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
-    for target_file in target_fihs:
-        filename = os.path.split(target_file)[1]
-        output_file = os.path.join(output_dir, filename)
-        options = gdal.WarpOptions(width=xsize,
-                                   height=ysize,
-                                   outputBounds=(geot[0], geot[3] + ysize * geot[5],
-                                                 geot[0] + xsize * geot[1], geot[3]),
-                                   outputBoundsSRS=projection,
-                                   dstSRS=projection,
-                                   dstNodata=ndv,
-                                   outputType=type_dict[dtype])
-        gdal.Warp(output_file, target_file, options=options)
-        output_files = np.append(output_files, output_file)
-    return output_files
+
+    output_files = [os.path.join(output_dir, os.path.split(target_file)[1]) for target_file in target_fihs]
+    tasks = [(target_file, output_file, geo_info, dtype, resample, index_dir)
+             for target_file, output_file in zip(target_fihs, output_files)
+             if overwrite or not os.path.exists(output_file)]
+
+    if jobs > 1 and len(tasks) > 1:
+        pool = ThreadPool(min(jobs, len(tasks)))
+        try:
+            results = pool.imap(_match_file, tasks)
+            errors = _collect_match_results(results, len(tasks), output_dir)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = _collect_match_results((_match_file(task) for task in tasks), len(tasks), output_dir)
+
+    if errors:
+        raise RuntimeError("Failed to reproject {0} of {1} files to {2}:\n{3}".format(
+            len(errors), len(tasks), output_dir, "\n".join(errors)))
+
+    return np.array(output_files)
+
+
+def _collect_match_results(results, total, output_dir):
+    errors = list()
+    step = max(1, total // 10)
+    for i, error in enumerate(results):
+        if error is not None:
+            errors.append(error)
+        if (i + 1) % step == 0 or i + 1 == total:
+            print("{0}: {1}/{2} files reprojected".format(output_dir, i + 1, total))
+    return errors
+
+
+def _match_file(task):
+    target_file, output_file, geo_info, dtype, resample, index_dir = task
+    driver, ndv, xsize, ysize, geot, projection = geo_info
+    try:
+        if index_dir is not None:
+            t_ndv, t_xsize, t_ysize, t_geot, t_projection = get_geoinfo(target_file)[1:]
+            mapping = reprojection_index((t_xsize, t_ysize, t_geot, t_projection),
+                                         (xsize, ysize, geot, projection),
+                                         resample=resample, index_dir=index_dir)
+            data = open_as_array(target_file, nan_values=False,
+                                 cache=os.path.abspath(target_file) in _SHARED_LAYERS)
+            if 'weights' in mapping:
+                data = data.astype(np.float64)
+                if t_ndv is not None:
+                    data[data == t_ndv] = np.nan
+            array = apply_reprojection_index(data, mapping, (ysize, xsize))
+            if t_ndv is not None and 'weights' not in mapping:
+                array[array == t_ndv] = np.nan
+            create_geotiff(output_file, array.astype(dtype.lower()), driver, ndv,
+                           xsize, ysize, geot, projection)
+        else:
+            type_dict = {gdal.GetDataTypeName(i): i for i in range(1, 12)}
+            options = gdal.WarpOptions(width=xsize,
+                                       height=ysize,
+                                       outputBounds=(geot[0], geot[3] + ysize * geot[5],
+                                                     geot[0] + xsize * geot[1], geot[3]),
+                                       outputBoundsSRS=projection,
+                                       dstSRS=projection,
+                                       dstNodata=ndv,
+                                       outputType=type_dict[dtype])
+            temp_file = temp_filehandle(output_file)
+            gdal.Warp(temp_file, target_file, options=options)
+            replace_file(temp_file, output_file)
+    except Exception as error:
+        return "{0}: {1}".format(target_file, error)
+    return None
+
+
+_STATIC_CACHE = {'folder': None, 'temp_folder': None}
+_CONTENT_HASHES = dict()
+
+def set_static_cache(folder=None):
+    """
+    Set the folder in which match_static_layer stores reprojected static
+    maps. Use a persistent folder to reuse the maps in later runs. When
+    folder is None, a temporary folder is used that is removed when the
+    Python process exits.
+
+    Parameters
+    ----------
+    folder : str, optional
+        Folder to store the reprojected maps, default is None.
+    """
+    _STATIC_CACHE['folder'] = folder
+
+
+def _static_cache_folder():
+    folder = _STATIC_CACHE['folder']
+    if folder is None:
+        if _STATIC_CACHE['temp_folder'] is None:
+            _STATIC_CACHE['temp_folder'] = tempfile.mkdtemp(prefix='static_layers_')
+            atexit.register(shutil.rmtree, _STATIC_CACHE['temp_folder'], True)
+        folder = _STATIC_CACHE['temp_folder']
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+
+def content_hash(fih, blocksize=2**20):
+    """
+    Calculate the md5 hash of the contents of a file. Hashes are remembered
+    per path, size and modification time.
+
+    Parameters
+    ----------
+    fih : str
+        Filehandle of the file.
+    blocksize : int, optional
+        Number of bytes to read at once, default is 1 MB.
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal md5 hash.
+    """
+    stat = os.stat(fih)
+    key = (os.path.abspath(fih), stat.st_size, stat.st_mtime)
+    if key not in _CONTENT_HASHES:
+        md5 = hashlib.md5()
+        with open(fih, 'rb') as stream:
+            for block in iter(lambda: stream.read(blocksize), b''):
+                md5.update(block)
+        _CONTENT_HASHES[key] = md5.hexdigest()
+    return _CONTENT_HASHES[key]
+
+
+def match_static_layer(static_file, source_file, dtype='Float32'):
+    """
+    Match the projection, resolution and no-data-value of a static (not time
+    dependent) map, like a global population or water pollution map, with
+    source_file. The result is stored in the static cache (see
+    set_static_cache) under a name based on the contents of static_file and
+    the grid of source_file, so each map is reprojected only once per grid
+    and reused in later calls and runs.
+
+    Parameters
+    ----------
+    static_file : str
+        The map to be reprojected.
+    source_file : str
+        The file to match the projection, resolution and ndv with.
+    dtype : str, optional
+        Datatype of output, default is 'Float32'.
+
+    Returns
+    -------
+    output_file : str
+        Filehandle of the reprojected map.
+    """
+    folder = _static_cache_folder()
+    ndv, xsize, ysize, geot, wkt = raster_header(source_file)[1:]
+    grid = json.dumps([xsize, ysize, list(geot), wkt, ndv, dtype])
+    key = hashlib.md5((content_hash(static_file) + grid).encode('utf-8')).hexdigest()
+    name = os.path.splitext(os.path.basename(static_file))[0]
+    output_file = os.path.join(folder, '{0}_{1}.tif'.format(name, key[:16]))
+    if not os.path.exists(output_file):
+        temp_folder = tempfile.mkdtemp(dir=folder)
+        if os.path.abspath(static_file) in _SHARED_LAYERS:
+            index_dir = os.path.join(folder, 'reprojection')
+        else:
+            index_dir = None
+        try:
+            temp_file = match_proj_res_ndv(source_file, np.array([static_file]), temp_folder, dtype=dtype, index_dir=index_dir)[0]
+            os.rename(temp_file, output_file)
+        finally:
+            shutil.rmtree(temp_folder, ignore_errors=True)
+    return output_file
+
+
+_SHARED_LAYERS = dict()
+
+def share_layers(fihs, folder):
+    """
+    Store the first band of (global) maps as .npy files that are opened as
+    read-only memory maps by open_as_array, so that processes working on
+    different basins share one copy of the data instead of each reading
+    the complete map. Shared maps are reprojected by match_static_layer
+    with a nearest neighbour reprojection index.
+
+    Parameters
+    ----------
+    fihs : list
+        Filehandles pointing to the maps.
+    folder : str
+        Folder to store the .npy files, existing files with the same contents
+        are reused.
+
+    Returns
+    -------
+    shared : dict
+        Dictionary with the .npy file, size, modification time and content
+        hash per map, pass it to register_shared_layers in other processes.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    shared = dict()
+    for fih in fihs:
+        name = os.path.splitext(os.path.basename(fih))[0]
+        stat = os.stat(fih)
+        digest = content_hash(fih)
+        npy = os.path.join(folder, '{0}_{1}.npy'.format(name, digest[:16]))
+        if not os.path.exists(npy):
+            array = open_as_array(fih, nan_values=False)
+            temp_npy = temp_filehandle(npy)
+            memmap = np.lib.format.open_memmap(temp_npy, mode='w+', dtype=array.dtype, shape=array.shape)
+            memmap[:] = array
+            del memmap
+            replace_file(temp_npy, npy)
+        shared[os.path.abspath(fih)] = (npy, stat.st_size, stat.st_mtime, digest)
+    register_shared_layers(shared)
+    return shared
+
+
+def register_shared_layers(shared):
+    """
+    Let open_as_array read maps from the .npy files created by share_layers.
+    The content hashes calculated by share_layers are reused by content_hash,
+    so the maps are not hashed again in every process.
+
+    Parameters
+    ----------
+    shared : dict
+        Dictionary with the .npy file, size, modification time and content
+        hash per map, see share_layers.
+    """
+    for fih, (npy, size, mtime, digest) in shared.items():
+        _CONTENT_HASHES[(fih, size, mtime)] = digest
+    _SHARED_LAYERS.update(shared)
+
+
+def _open_shared_layer(fih, nan_values, cache, rows):
+    array = np.load(_SHARED_LAYERS[os.path.abspath(fih)][0], mmap_mode='r')
+    if rows is not None:
+        array = array[rows[0]:rows[0] + rows[1]]
+    if nan_values:
+        ndv = raster_header(fih)[1]
+        array = np.array(array, dtype=np.float64 if array.dtype == np.float64 else np.float32)
+        if ndv is not None:
+            array[array == ndv] = np.nan
+        if cache:
+            array.setflags(write=False)
+    elif not cache:
+        array = np.array(array)
+    return array
+
+
+_MONTH_POOL = {'processes': 1, 'max_pending': None}
+_MONTH_CONTEXT = dict()
+
+def set_month_processes(processes=1, max_pending=None):
+    """
+    Set the number of processes used by map_months.
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of processes, 1 runs the months in the calling process. Default
+        is 1.
+    max_pending : int, optional
+        Maximum number of months submitted but not yet consumed, which bounds
+        the memory used by results waiting to be consumed. Default is twice
+        the number of processes.
+    """
+    _MONTH_POOL['processes'] = processes
+    _MONTH_POOL['max_pending'] = max_pending
+
+
+def _init_month_worker(function, context, shared):
+    _MONTH_CONTEXT[function] = context
+    register_shared_layers(shared)
+
+
+def _run_month(args):
+    function, task = args
+    return function(_MONTH_CONTEXT[function], task)
+
+
+def map_months(function, tasks, context=None):
+    """
+    Call function(context, task) for each task, e.g. the independent monthly
+    part of a sheet, in a pool of processes (see set_month_processes). The
+    results are yielded in the order of tasks, so the caller can do the
+    sequential part (csv-files, yearly totals) while the pool continues.
+    The context is sent once to every process, the tasks one at a time. The
+    first task is run in the calling process.
+
+    Parameters
+    ----------
+    function : function
+        Module level function accepting the context and one task.
+    tasks : list
+        Picklable arguments, one per month.
+    context : object, optional
+        Picklable arguments shared by all months, default is None.
+
+    Returns
+    -------
+    results : generator
+        Results of function in the order of tasks.
+
+    Examples
+    --------
+    >>> for date, totals in zip(dates, map_months(monthly_totals, fhs, (lu_fh, AREA))):
+    ...     writer.writerow([date, totals])
+    """
+    processes = _MONTH_POOL['processes']
+    if processes <= 1 or multiprocessing.current_process().daemon:
+        for task in tasks:
+            yield function(context, task)
+        return
+
+    # Run the first month here, so folders created by function exist before
+    # the other months start.
+    tasks = iter(tasks)
+    for task in tasks:
+        yield function(context, task)
+        break
+
+    max_pending = _MONTH_POOL['max_pending'] or 2 * processes
+    pool = multiprocessing.Pool(processes, initializer=_init_month_worker,
+                                initargs=(function, context, dict(_SHARED_LAYERS)))
+    try:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_run_month, ((function, task),)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+_REPROJECTION_INDICES = dict()
+_REPROJECTION_LOCK = threading.Lock()
+
+def reprojection_index(from_grid, to_grid, resample='near', index_dir=None):
+    """
+    Calculate which pixels of one grid end up in the pixels of another grid,
+    so that any map on from_grid can be reprojected with an array lookup.
+    Index maps are cached in memory and, if index_dir is given, on disk.
+
+    Parameters
+    ----------
+    from_grid : tuple
+        Tuple with (xsize, ysize, geot, projection) of the grid of the input maps.
+    to_grid : tuple
+        Tuple with (xsize, ysize, geot, projection) of the output grid.
+    resample : str, optional
+        Either 'near' (nearest neighbour) or 'bilinear', default is 'near'.
+    index_dir : str, optional
+        Folder to store the index maps, default is None.
+
+    Returns
+    -------
+    mapping : dict
+        Dictionary with 'index', the flat indices in from_grid for each pixel
+        of to_grid (-1 when outside from_grid), and for bilinear resampling
+        the four neighbours per pixel and their 'weights'.
+    """
+    signature = json.dumps([resample] + [[grid[0], grid[1], list(grid[2]), grid[3].ExportToWkt()]
+                                         for grid in (from_grid, to_grid)])
+    key = hashlib.md5(signature.encode('utf-8')).hexdigest()
+    with _REPROJECTION_LOCK:
+        if key not in _REPROJECTION_INDICES:
+            _REPROJECTION_INDICES[key] = _load_reprojection_index(key, from_grid, to_grid,
+                                                                  resample, index_dir)
+    return _REPROJECTION_INDICES[key]
+
+
+def _load_reprojection_index(key, from_grid, to_grid, resample, index_dir):
+    index_fih = None if index_dir is None else os.path.join(index_dir, 'index_{0}.npz'.format(key))
+    if index_fih is not None and os.path.exists(index_fih):
+        with np.load(index_fih) as stored:
+            mapping = dict((name, stored[name]) for name in stored.files)
+    else:
+        mapping = _calc_reprojection_index(from_grid, to_grid, resample)
+        if index_fih is not None:
+            if not os.path.exists(index_dir):
+                os.makedirs(index_dir)
+            np.savez(index_fih, **mapping)
+    return mapping
+
+
+def _calc_reprojection_index(from_grid, to_grid, resample):
+    f_xsize, f_ysize, f_geot, f_projection = from_grid
+    t_xsize, t_ysize, t_geot, t_projection = to_grid
+
+    columns = np.arange(t_xsize) + 0.5
+    transform = None
+    if not t_projection.IsSame(f_projection):
+        for srs in (t_projection, f_projection):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        transform = osr.CoordinateTransformation(t_projection, f_projection)
+
+    x_pixels = np.zeros((t_ysize, t_xsize))
+    y_pixels = np.zeros((t_ysize, t_xsize))
+    for row in range(t_ysize):
+        x = t_geot[0] + columns * t_geot[1] + (row + 0.5) * t_geot[2]
+        y = t_geot[3] + columns * t_geot[4] + (row + 0.5) * t_geot[5]
+        if transform is not None:
+            points = np.array(transform.TransformPoints(list(zip(x, y))))
+            x, y = points[:, 0], points[:, 1]
+        x_pixels[row] = (x - f_geot[0]) / f_geot[1]
+        y_pixels[row] = (y - f_geot[3]) / f_geot[5]
+    x_pixels = x_pixels.ravel()
+    y_pixels = y_pixels.ravel()
+
+    dtype = np.int32 if f_xsize * f_ysize < 2**31 else np.int64
+
+    if resample == 'near':
+        x_index = np.floor(x_pixels).astype(np.int64)
+        y_index = np.floor(y_pixels).astype(np.int64)
+        inside = (x_index >= 0) & (x_index < f_xsize) & (y_index >= 0) & (y_index < f_ysize)
+        index = np.where(inside, y_index * f_xsize + x_index, -1).astype(dtype)
+        return {'index': index}
+
+    elif resample == 'bilinear':
+        x_pixels -= 0.5
+        y_pixels -= 0.5
+        x0 = np.floor(x_pixels).astype(np.int64)
+        y0 = np.floor(y_pixels).astype(np.int64)
+        dx = x_pixels - x0
+        dy = y_pixels - y0
+        index = np.zeros((4, x0.size), dtype=dtype)
+        weights = np.zeros((4, x0.size), dtype=np.float32)
+        for i, (x_offset, y_offset, weight) in enumerate([(0, 0, (1 - dx) * (1 - dy)),
+                                                          (1, 0, dx * (1 - dy)),
+                                                          (0, 1, (1 - dx) * dy),
+                                                          (1, 1, dx * dy)]):
+            xi = x0 + x_offset
+            yi = y0 + y_offset
+            inside = (xi >= 0) & (xi < f_xsize) & (yi >= 0) & (yi < f_ysize)
+            index[i] = np.where(inside, yi * f_xsize + xi, 0)
+            weights[i] = np.where(inside, weight, 0.0)
+        return {'index': index, 'weights': weights}
+
+    else:
+        raise ValueError("resample should be 'near' or 'bilinear', not '{0}'".format(resample))
+
+
+def apply_reprojection_index(array, mapping, shape):
+    """
+    Reproject a map with an index map calculated by reprojection_index.
+
+    Parameters
+    ----------
+    array : ndarray
+        Map on the grid the index map was calculated from, with np.nan as
+        no-data-value.
+    mapping : dict
+        Index map, see reprojection_index.
+    shape : tuple
+        Shape (ysize, xsize) of the output grid.
+
+    Returns
+    -------
+    reprojected : ndarray
+        Map on the output grid.
+    """
+    values = np.ravel(array)
+    index = mapping['index']
+    if 'weights' not in mapping:
+        reprojected = values[np.maximum(index, 0)].astype(np.float64)
+        reprojected[index < 0] = np.nan
+    else:
+        neighbours = values[index]
+        weights = np.where(np.isnan(neighbours), 0.0, mapping['weights'])
+        total = np.sum(weights, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            reprojected = np.sum(np.where(weights > 0, neighbours, 0.0) * weights, axis=0) / total
+        reprojected[total == 0] = np.nan
+    return reprojected.reshape(shape)
+
+
+_GEOINFO_CACHE = dict()
+
+def raster_header(fih, subdataset=0, subdataset_drivers=('HDF4', 'netCDF')):
+    """
+    Read the header of a raster once per path and modification time. Cached
+    headers are reused by get_geoinfo, get_gdalwarp_info and
+    assert_proj_res_ndv, so repeated metadata lookups do not reopen files.
+
+    Parameters
+    ----------
+    fih : str
+        Filehandle pointing to a geotiff, HDF4 or netCDF file.
+    subdataset : int, optional
+        Layer to be used in case of HDF4 or netCDF format, default is 0.
+    subdataset_drivers : tuple, optional
+        Drivers for which the subdataset is opened instead of the file itself.
+
+    Returns
+    -------
+    header : tuple
+        Tuple with (driver name, ndv, xsize, ysize, geot, projection wkt).
+    """
+    try:
+        key = (os.path.abspath(fih), os.path.getmtime(fih), subdataset, subdataset_drivers)
+    except OSError:
+        key = None
+    if key is not None and key in _GEOINFO_CACHE:
+        return _GEOINFO_CACHE[key]
+    dataset = gdal.Open(fih, gdal.GA_ReadOnly)
+    tpe = dataset.GetDriver().ShortName
+    if tpe in subdataset_drivers:
+        dataset = gdal.Open(dataset.GetSubDatasets()[subdataset][0])
+    header = (tpe, dataset.GetRasterBand(1).GetNoDataValue(), dataset.RasterXSize,
+              dataset.RasterYSize, tuple(dataset.GetGeoTransform()), dataset.GetProjectionRef())
+    dataset = None
+    if key is not None:
+        _GEOINFO_CACHE[key] = header
+    return header
+
+
+def clear_geoinfo_cache():
+    """
+    Forget all raster headers cached by raster_header.
+    """
+    _GEOINFO_CACHE.clear()
 
 
 def get_geoinfo(fih, subdataset=0):
@@ -554,23 +1777,18 @@ def get_geoinfo(fih, subdataset=0):
     Projection : str
         Projection of fih.
     """
-    sourceds = gdal.Open(fih, gdal.GA_ReadOnly)
-    tpe = sourceds.GetDriver().ShortName
-    if tpe == 'HDF4' or tpe == 'netCDF':
-        sourceds = gdal.Open(sourceds.GetSubDatasets()[subdataset][0])
-    ndv = sourceds.GetRasterBand(1).GetNoDataValue()
-    xsize = sourceds.RasterXSize
-    ysize = sourceds.RasterYSize
-    geot = sourceds.GetGeoTransform()
+    tpe, ndv, xsize, ysize, geot, wkt = raster_header(fih, subdataset)
     projection = osr.SpatialReference()
-    projection.ImportFromWkt(sourceds.GetProjectionRef())
+    projection.ImportFromWkt(wkt)
     driver = gdal.GetDriverByName(tpe)
     return driver, ndv, xsize, ysize, geot, projection
 
 
 def list_files_in_folder(folder, extension='tif'):
     """
-    List the files in a folder with a specified extension.
+    List the files in a folder with a specified extension. Hidden files, like
+    the temporary files of an interrupted write (see temp_filehandle), are
+    skipped.
 
     Parameters
     ----------
@@ -584,11 +1802,61 @@ def list_files_in_folder(folder, extension='tif'):
     list_of_files : list
         List with filehandles of the files found in folder with extension.
     """
-    list_of_files = [os.path.join(folder, fn) for fn in next(os.walk(folder))[2] if fn.split('.')[-1] == extension]
+    list_of_files = [os.path.join(folder, fn) for fn in next(os.walk(folder))[2]
+                     if fn.split('.')[-1] == extension and not fn.startswith('.')]
     return list_of_files
 
 
-def open_as_array(fih, bandnumber=1, nan_values=True):
+_READ_CACHE = collections.OrderedDict()
+_READ_CACHE_INFO = {'max_bytes': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+def set_read_cache(max_megabytes=1024):
+    """
+    Enable (or disable) the raster read cache used by open_as_array when it is
+    called with cache=True. Arrays are evicted least-recently-used first when
+    the total size of the cached arrays exceeds the limit.
+
+    Parameters
+    ----------
+    max_megabytes : float, optional
+        Maximum size of the cache in MB, set to 0 to disable the cache. Default
+        is 1024.
+    """
+    _READ_CACHE_INFO['max_bytes'] = int(max_megabytes * 1024**2)
+    _evict_read_cache()
+
+
+def clear_read_cache():
+    """
+    Remove all arrays from the raster read cache and reset its counters.
+    """
+    _READ_CACHE.clear()
+    _READ_CACHE_INFO.update({'bytes': 0, 'hits': 0, 'misses': 0, 'evictions': 0})
+
+
+def read_cache_info():
+    """
+    Get the state of the raster read cache.
+
+    Returns
+    -------
+    info : dict
+        Dictionary with the keys 'max_bytes', 'bytes', 'entries', 'hits',
+        'misses' and 'evictions'.
+    """
+    info = dict(_READ_CACHE_INFO)
+    info['entries'] = len(_READ_CACHE)
+    return info
+
+
+def _evict_read_cache():
+    while _READ_CACHE and _READ_CACHE_INFO['bytes'] > _READ_CACHE_INFO['max_bytes']:
+        array = _READ_CACHE.popitem(last=False)[1]
+        _READ_CACHE_INFO['bytes'] -= array.nbytes
+        _READ_CACHE_INFO['evictions'] += 1
+
+
+def open_as_array(fih, bandnumber=1, nan_values=True, cache=False, rows=None):
     """
     Open a map as an numpy array.
 
@@ -603,12 +1871,37 @@ def open_as_array(fih, bandnumber=1, nan_values=True):
     nan_values : boolean, optional
         Convert he no-data-values into np.nan values, note that dtype needs to
         be a float if True. Default is False.
+    cache : boolean, optional
+        Look up the map in the read cache (see set_read_cache) before opening
+        it. Only use this for maps that are not modified by the caller, the
+        returned array is read-only when the cache is enabled. Default is False.
+    rows : tuple, optional
+        Tuple with (first row, number of rows) to only read a block of rows
+        of the map. Not combined with the read cache. Default is None.
 
     Returns
     -------
     array : ndarray
         array with the pixel values.
     """
+    if bandnumber == 1 and os.path.abspath(fih) in _SHARED_LAYERS:
+        return _open_shared_layer(fih, nan_values, cache, rows)
+
+    if cache and rows is None and _READ_CACHE_INFO['max_bytes'] > 0:
+        key = (os.path.abspath(fih), os.path.getmtime(fih), bandnumber, nan_values)
+        if key in _READ_CACHE:
+            _READ_CACHE[key] = _READ_CACHE.pop(key)
+            _READ_CACHE_INFO['hits'] += 1
+            return _READ_CACHE[key]
+        _READ_CACHE_INFO['misses'] += 1
+        array = open_as_array(fih, bandnumber=bandnumber, nan_values=nan_values)
+        array.setflags(write=False)
+        if array.nbytes <= _READ_CACHE_INFO['max_bytes']:
+            _READ_CACHE[key] = array
+            _READ_CACHE_INFO['bytes'] += array.nbytes
+            _evict_read_cache()
+        return array
+
     dataset = gdal.Open(fih, gdal.GA_ReadOnly)
     tpe = dataset.GetDriver().ShortName
     if tpe == 'HDF4':
@@ -617,7 +1910,12 @@ def open_as_array(fih, bandnumber=1, nan_values=True):
     else:
         subdataset = dataset.GetRasterBand(bandnumber)
         ndv = subdataset.GetNoDataValue()
-    array = subdataset.ReadAsArray()
+    if rows is None:
+        array = subdataset.ReadAsArray()
+    else:
+        xsize = dataset.RasterXSize if tpe != 'HDF4' else subdataset.RasterXSize
+        ysize = dataset.RasterYSize if tpe != 'HDF4' else subdataset.RasterYSize
+        array = subdataset.ReadAsArray(0, rows[0], xsize, min(rows[1], ysize - rows[0]))
     if nan_values:
         if len(array[array == ndv]) >0:
             array[array == ndv] = np.nan
@@ -626,7 +1924,9 @@ def open_as_array(fih, bandnumber=1, nan_values=True):
 
 def create_geotiff(fih, array, driver, ndv, xsize, ysize, geot, projection, compress=None):
     """
-    Creates a geotiff from a numpy array.
+    Creates a geotiff from a numpy array. The map is written to a temporary
+    file first and then renamed, so an interrupted run never leaves a
+    partially written map behind.
 
     Parameters
     ----------
@@ -648,10 +1948,11 @@ def create_geotiff(fih, array, driver, ndv, xsize, ysize, geot, projection, comp
         Projection of fih.
     """
     datatypes = {gdal.GetDataTypeName(i).lower() : i for i in range(1, 12)}
+    temp_fih = temp_filehandle(fih)
     if compress != None:
-        dataset = driver.Create(fih, xsize, ysize, 1, datatypes[array.dtype.name], ['COMPRESS={0}'.format(compress)])
+        dataset = driver.Create(temp_fih, xsize, ysize, 1, datatypes[array.dtype.name], ['COMPRESS={0}'.format(compress)])
     else:
-        dataset = driver.Create(fih, xsize, ysize, 1, datatypes[array.dtype.name])
+        dataset = driver.Create(temp_fih, xsize, ysize, 1, datatypes[array.dtype.name])
     if ndv is None:
         ndv = -9999
     array[np.isnan(array)] = ndv
@@ -660,10 +1961,201 @@ def create_geotiff(fih, array, driver, ndv, xsize, ysize, geot, projection, comp
     dataset.SetProjection(projection.ExportToWkt())
     dataset.GetRasterBand(1).WriteArray(array)
     dataset = None
+    replace_file(temp_fih, fih)
     if "nt" not in array.dtype.name:
         array[array == ndv] = np.nan
 
 
+def temp_filehandle(fih):
+    """
+    Create a filehandle for a temporary file in the same folder as fih, with
+    the same extension so that the (GDAL) driver can be derived from it.
+
+    Parameters
+    ----------
+    fih : str
+        Filehandle of the final file.
+
+    Returns
+    -------
+    temp_fih : str
+        Filehandle of the temporary file.
+    """
+    folder, name = os.path.split(fih)
+    root, extension = os.path.splitext(name)
+    return os.path.join(folder, '.{0}.{1}.tmp{2}'.format(root, os.getpid(), extension))
+
+
+def replace_file(temp_fih, fih):
+    """
+    Rename a temporary file to its final name, replacing an existing file.
+    On POSIX systems the rename is atomic.
+
+    Parameters
+    ----------
+    temp_fih : str
+        Filehandle of the temporary file.
+    fih : str
+        Filehandle of the final file.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(temp_fih, fih)
+    else:
+        if os.path.exists(fih):
+            os.remove(fih)
+        os.rename(temp_fih, fih)
+
+
+def svg_to_pdf(svg_fih, fih):
+    """
+    Convert a svg-file to a pdf-file, the pdf is written to a temporary file
+    first so that an interrupted conversion does not leave a partial pdf.
+
+    Parameters
+    ----------
+    svg_fih : str
+        Filehandle of the svg-file.
+    fih : str
+        Filehandle of the pdf-file.
+    """
+    import cairosvg
+    temp_fih = temp_filehandle(fih)
+    cairosvg.svg2pdf(url=svg_fih, write_to=temp_fih)
+    replace_file(temp_fih, fih)
+
+
+_CUBES = dict()
+
+def write_cube(fihs, dates, cube_fih):
+    """
+    Store a series of maps with the same dimensions as one memory-mapped
+    (time, y, x) float32 array. The dates and georeference are saved in a
+    sidecar json-file next to the cube.
+
+    Parameters
+    ----------
+    fihs : ndarray
+        Array with filehandles pointing to the maps.
+    dates : ndarray
+        Array with datetime.date objects corresponding to fihs.
+    cube_fih : str
+        Filehandle of the cube to be created, should end with '.npy'.
+
+    Returns
+    -------
+    cube_fih : str
+        Filehandle of the created cube.
+    """
+    order = np.argsort([date.toordinal() for date in dates])
+    fihs = np.array(fihs)[order]
+    dates = np.array(dates)[order]
+
+    driver, ndv, xsize, ysize, geot, projection = get_geoinfo(fihs[0])
+    folder = os.path.dirname(cube_fih)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+
+    _CUBES.pop(os.path.abspath(cube_fih), None)
+    temp_fih = temp_filehandle(cube_fih)
+    cube = np.lib.format.open_memmap(temp_fih, mode='w+', dtype=np.float32, shape=(len(fihs), ysize, xsize))
+    for i, fih in enumerate(fihs):
+        cube[i] = open_as_array(fih, nan_values=True)
+    cube.flush()
+    del cube
+    replace_file(temp_fih, cube_fih)
+
+    meta = {'dates': [date.toordinal() for date in dates],
+            'filehandles': [str(fih) for fih in fihs],
+            'geotransform': list(geot),
+            'projection': projection.ExportToWkt(),
+            'ndv': ndv}
+    temp_fih = temp_filehandle(_cube_meta_fih(cube_fih))
+    with open(temp_fih, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    replace_file(temp_fih, _cube_meta_fih(cube_fih))
+    return cube_fih
+
+
+def open_cube(cube_fih):
+    """
+    Open a cube created with write_cube.
+
+    Parameters
+    ----------
+    cube_fih : str
+        Filehandle pointing to the cube.
+
+    Returns
+    -------
+    cube : memmap
+        Read-only (time, y, x) array, no-data-values are np.nan.
+    dates : ndarray
+        Array with datetime.date objects for the first axis of cube.
+    meta : dict
+        Dictionary with the 'geotransform', 'projection' (wkt), 'ndv' and the
+        original 'filehandles'.
+    """
+    key = os.path.abspath(cube_fih)
+    mtime = os.path.getmtime(_cube_meta_fih(cube_fih))
+    if key not in _CUBES or _CUBES[key][0] != mtime:
+        with open(_cube_meta_fih(cube_fih), 'r') as meta_file:
+            meta = json.load(meta_file)
+        dates = np.array([datetime.date.fromordinal(ordinal) for ordinal in meta['dates']])
+        cube = np.load(cube_fih, mmap_mode='r')
+        index = dict((_date_key(date), i) for i, date in enumerate(dates))
+        _CUBES[key] = (mtime, cube, dates, meta, index)
+    return _CUBES[key][1:4]
+
+
+def cube_map(cube_fih, date):
+    """
+    Get the map of one date from a cube without copying it.
+
+    Parameters
+    ----------
+    cube_fih : str
+        Filehandle pointing to the cube.
+    date : datetime.date
+        Date of the map.
+
+    Returns
+    -------
+    array : ndarray
+        Read-only (y, x) view on the cube.
+    """
+    cube = open_cube(cube_fih)[0]
+    index = _CUBES[os.path.abspath(cube_fih)][4]
+    return cube[index[_date_key(date)]]
+
+
+def cube_pixel(cube_fih, row, column):
+    """
+    Get the time series of one pixel from a cube.
+
+    Parameters
+    ----------
+    cube_fih : str
+        Filehandle pointing to the cube.
+    row : int
+        Index of the pixel in y direction.
+    column : int
+        Index of the pixel in x direction.
+
+    Returns
+    -------
+    dates : ndarray
+        Array with datetime.date objects.
+    values : ndarray
+        The values of the pixel for each date.
+    """
+    cube, dates = open_cube(cube_fih)[0:2]
+    return dates, cube[:, row, column]
+
+
+def _cube_meta_fih(cube_fih):
+    return os.path.splitext(cube_fih)[0] + '.json'
+
+
 def pixel_coordinates(lon, lat, fih):
     """
     Find the corresponding pixel to a latitude and longitude.
@@ -703,7 +2195,7 @@ def pixel_coordinates(lon, lat, fih):
     return xpixel, ypixel
 
 
-def assert_proj_res_ndv(list_of_filehandle_lists, check_ndv=True):
+def assert_proj_res_ndv(list_of_filehandle_lists, check_ndv=True, sample=None):
     """
     Check if the projection, resolution and no-data-value of all provided filehandles are the same.
 
@@ -713,6 +2205,11 @@ def assert_proj_res_ndv(list_of_filehandle_lists, check_ndv=True):
         List with different ndarray containing filehandles to compare.
     check_ndv : boolean, optional
         Check or ignore the no-data-values, default is True.
+    sample : int, optional
+        Only check this many evenly spaced files (including the first and
+        last) of each list. Useful for lists written by a single producer,
+        like the output of match_proj_res_ndv. Default is None, which checks
+        all files.
 
     Examples
     --------
@@ -721,8 +2218,10 @@ def assert_proj_res_ndv(list_of_filehandle_lists, check_ndv=True):
     longlist = np.array([])
     for fih_list in list_of_filehandle_lists:
         if isinstance(fih_list, list):
-            longlist = np.append(longlist, np.array(fih_list))
+            fih_list = np.array(fih_list)
         if isinstance(fih_list, np.ndarray):
+            if sample is not None and fih_list.size > sample:
+                fih_list = fih_list[np.unique(np.linspace(0, fih_list.size - 1, sample).astype(int))]
             longlist = np.append(longlist, fih_list)
         if isinstance(fih_list, str):
             longlist = np.append(longlist, np.array(fih_list))
@@ -735,9 +2234,12 @@ def assert_proj_res_ndv(list_of_filehandle_lists, check_ndv=True):
             assert np.all([s_ts == t_ts, s_te == t_te, s_srs == t_srs]), "{0} does not have the same Proj/Res as {1}".format(longlist[0], fih)
 
 
-def map_pixel_area_km(fih, approximate_lengths=False):
+_PIXEL_AREA_CACHE = dict()
+
+def map_pixel_area_km(fih, approximate_lengths=False, per_row=False):
     """
-    Calculate the area of the pixels in a geotiff.
+    Calculate the area of the pixels in a geotiff. The areas are calculated
+    on the WGS84 ellipsoid and are cached per geotransform and shape.
 
     Parameters
     ----------
@@ -745,6 +2247,9 @@ def map_pixel_area_km(fih, approximate_lengths=False):
         Filehandle pointing to a geotiff.
     approximate_lengths : boolean, optional
         Give the approximate length per degree [km/deg] instead of the area [km2], default is False.
+    per_row : boolean, optional
+        Return an array with shape (ysize, 1) containing one value per row,
+        which broadcasts against the maps, instead of a full map. Default is False.
 
     Returns
     -------
@@ -752,23 +2257,51 @@ def map_pixel_area_km(fih, approximate_lengths=False):
         The area per cell.
     """
     xsize, ysize, geot = get_geoinfo(fih)[2:-1]
-    area_column = np.zeros((ysize, 1))
-    for y_pixel in range(ysize):
-        pnt1 = (geot[3] + y_pixel*geot[5], geot[0])
-        pnt2 = (pnt1[0], pnt1[1] + geot[1])
-        pnt3 = (pnt1[0] - geot[1],  pnt1[1])
-        pnt4 = (pnt1[0] - geot[1], pnt1[1] + geot[1])
-        u = distance.distance(pnt1, pnt2).km
-        l = distance.distance(pnt3, pnt4).km
-        h = distance.distance(pnt1, pnt3).km
-        area_column[y_pixel, 0] = (u+l)/2*h
-    map_area = np.repeat(area_column, xsize, axis=1)
+    key = (tuple(geot), xsize, ysize)
+    if key not in _PIXEL_AREA_CACHE:
+        _PIXEL_AREA_CACHE[key] = _pixel_area_column(geot, ysize)
+    area_column = _PIXEL_AREA_CACHE[key]
     if approximate_lengths:
         pixel_approximation = np.sqrt(abs(geot[1]) * abs(geot[5]))
-        map_area = np.sqrt(map_area) / pixel_approximation
+        area_column = np.sqrt(area_column) / pixel_approximation
+    if per_row:
+        map_area = np.array(area_column)
+    else:
+        map_area = np.repeat(area_column, xsize, axis=1)
     return map_area
 
 
+def _pixel_area_column(geot, ysize, a=6378.137, f=1/298.257223563):
+    """
+    Calculate the area [km2] of the pixels in each row of a grid, with the
+    same trapezoid as before (top and bottom length along the parallels and
+    the height along the meridian), but using closed-form expressions for the
+    WGS84 ellipsoid instead of a geodesic per point.
+    """
+    e2 = f * (2 - f)
+    lat1 = np.radians(geot[3] + np.arange(ysize) * geot[5])
+    lat2 = lat1 - np.radians(geot[1])
+    dlon = np.radians(abs(geot[1]))
+
+    def parallel_length(lat):
+        return a * np.cos(lat) / np.sqrt(1 - e2 * np.sin(lat)**2) * dlon
+
+    def meridian_distance(lat):
+        e4 = e2**2
+        e6 = e2**3
+        return a * ((1 - e2/4 - 3*e4/64 - 5*e6/256) * lat
+                    - (3*e2/8 + 3*e4/32 + 45*e6/1024) * np.sin(2*lat)
+                    + (15*e4/256 + 45*e6/1024) * np.sin(4*lat)
+                    - (35*e6/3072) * np.sin(6*lat))
+
+    u = parallel_length(lat1)
+    l = parallel_length(lat2)
+    h = np.abs(meridian_distance(lat1) - meridian_distance(lat2))
+    area_column = ((u + l) / 2 * h)[:, np.newaxis]
+    area_column.setflags(write=False)
+    return area_column
+
+
 def xdaily_to_monthly(files, dates, out_path, name_out):
     r"""
 
@@ -8,6 +8,7 @@ from __future__ import print_function
 from builtins import zip
 from builtins import range
 import os
+import json
 import numpy as np
 import matplotlib.pyplot as plt
 import re
@@ -29,7 +30,7 @@ def get_ts_from_complete_data(complete_data, mask, keys, dates = None):
         keys = list(complete_data.keys())
     
     common_dates = becgis.common_dates([complete_data[key][1] for key in keys])
-    becgis.assert_proj_res_ndv([complete_data[key][0] for key in keys])
+    becgis.assert_proj_res_ndv([complete_data[key][0] for key in keys], sample = 3)
     
     MASK = becgis.open_as_array(mask, nan_values = True)
     
@@ -41,10 +42,8 @@ def get_ts_from_complete_data(complete_data, mask, keys, dates = None):
         
         for date in common_dates:
             
-            tif = complete_data[key][0][complete_data[key][1] == date][0]
-            
-            DATA = becgis.open_as_array(tif, nan_values = True)
-            DATA[np.isnan(DATA)] = 0.0
+            DATA = complete_data[key].array(date)
+            DATA = np.where(np.isnan(DATA), 0.0, DATA)
             
             DATA[np.isnan(MASK)] = np.nan
             
@@ -61,7 +60,7 @@ def get_ts_from_complete_data_spec(complete_data, lu_fh, keys, a, dates = None):
         keys = list(complete_data.keys())
     
     common_dates = becgis.common_dates([complete_data[key][1] for key in keys])
-    becgis.assert_proj_res_ndv([complete_data[key][0] for key in keys])
+    becgis.assert_proj_res_ndv([complete_data[key][0] for key in keys], sample = 3)
     
     MASK = becgis.open_as_array(lu_fh, nan_values = True)
     
@@ -79,10 +78,8 @@ def get_ts_from_complete_data_spec(complete_data, lu_fh, keys, a, dates = None):
         
         for date in common_dates:
             
-            tif = complete_data[key][0][complete_data[key][1] == date][0]
-            
-            DATA = becgis.open_as_array(tif, nan_values = True)
-            DATA[np.isnan(DATA)] = 0.0
+            DATA = complete_data[key].array(date)
+            DATA = np.where(np.isnan(DATA), 0.0, DATA)
             
             DATA[np.isnan(MASK)] = np.nan
             
@@ -251,15 +248,36 @@ def calc_gwsupply(total_supply, params):
     return gw_supply
     
 def correct_var(metadata, complete_data, output_dir, formula,
-                new_var, slope = False, bounds = (0, [1.0, 1., 12.])):
+                new_var, slope = False, bounds = (0, [1.0, 1., 12.]),
+                dates = None, refit = True):
     
     var = split_form(formula)[0][-1]
     
-    a, x0 = calc_var_correction(metadata, complete_data, output_dir,
-                            formula = formula, slope = slope, plot = True, bounds = bounds)
+    folder = os.path.join(output_dir, metadata['name'],
+                          'data', new_var)
+    
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    
+    fit_fh = os.path.join(folder, 'correction.json')
+    
+    if refit or not os.path.exists(fit_fh):
+        a, x0 = calc_var_correction(metadata, complete_data, output_dir,
+                                formula = formula, slope = slope, plot = True, bounds = bounds)
+        save_correction(fit_fh, a, x0)
+    else:
+        a, x0 = load_correction(fit_fh)
+        print("Using stored alpha, beta and theta from {0}".format(fit_fh))
     
     for date, fn in zip(complete_data[var][1], complete_data[var][0]):
         
+        bla = os.path.split(fn)[1].split('_')[-1]
+        filen = 'supply_sw_' + bla[0:6] + '.tif'
+        out_fn = os.path.join(folder, filen)
+        
+        if not refit and os.path.exists(out_fn) and not becgis.in_selection([date], dates)[0]:
+            continue
+        
         geo_info = becgis.get_geoinfo(fn)
         
         data = becgis.open_as_array(fn, nan_values = True)
@@ -269,22 +287,35 @@ def correct_var(metadata, complete_data, output_dir, formula,
         fraction = a[0] * (np.cos((x - a[2]) * (np.pi / 6)) * 0.5 + 0.5) + (a[1] * (1 - a[0]))
         
         data *= fraction
-        
-        folder = os.path.join(output_dir, metadata['name'],
-                              'data', new_var)
-        
-        if not os.path.exists(folder):
-            os.makedirs(folder)
             
-        bla = os.path.split(fn)[1].split('_')[-1]
-        filen = 'supply_sw_' + bla[0:6] + '.tif'
-        fn = os.path.join(folder, filen)
-            
-        becgis.create_geotiff(fn, data, *geo_info)
+        becgis.create_geotiff(out_fn, data, *geo_info)
         
-    meta = becgis.sort_files(folder, [-10,-6], month_position = [-6,-4])[0:2]
+    meta = becgis.TimeSeriesCatalog(*becgis.sort_files(folder, [-10,-6], month_position = [-6,-4])[0:2])
     return a, meta
 
+
+def save_correction(fh, a, x0):
+    """
+    Store the fitted parameters of the supply correction, so that later
+    (incremental) runs can apply them to new months without refitting.
+    """
+    if isinstance(x0, datetime):
+        x0 = x0.date()
+    with open(fh, 'w') as json_file:
+        json.dump({'a': [float(value) for value in a],
+                   'x0': x0.isoformat()}, json_file, indent = 2)
+
+
+def load_correction(fh):
+    """
+    Load the parameters stored by save_correction.
+    """
+    with open(fh, 'r') as json_file:
+        fit = json.load(json_file)
+    a = np.array(fit['a'])
+    x0 = datetime.strptime(fit['x0'], '%Y-%m-%d').date()
+    return a, x0
+
 def calc_delta_months(x0, date):
     
     if isinstance(x0, datetime):
@@ -12,7 +12,6 @@ import os
 import glob
 import warnings
 import netCDF4
-import subprocess
 import osr
 import gdal
 import csv
@@ -20,14 +19,20 @@ import matplotlib.pyplot as plt
 import numpy as np
 from shutil import copyfile
 import datetime
+import sys
+import traceback
+import contextlib
+import multiprocessing
 
 import WA_Hyperloop.becgis as becgis
+import WA_Hyperloop.pipeline as pipeline
+import WA_Hyperloop.netcdf_reader as netcdf_reader
 import WA_Hyperloop.find_possible_dates as find_possible_dates
 
 def create_csv_yearly(input_folder, output_folder, sheetnb, start_month, 
                       year_position = [-11,-7], month_position = [-6,-4], 
                       header_rows = 1, header_columns = 1, 
-                      minus_header_colums = None):
+                      minus_header_colums = None, years = None):
     """
     Calculate yearly csvs from monthly csvs for complete years (i.e. with 12
     months of data available).
@@ -48,12 +53,16 @@ def create_csv_yearly(input_folder, output_folder, sheetnb, start_month,
         The number of fixed rows at the top of the csv without any numerical data.
     header_columns : int
         The number of fixed columns at the left side of the csv without any numerical data.
+    years : list, optional
+        Only (re)create the csv-files of these water years, e.g. the years with
+        new months in an incremental run. Default is None, i.e. all years.
         
     Returns
     -------
     output_fhs : ndarray
         Array with filehandles pointing to the generated yearly csv-files.
     """
+    selected_years = years
     fhs, dates = becgis.sort_files(input_folder, year_position, month_position = month_position, extension = 'csv')[0:2]
     water_dates = np.copy(dates)
     for w in water_dates:
@@ -71,6 +80,9 @@ def create_csv_yearly(input_folder, output_folder, sheetnb, start_month,
     
     output_fhs = np.array([])
     
+    if selected_years is not None:
+        years_counts[~np.isin(years, selected_years)] = 0
+    
     data = list()
     for date in water_dates:
         if date.year in years[years_counts == 12]:
@@ -84,12 +96,13 @@ def create_csv_yearly(input_folder, output_folder, sheetnb, start_month,
                 data = list()
                 template[header_rows:,header_columns:minus_header_colums] = yearly_data.astype(np.str)
                 fh = os.path.join(output_folder, 'sheet_{1}_{0}.csv'.format(date.year,sheetnb))
-                csv_file = open(fh, 'w')
+                csv_file = open(becgis.temp_filehandle(fh), 'w')
                 writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n')
                 for row_index in range(shape[0]):
                     writer.writerow(template[row_index,:])
                 output_fhs = np.append(output_fhs, fh)
                 csv_file.close()
+                becgis.replace_file(becgis.temp_filehandle(fh), fh)
     
     return output_fhs
 
@@ -107,7 +120,7 @@ def diagnosis_wp(metadata, complete_data, output_dir, waterpix):
     
     common_dates = becgis.common_dates([complete_data['p'][1],complete_data['et'][1],complete_data['tr'][1], complete_data['etb'][1]])
     
-    becgis.assert_proj_res_ndv([complete_data['p'][0],complete_data['et'][0],complete_data['tr'][0]])
+    becgis.assert_proj_res_ndv([complete_data['p'][0],complete_data['et'][0],complete_data['tr'][0]], sample = 3)
     
     balance_km3 = np.array([])
     
@@ -127,9 +140,9 @@ def diagnosis_wp(metadata, complete_data, output_dir, waterpix):
         
         print(date)
         
-        P = complete_data['p'][0][complete_data['p'][1] == date][0]
-        ET = complete_data['et'][0][complete_data['et'][1] == date][0]
-        RO = complete_data['tr'][0][complete_data['tr'][1] == date][0]
+        P = complete_data['p'].get(date)
+        ET = complete_data['et'].get(date)
+        RO = complete_data['tr'].get(date)
         
         factor = 0.001 * 0.001 * area
         
@@ -470,6 +483,7 @@ def prepareSurfWatLoop(data, global_data):
 def sort_data_short(output_dir, metadata):
     data = ['p', 'et', 'n', 'ndm', 'lai', 'etref', 'etb', 'etg', 'i', 't', 
             'r', 'bf', 'sr', 'tr', 'perc', 'dperc', 'supply_total', 'dro']
+    becgis.set_static_cache(os.path.join(output_dir, metadata['name'], 'data', 'static'))
     complete_data = dict()
     for datatype in data:
         try:
@@ -480,7 +494,8 @@ def sort_data_short(output_dir, metadata):
                 files, dates = becgis.sort_files(folder, [-8,-4])[0:2]
             else:
                 files, dates = becgis.sort_files(folder, [-10,-6], month_position = [-6,-4])[0:2]
-            complete_data[datatype] = (files, dates)
+            complete_data[datatype] = becgis.TimeSeriesCatalog(files, dates)
+            complete_data[datatype].attach_cube(os.path.join(output_dir, metadata['name'], 'data', 'cubes', '{0}.npy'.format(datatype)))
         except:
             #traceback.print_exc()
             print(datatype)
@@ -501,7 +516,7 @@ def sort_data_short(output_dir, metadata):
             for fn in glob.glob(folder + "\\*_km3.tif"):
                 os.remove(fn) 
             files, dates = becgis.sort_files(folder, [-11,-7], month_position = [-6,-4])[0:2]
-            complete_data[data_2dict[datatype]] = (files, dates)
+            complete_data[data_2dict[datatype]] = becgis.TimeSeriesCatalog(files, dates)
         except:
             #traceback.print_exc()
             print(datatype)
@@ -509,14 +524,15 @@ def sort_data_short(output_dir, metadata):
     
     return complete_data
 
-def sort_data(data, metadata, global_data, output_dir):
+def sort_data(data, metadata, global_data, output_dir, cubes = True, jobs = 1, overwrite = True):
     output_dir = os.path.join(output_dir, metadata['name'])
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    becgis.set_static_cache(os.path.join(output_dir, 'data', 'static'))
         
     complete_data = dict()
     for key in list(data.keys()):
-        complete_data = sort_var(data, metadata, global_data, output_dir, key, complete_data)
+        complete_data = sort_var(data, metadata, global_data, output_dir, key, complete_data, cubes = cubes, jobs = jobs, overwrite = overwrite)
 
     #complete_data['fractions'] = sh5.calc_fractions(complete_data['p'][0], complete_data['p'][1], os.path.join(output_dir, 'data', 'fractions'), global_data['dem'], metadata['lu'])
 #
@@ -526,8 +542,8 @@ def sort_data(data, metadata, global_data, output_dir):
 #    complete_data['t'] = (t_files, t_dates)
     
     if np.all(['etb_folder' in list(data.keys()), 'etg_folder' in list(data.keys())]):
-        complete_data = sort_var(data, metadata, global_data, output_dir, 'etb_folder', complete_data)
-        complete_data = sort_var(data, metadata, global_data, output_dir, 'etg_folder', complete_data)
+        complete_data = sort_var(data, metadata, global_data, output_dir, 'etb_folder', complete_data, cubes = cubes, jobs = jobs, overwrite = overwrite)
+        complete_data = sort_var(data, metadata, global_data, output_dir, 'etg_folder', complete_data, cubes = cubes, jobs = jobs, overwrite = overwrite)
         
 #    else:  
 #        gb_cats, mvg_avg_len = gd.get_bluegreen_classes(version = '1.0')
@@ -541,30 +557,128 @@ def sort_data(data, metadata, global_data, output_dir):
     return complete_data
 
 
+SHARED_GLOBAL_DATA = ['population_tif', 'wpl_tif', 'environ_water_req', 'dem', 'dir']
+
+def run_basins(basins, data, global_data, output_dir, steps, processes = 1,
+               shared_keys = SHARED_GLOBAL_DATA, incremental = False):
+    """
+    Run the steps of the hyperloop for several basins, each basin in its own
+    worker process. Stages whose inputs did not change since the previous run
+    are skipped and an interrupted basin resumes with the months it had not
+    completed yet, see pipeline.run_pipeline. The global maps in shared_keys are stored once as memory
+    mapped files (see becgis.share_layers) that all workers read from. With
+    more than one process, the output of each basin is written to a log file
+    inside its output folder. A failing basin does not stop the other basins.
+
+    Parameters
+    ----------
+    basins : dict
+        Dictionary with the metadata per basin ID.
+    data : dict
+        Dictionary with the folders of the temporal data, see sort_data.
+    global_data : dict
+        Dictionary with the filehandles of the static data.
+    output_dir : str
+        Folder to store the results.
+    steps : dict
+        Dictionary with booleans for 'Reproject data', 'Create Sheet 4 and 6',
+        'Create Sheet 2', 'Create Sheet 3', 'Create Sheet 5',
+        'Create Sheet 1' and optionally 'Create Sheet 7'.
+    processes : int, optional
+        Number of basins to run at the same time, default is 1.
+    shared_keys : list, optional
+        Keys of global_data to share between the workers.
+    incremental : boolean, optional
+        Only compute the months added since the previous run, see
+        pipeline.run_pipeline. Default is False.
+
+    Returns
+    -------
+    failures : dict
+        Dictionary with the traceback per failed basin ID.
+    """
+    fihs = [global_data[key] for key in shared_keys if key in global_data]
+    shared = becgis.share_layers(fihs, os.path.join(output_dir, 'shared'))
+
+    tasks = [(ID, metadata, data, global_data, output_dir, steps, incremental, processes > 1)
+             for ID, metadata in basins.items()]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer = becgis.register_shared_layers,
+                                    initargs = (shared,), maxtasksperchild = 1)
+        try:
+            results = pool.imap_unordered(_run_basin, tasks)
+            failures = _collect_basin_results(results, len(tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        failures = _collect_basin_results((_run_basin(task) for task in tasks), len(tasks))
+
+    for ID in sorted(failures.keys()):
+        print('Basin {0} failed:\n{1}'.format(ID, failures[ID]))
+    return failures
+
+
+def _collect_basin_results(results, total):
+    failures = dict()
+    for i, (ID, name, error, log_fh) in enumerate(results):
+        status = 'failed' if error else 'done'
+        if log_fh is None:
+            print('{0}/{1} basin {2} ({3}) {4}'.format(i + 1, total, ID, name, status))
+        else:
+            print('{0}/{1} basin {2} ({3}) {4}, see {5}'.format(i + 1, total, ID, name, status, log_fh))
+        if error:
+            failures[ID] = error
+    return failures
+
+
+def _run_basin(task):
+
+    ID, metadata, data, global_data, output_dir, steps, incremental, log = task
+    basin_dir = os.path.join(output_dir, metadata['name'])
+    if not os.path.exists(basin_dir):
+        os.makedirs(basin_dir)
+    log_fh = os.path.join(basin_dir, 'hyperloop.log') if log else None
+
+    error = None
+    with _basin_output(log_fh):
+        try:
+            print('Start basin {0}: {1}'.format(ID, metadata['name']))
+            plt.close("all")
+            pipeline.run_pipeline(data, metadata, global_data, output_dir, steps, incremental = incremental)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+    return ID, metadata['name'], error, log_fh
+
+
+@contextlib.contextmanager
+def _basin_output(log_fh):
+    """
+    Redirect the output of a basin to log_fh while it runs in a pool worker,
+    the output stays in the console when log_fh is None.
+    """
+    if log_fh is None:
+        yield
+        return
+    stdout = sys.stdout
+    log = open(log_fh, 'w')
+    sys.stdout = log
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+        log.close()
+
+
 def WP_NetCDF_to_Rasters(input_nc, ras_variable, root_dir,
-                         time_var = 'time_yyyymm'):
-    
-    ds = netCDF4.Dataset(input_nc)
-    time = ds.variables[time_var][:]
-    
-    out_dir = os.path.join(root_dir, ras_variable)
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-    
-    for i, t in enumerate(time):
-        
-        i += 1
-        
-        out_fh = os.path.join(out_dir, '{0}_{1}.tif'.format(ras_variable, t))
-        in_fh = r'NETCDF:"{0}":{1}'.format(input_nc, ras_variable)
-        
-        string = 'gdal_translate -a_srs epsg:4326 -b {0} -of GTiff {1} {2}'.format(i, in_fh, out_fh)
-                  
-        proc = subprocess.Popen(string, stdout=subprocess.PIPE, 
-                                stderr=subprocess.PIPE)
-        out, err = proc.communicate()
-        
-    return out_dir
+                         time_var = 'time_yyyymm', overwrite = True):
+    """
+    Convert the time slices of a WaterPix variable to geotiffs, see
+    netcdf_reader.nc_to_rasters.
+    """
+    return netcdf_reader.nc_to_rasters(input_nc, ras_variable, root_dir,
+                                       time_var = time_var, overwrite = overwrite)
 
 
 #def sort_var(data, metadata, global_data, output_dir, key, complete_data, time_var = 'time_yyyymm'):
@@ -581,7 +695,7 @@ def WP_NetCDF_to_Rasters(input_nc, ras_variable, root_dir,
 #    complete_data[var_name] = (files, dates)
 #    return complete_data
 
-def sort_var(data, metadata, global_data, output_dir, key, complete_data, time_var = 'time_yyyymm'):
+def sort_var(data, metadata, global_data, output_dir, key, complete_data, time_var = 'time_yyyymm', cubes = False, jobs = 1, overwrite = True):
     print(key)
     
     str_template = glob.glob(os.path.join(data[key], '*.tif'))[0]
@@ -592,8 +706,19 @@ def sort_var(data, metadata, global_data, output_dir, key, complete_data, time_v
     else:
         files, dates = becgis.sort_files(data[key], year_pos)[0:2]
     var_name = key.split('_folder')[0]
-    files = becgis.match_proj_res_ndv(metadata['lu'], files, os.path.join(output_dir, 'data', var_name), dtype = 'Float32')
-    complete_data[var_name] = (files, dates)
+    # Files of a variable completed before an interruption are kept, see pipeline.checkpoint.
+    files = becgis.match_proj_res_ndv(metadata['lu'], files, os.path.join(output_dir, 'data', var_name), dtype = 'Float32',
+                                      index_dir = os.path.join(output_dir, 'data', 'reprojection'), jobs = jobs,
+                                      overwrite = overwrite and not pipeline.completed(key))
+    complete_data[var_name] = becgis.TimeSeriesCatalog(files, dates)
+    if cubes:
+        cube_fh = os.path.join(output_dir, 'data', 'cubes', '{0}.npy'.format(var_name))
+        if not (pipeline.completed(key) and os.path.exists(cube_fh)):
+            becgis.write_cube(files, dates, cube_fh)
+        complete_data[var_name].attach_cube(cube_fh)
+        pipeline.checkpoint(key, list(files) + [cube_fh])
+    else:
+        pipeline.checkpoint(key, files)
     return complete_data
 
 
@@ -643,99 +768,34 @@ def NetCDF_to_Raster(input_nc, output_tiff, ras_variable,
                      crs={'variable': 'crs', 'wkt': 'crs_wkt'}, time=None):
     # Input
     inp_nc = netCDF4.Dataset(input_nc, 'r')
-    inp_values = inp_nc.variables[ras_variable]
-    x_index = inp_values.dimensions.index(x_variable)
-    y_index = inp_values.dimensions.index(y_variable)
 
     if not time:
-        inp_array = inp_values[:]
+        inp_array = netcdf_reader.read_array(inp_nc, ras_variable, x_variable = x_variable, y_variable = y_variable)
     else:
-        time_variable = time['variable']
-        time_value = time['value']
-        t_index = inp_values.dimensions.index(time_variable)
-        time_index = list(inp_nc.variables[time_variable][:]).index(time_value)
-        if t_index == 0:
-            inp_array = inp_values[time_index, :, :]
-        elif t_index == 1:
-            inp_array = inp_values[:, time_index, :]
-        elif t_index == 2:
-            inp_array = inp_values[:, :, time_index]
-        else:
-            raise Exception("The array has more dimensions than expected")
-
-    # Transpose array if necessary
-    if y_index > x_index:
-        inp_array = np.transpose(inp_array)
-
-    # Additional parameters
-    gdal_datatype = gdaltype_from_dtype(inp_array.dtype)
-    #NoData_value = 9.96920996839e+36 # inp_nc.variables[ras_variable]._FillValue
+        time_index = list(inp_nc.variables[time['variable']][:]).index(time['value'])
+        inp_array = netcdf_reader.read_array(inp_nc, ras_variable, x_variable = x_variable, y_variable = y_variable,
+                                             time_var = time['variable'], indices = [time_index])[0]
 
     if type(crs) == str:
         srs_wkt = crs
     else:
-        crs_variable = crs['variable']
-        crs_wkt = crs['wkt']
-        exec('srs_wkt = str(inp_nc.variables["{0}"].{1})'.format(crs_variable,
-                                                                 crs_wkt))
-
-    inp_x = inp_nc.variables[x_variable]
-    inp_y = inp_nc.variables[y_variable]
+        srs_wkt = str(getattr(inp_nc.variables[crs['variable']], crs['wkt']))
+    projection = osr.SpatialReference()
+    projection.ImportFromWkt(srs_wkt)
 
-    cellsize_x = abs(np.mean([inp_x[i] - inp_x[i-1]
-                                 for i in range(1, len(inp_x))]))
-    cellsize_y = -abs(np.mean([inp_y[i] - inp_y[i-1]
-                                  for i in range(1, len(inp_y))]))
+    geot = netcdf_reader.geotransform(inp_nc, x_variable = x_variable, y_variable = y_variable)
+    inp_nc.close()
 
     # Output
-    out_driver = gdal.GetDriverByName('GTiff')
-    
-    if os.path.exists(output_tiff):
-        out_driver.Delete(output_tiff)
-
     y_ncells, x_ncells = inp_array.shape
-
-    out_source = out_driver.Create(output_tiff, x_ncells, y_ncells,
-                                   1, gdal_datatype)
-    out_band = out_source.GetRasterBand(1)
-    #out_band.SetNoDataValue(pd.np.asscalar(NoData_value))
-
-    out_top_left_x = inp_x[0] - cellsize_x/2.0
-    if inp_y[-1] > inp_y[0]:
-        out_top_left_y = inp_y[-1] - cellsize_y/2.0
-        inp_array = np.flipud(inp_array)
-    else:
-        out_top_left_y = inp_y[0] - cellsize_y/2.0
-
-    out_source.SetGeoTransform((out_top_left_x, cellsize_x, 0,
-                                out_top_left_y, 0, cellsize_y))
-    out_source.SetProjection(srs_wkt)
-    out_band.WriteArray(inp_array)
-    out_band.ComputeStatistics(True)
-
-    # Save and/or close the data sources
-    inp_nc.close()
-    out_source = None
+    becgis.create_geotiff(output_tiff, inp_array, gdal.GetDriverByName('GTiff'), -9999,
+                          x_ncells, y_ncells, geot, projection)
 
     # Return
     return output_tiff
 
 def SortWaterPix(nc, variable, output_folder, time_var = 'time_yyyymm'):
-    spa_ref = Spatial_Reference(4326)
-    nc1 = netCDF4.Dataset(nc)
-    time = nc1.variables[time_var][:]
-    for time_value in time:
-        output_dir = os.path.join(output_folder, variable)
-        output_tif = os.path.join(output_dir, "{0}_{1}.tif".format(variable, time_value))
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        NetCDF_to_Raster(input_nc=nc,
-                                output_tiff=output_tif,
-                                ras_variable=variable,
-                                x_variable='longitude', y_variable='latitude',
-                                crs=spa_ref,
-                                time={'variable': time_var, 'value': time_value})
-    return output_dir
+    return netcdf_reader.nc_to_rasters(nc, variable, output_folder, time_var = time_var)
 
 #def calc_missing_runoff_fractions(metadata):
 #    
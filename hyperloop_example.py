@@ -10,6 +10,7 @@ from WA_Hyperloop.sheet3_functions import sheet3_functions as sh3
 from WA_Hyperloop.sheet4_functions import sheet4_functions as sh4
 from WA_Hyperloop.sheet5_functions import sheet5_functions as sh5
 from WA_Hyperloop import hyperloop as hl
+from WA_Hyperloop import becgis
 import matplotlib.pyplot as plt
 
 ###
@@ -53,6 +54,7 @@ basins[ID] = {
             'lu_based_supply_split':    False, #Value is True if an initial split in SW/GW supply is done based on landuse class and values in get_dictionnaries
             'grace_supply_split':       True, #Value is True if GW/SW split is adjusted. Can be true weather or not initial split based on landuse is done. If both of these are False, all supply will be SWsupply
             'grace_split_alpha_bounds': ([0.0, 0.5, 1.], [1., 1., 12.]), # lower and upper bounds of trigonometric function parameters for splitting suply into sw and gw as ([alpha_l, beta_l, theta_l],[alpha_u, beta_u, theta_u]). ([0., 0., 1.], [1.0, 1.0, 12.]) are the widest bounds allowed. alpha controls the mean, beta the amplitude and theta the phase.
+            'grace_refit':              'new_year', # When to fit the GRACE split again in an incremental run: 'always', 'new_year' (when a water year is completed) or 'never' (reuse the stored fit).
             'water_year_start_month':   10, #Start month of water year. Used to compute the yearly sheets.
             'ndm_max_original':         False, # True will use original method to determine NDM_max (based on entire domain), false will use a different method dependent on nearby pixels of the same lu-category.
             }
@@ -79,7 +81,7 @@ global_data["waterpix"]                 = r"D:\Products\Waterpix\SEAsia\output_2
 ###
 #waterpix        = r"K:\Products\WATERPIX\out_SEAsia_0point075.nc"
 #waterpix_in     = r"K:\Products\WATERPIX\in_SEAsia_0point075.nc"
-#data = dict()
+data = dict()
 #data["ndm_folder"]          = r"K:\Products\MODIS_17_NDM"
 #data["p_folder"]            = hl.WP_NetCDF_to_Rasters(waterpix_in, 'Precipitation_M', r"K:\Products\WATERPIX\Output")
 #data["et_folder"]           = hl.WP_NetCDF_to_Rasters(waterpix_in, 'Evapotranspiration_M', r"K:\Products\WATERPIX\Output")
@@ -96,6 +98,8 @@ global_data["waterpix"]                 = r"D:\Products\Waterpix\SEAsia\output_2
 #data["etb_folder"]          = hl.WP_NetCDF_to_Rasters(waterpix, 'ETblue_M', r"K:\Products\WATERPIX\Output")
 #data["etg_folder"]          = hl.WP_NetCDF_to_Rasters(waterpix, 'ETgreen_M', r"K:\Products\WATERPIX\Output")
 
+# Steps switched on are only recomputed when their inputs changed since the
+# previous run (see pipeline.run_pipeline).
 steps = dict()
 steps['Reproject data']                  = False
 steps['Create Sheet 4 and 6']            = True
@@ -103,32 +107,27 @@ steps['Create Sheet 2']                  = False
 steps['Create Sheet 3']                  = False
 steps['Create Sheet 5']                  = False
 steps['Create Sheet 1']                  = False
+steps['Create Sheet 7']                  = False
+
+# Keep static maps (landuse, subbasin masks) in memory between reads, set to 0 to disable.
+becgis.set_read_cache(max_megabytes = 2048)
+
+# Number of months calculated at the same time inside the sheets, only used
+# when the basins run one at a time.
+becgis.set_month_processes(processes = 1)
 
 #%%
 ###
 # Start hyperloop
 ###
-for ID, metadata in basins.items():
-    
-    print 'Start basin {0}: {1}'.format(ID, metadata['name'])
-    plt.close("all")
-    
-    if steps['Reproject data']:
-        complete_data = hl.sort_data(data, metadata, global_data, output_dir)
-    else:
-        complete_data = hl.sort_data_short(output_dir, metadata)
-
-    if steps['Create Sheet 4 and 6']:
-        complete_data = sh4.create_sheet4_6(complete_data, metadata, output_dir, global_data)
-
-    if steps['Create Sheet 2']:
-        complete_data = sh2.create_sheet2(complete_data, metadata, output_dir)
-
-    if steps['Create Sheet 3']:
-        complete_data = sh3.create_sheet3(complete_data, metadata, output_dir)
+# Number of basins to run at the same time, each basin runs in its own process
+# and writes its output to <output_dir>/<basin name>/hyperloop.log.
+processes = 1
 
-    if steps['Create Sheet 5']:
-        complete_data = sh5.create_sheet5(complete_data, metadata, output_dir, global_data)
+# Only calculate the months added since the previous run, the sheets and
+# yearly totals of earlier months are kept.
+incremental = False
 
-    if steps['Create Sheet 1']:
-        complete_data, all_sh1_results = sh1.create_sheet1(complete_data, metadata, output_dir, global_data)
\ No newline at end of file
+if __name__ == '__main__':
+    failures = hl.run_basins(basins, data, global_data, output_dir, steps, processes = processes,
+                             incremental = incremental)
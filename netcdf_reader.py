@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Read (WaterPix) NetCDF files directly with netCDF4 and convert them to
+geotiffs. A file is opened once and the time slices are read in chunks, the
+geotransform is derived from the coordinate variables.
+"""
+from __future__ import print_function
+from builtins import range
+import os
+import netCDF4
+import numpy as np
+from osgeo import gdal, osr
+
+import WA_Hyperloop.becgis as becgis
+
+
+def geotransform(dataset, x_variable='longitude', y_variable='latitude'):
+    """
+    Calculate the geotransform of a NetCDF file from its coordinate variables,
+    which contain the centers of the pixels.
+
+    Parameters
+    ----------
+    dataset : object
+        Opened netCDF4.Dataset.
+    x_variable : str, optional
+        Name of the x coordinate variable, default is 'longitude'.
+    y_variable : str, optional
+        Name of the y coordinate variable, default is 'latitude'.
+
+    Returns
+    -------
+    geot : tuple
+        Geotransform of the maps after orienting them with read_array, i.e.
+        with the northern row first.
+    """
+    x = np.asarray(dataset.variables[x_variable][:], dtype=np.float64)
+    y = np.asarray(dataset.variables[y_variable][:], dtype=np.float64)
+    cellsize_x = abs(np.mean(np.diff(x)))
+    cellsize_y = -abs(np.mean(np.diff(y)))
+    return (x[0] - cellsize_x / 2.0, cellsize_x, 0,
+            np.max(y[[0, -1]]) - cellsize_y / 2.0, 0, cellsize_y)
+
+
+def read_array(dataset, ras_variable, x_variable='longitude', y_variable='latitude',
+               time_var=None, indices=None):
+    """
+    Read a variable from a NetCDF file as float32 with the (y, x) axes in the
+    order of a geotiff, i.e. the northern row first. Masked (fill) values are
+    set to NaN, scale factors and offsets are applied by netCDF4.
+
+    Parameters
+    ----------
+    dataset : object
+        Opened netCDF4.Dataset.
+    ras_variable : str
+        Name of the variable to read.
+    x_variable : str, optional
+        Name of the x dimension, default is 'longitude'.
+    y_variable : str, optional
+        Name of the y dimension, default is 'latitude'.
+    time_var : str, optional
+        Name of the time dimension, None for a variable without time
+        dimension. Default is None.
+    indices : list, optional
+        Indices along the time dimension to read, default is None (all).
+
+    Returns
+    -------
+    array : ndarray
+        Array with shape (y, x), or (time, y, x) when time_var is given.
+    """
+    variable = dataset.variables[ras_variable]
+    dimensions = list(variable.dimensions)
+
+    selection = [slice(None)] * len(dimensions)
+    if time_var is not None and indices is not None:
+        indices = list(indices)
+        if indices == list(range(indices[0], indices[-1] + 1)):
+            selection[dimensions.index(time_var)] = slice(indices[0], indices[-1] + 1)
+        else:
+            selection[dimensions.index(time_var)] = indices
+    data = variable[tuple(selection)]
+    data = np.ma.filled(np.ma.asarray(data).astype(np.float32), np.nan)
+
+    order = [dimensions.index(y_variable), dimensions.index(x_variable)]
+    if time_var is not None:
+        order.insert(0, dimensions.index(time_var))
+    array = np.transpose(data, order)
+
+    y = dataset.variables[y_variable][:]
+    if y[-1] > y[0]:
+        array = array[..., ::-1, :]
+    return np.ascontiguousarray(array)
+
+
+def read_chunks(dataset, ras_variable, time_var='time_yyyymm', indices=None, chunk_size=12,
+                x_variable='longitude', y_variable='latitude'):
+    """
+    Read the time slices of a variable in chunks, see read_array.
+
+    Parameters
+    ----------
+    dataset : object
+        Opened netCDF4.Dataset.
+    ras_variable : str
+        Name of the variable to read.
+    time_var : str, optional
+        Name of the time dimension, default is 'time_yyyymm'.
+    indices : list, optional
+        Indices along the time dimension to read, default is None (all).
+    chunk_size : int, optional
+        Number of time slices to read at once, default is 12.
+
+    Yields
+    ------
+    indices : list
+        Indices along the time dimension of the chunk.
+    array : ndarray
+        Array with shape (len(indices), y, x).
+    """
+    if indices is None:
+        indices = list(range(len(dataset.variables[time_var])))
+    for start in range(0, len(indices), chunk_size):
+        chunk = indices[start:start + chunk_size]
+        yield chunk, read_array(dataset, ras_variable, x_variable=x_variable, y_variable=y_variable,
+                                time_var=time_var, indices=chunk)
+
+
+def nc_to_rasters(input_nc, ras_variables, root_dir, time_var='time_yyyymm',
+                  x_variable='longitude', y_variable='latitude', epsg=4326,
+                  chunk_size=12, overwrite=True):
+    """
+    Convert the time slices of one or more variables in a NetCDF file to
+    geotiffs named '<variable>_<time>.tif' in root_dir/<variable>.
+
+    Parameters
+    ----------
+    input_nc : str
+        Filehandle pointing to the NetCDF file.
+    ras_variables : str or list
+        Name(s) of the variables to convert.
+    root_dir : str
+        Folder in which a subfolder per variable is created.
+    time_var : str, optional
+        Name of the time variable, its values are used in the filenames.
+        Default is 'time_yyyymm'.
+    x_variable : str, optional
+        Name of the x coordinate variable, default is 'longitude'.
+    y_variable : str, optional
+        Name of the y coordinate variable, default is 'latitude'.
+    epsg : int, optional
+        EPSG code of the coordinate system, default is 4326.
+    chunk_size : int, optional
+        Number of time slices to read at once, default is 12.
+    overwrite : boolean, optional
+        Convert time slices whose geotiff already exists, default is True.
+        Set to False to only convert new time slices.
+
+    Returns
+    -------
+    out_dirs : str or list
+        Folder(s) with the geotiffs, a str when ras_variables is a str.
+    """
+    variables = [ras_variables] if isinstance(ras_variables, str) else list(ras_variables)
+
+    projection = osr.SpatialReference()
+    projection.ImportFromEPSG(epsg)
+    driver = gdal.GetDriverByName('GTiff')
+
+    dataset = netCDF4.Dataset(input_nc, 'r')
+    try:
+        times = np.asarray(dataset.variables[time_var][:]).tolist()
+        geot = geotransform(dataset, x_variable=x_variable, y_variable=y_variable)
+        xsize = len(dataset.dimensions[x_variable])
+        ysize = len(dataset.dimensions[y_variable])
+
+        out_dirs = list()
+        for ras_variable in variables:
+            out_dir = os.path.join(root_dir, ras_variable)
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+            out_dirs.append(out_dir)
+
+            out_fhs = [os.path.join(out_dir, '{0}_{1}.tif'.format(ras_variable, t)) for t in times]
+            indices = [i for i, out_fh in enumerate(out_fhs) if overwrite or not os.path.exists(out_fh)]
+
+            for chunk, array in read_chunks(dataset, ras_variable, time_var=time_var, indices=indices,
+                                            chunk_size=chunk_size, x_variable=x_variable, y_variable=y_variable):
+                for i, data in zip(chunk, array):
+                    becgis.create_geotiff(out_fhs[i], data, driver, -9999, xsize, ysize, geot, projection)
+            print("Converted {0} of {1} time slices of {2}".format(len(indices), len(times), ras_variable))
+    finally:
+        dataset.close()
+
+    if isinstance(ras_variables, str):
+        return out_dirs[0]
+    return out_dirs
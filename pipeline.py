@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+"""
+Run the hyperloop for a basin as a graph of stages. Each stage declares the
+variables of complete_data it requires and produces, the folders (relative to
+the basin folder) it writes and reads, and the metadata and global_data it
+depends on (None means all metadata). The contents of all inputs are hashed
+and stored in <output_dir>/<basin>/pipeline.json, so that a rerun only
+recomputes the stages whose inputs changed. In incremental mode a stage whose
+parameters did not change only computes the new (or changed) months.
+
+While a stage runs, the months (or other items) it completes are recorded
+in pipeline.json together with the checksums of their outputs (see
+checkpoint). When a run is interrupted, the next run with the same inputs
+verifies these outputs and only computes the remaining months.
+"""
+from __future__ import print_function
+from builtins import str
+import os
+import re
+import json
+import hashlib
+import datetime
+import collections
+import numpy as np
+
+import WA_Hyperloop.becgis as becgis
+
+_CHECKPOINT = {'state_fh': None, 'state': None, 'stage': None, 'done': set()}
+
+STAGES = collections.OrderedDict()
+STAGES['sort_data'] = {'step': 'Reproject data',
+                       'requires': [],
+                       'produces': [],
+                       'writes': [],
+                       'folders': [],
+                       'metadata': ['lu', 'name'],
+                       'global_data': []}
+STAGES['sheet4_6'] = {'step': 'Create Sheet 4 and 6',
+                      'requires': ['perc', 'dperc', 'etb', 'lai', 'etref', 'p', 'bf', 'supply_total', 'dro', 'et', 'tr'],
+                      'produces': ['recharge', 'supply_swa', 'supply_sw', 'supply_gw', 'return_flow_sw_sw',
+                                   'return_flow_sw_gw', 'return_flow_gw_sw', 'return_flow_gw_gw'],
+                      'writes': [],
+                      'folders': [],
+                      'metadata': ['GRACE', 'grace_refit', 'grace_split_alpha_bounds', 'grace_supply_split',
+                                   'lu', 'lu_based_supply_split', 'name', 'water_year_start_month'],
+                      'global_data': ['equiped_sw_irrigation', 'wpl_tif', 'population_tif']}
+STAGES['sheet2'] = {'step': 'Create Sheet 2',
+                    'requires': ['et', 'lai', 'p', 'n', 'ndm'],
+                    'produces': ['i', 't'],
+                    'writes': [],
+                    'folders': [],
+                    'metadata': ['lu', 'name', 'ndm_max_original', 'water_year_start_month'],
+                    'global_data': []}
+STAGES['sheet3'] = {'step': 'Create Sheet 3',
+                    'requires': ['etb', 'etg', 'ndm', 'p'],
+                    'produces': [],
+                    'writes': [],
+                    'folders': [],
+                    'metadata': ['crops', 'lu', 'name', 'non_crop'],
+                    'global_data': []}
+STAGES['sheet5'] = {'step': 'Create Sheet 5',
+                    'requires': ['bf', 'p', 'return_flow_gw_sw', 'return_flow_sw_sw', 'sr', 'supply_sw', 'tr'],
+                    'produces': ['fractions'],
+                    'writes': [os.path.join('sheet5', 'sheet5_monthly')],
+                    'folders': [],
+                    'metadata': ['OutletPoints', 'SWfile', 'dico_in', 'dico_out', 'discharge_out_from_wp',
+                                 'fraction_xs', 'lu', 'masks', 'name', 'surfwat', 'water_year_start_month'],
+                    'global_data': ['dem', 'wpl_tif', 'environ_water_req']}
+STAGES['sheet1'] = {'step': 'Create Sheet 1',
+                    'requires': ['etb', 'etg', 'fractions', 'p', 'tr'],
+                    'produces': [],
+                    'writes': [],
+                    'folders': [os.path.join('sheet5', 'sheet5_monthly')],
+                    'metadata': ['lu', 'name', 'recycling_ratio', 'water_year_start_month'],
+                    'global_data': ['wpl_tif', 'environ_water_req']}
+STAGES['sheet7'] = {'step': 'Create Sheet 7',
+                    'requires': ['bf', 'etb', 'etg', 'ndm', 'p', 'recharge', 'rzsm', 'tr'],
+                    'produces': [],
+                    'writes': [],
+                    'folders': [],
+                    'metadata': ['lu', 'name', 'recycling_ratio', 'water_year_start_month'],
+                    'global_data': ['population_tif', 'cattle', 'root_depth']}
+
+def stage_order(stages=STAGES):
+    """
+    Sort the stages so that every stage comes after the stages producing its
+    inputs. The order of STAGES is kept where possible.
+
+    Parameters
+    ----------
+    stages : dict, optional
+        Dictionary with the stage definitions, default is STAGES.
+
+    Returns
+    -------
+    order : list
+        Names of the stages.
+    """
+    upstream = dict()
+    for name, stage in stages.items():
+        upstream[name] = set(['sort_data']) if name != 'sort_data' and 'sort_data' in stages else set()
+        for other, other_stage in stages.items():
+            if other == name:
+                continue
+            produced = set(other_stage['produces'])
+            written = set(other_stage['writes'])
+            if produced & set(stage['requires']) or written & set(stage['folders']):
+                upstream[name].add(other)
+
+    order = list()
+    while len(order) < len(stages):
+        ready = [name for name in stages if name not in order and upstream[name] <= set(order)]
+        assert len(ready) > 0, "stages contain a cycle"
+        order.append(ready[0])
+    return order
+
+
+def run_pipeline(data, metadata, global_data, output_dir, steps, force=False, incremental=False):
+    """
+    Run the stages of the hyperloop for one basin. Stages that are switched on
+    in steps are only recomputed when the contents of their inputs or their
+    parameters changed since the previous run, otherwise their outputs are
+    loaded from pipeline.json. File contents are hashed once and the hashes
+    are reused as long as the size and modification time of a file stay the
+    same.
+
+    Parameters
+    ----------
+    data : dict
+        Dictionary with the folders of the temporal data, see sort_data.
+    metadata : dict
+        Dictionary with the metadata of the basin.
+    global_data : dict
+        Dictionary with the filehandles of the static data.
+    output_dir : str
+        Folder to store the results.
+    steps : dict
+        Dictionary with a boolean per step, e.g. {'Create Sheet 2': True}, see
+        the 'step' of each stage in STAGES.
+    force : boolean, optional
+        Recompute all switched on stages, default is False.
+    incremental : boolean, optional
+        Only compute the months that were added or changed since the previous
+        run of a stage, the monthly outputs of the other months are kept and
+        only the affected yearly aggregates are updated. Falls back to a full
+        run when parameters changed or months were removed. Default is False.
+
+    Returns
+    -------
+    complete_data : dict
+        Dictionary with the time series of all variables.
+    """
+    from WA_Hyperloop import hyperloop as hl
+
+    basin_dir = os.path.join(output_dir, metadata['name'])
+    if not os.path.exists(basin_dir):
+        os.makedirs(basin_dir)
+    state_fh = os.path.join(basin_dir, 'pipeline.json')
+    state = load_state(state_fh)
+
+    complete_data = dict()
+    for name in stage_order():
+        stage = STAGES[name]
+        record = state['stages'].get(name)
+        enabled = steps.get(stage['step'], False)
+        if enabled:
+            key, parameters, months = stage_key(name, complete_data, data, metadata, global_data, basin_dir, state)
+            current = record is not None and record['key'] == key and _outputs_valid(record, state)
+            dates = None
+            if incremental and not force and not current and record is not None and \
+                    record.get('parameters') == parameters and _outputs_valid(record, state):
+                dates = new_months(record['months'], months)
+
+        if enabled and (force or not current):
+            if dates is None:
+                print('{0}: running'.format(name))
+            else:
+                print('{0}: running for {1} new month(s)'.format(name, len(dates)))
+            before = dict(complete_data)
+            begin_stage(state_fh, state, name, key, reset=force)
+            try:
+                complete_data = _run_stage(name, complete_data, data, metadata, global_data, output_dir, dates=dates)
+            finally:
+                _CHECKPOINT.update(state_fh=None, state=None, stage=None, done=set())
+            produced = [var for var in complete_data if complete_data[var] is not before.get(var)]
+            outputs = catalogs_to_json(complete_data, produced)
+            # Besides the catalogs, the files recorded with checkpoint (e.g. the
+            # csv and pdf files of the sheets) are verified by the next run.
+            written = set(fh for fhs, _ in outputs.values() for fh in fhs)
+            written.update(fh for checksums in state['checkpoints'][name]['items'].values() for fh in checksums)
+            if dates is not None:
+                written.update(record.get('checksums', dict()).keys())
+            state['stages'][name] = {'key': key,
+                                     'parameters': parameters,
+                                     'months': months,
+                                     'outputs': outputs,
+                                     'checksums': dict((fh, file_hash(fh, state)) for fh in sorted(written) if os.path.exists(fh))}
+            state['checkpoints'].pop(name, None)
+            save_state(state_fh, state)
+        elif record is not None:
+            print('{0}: {1}, using previous results'.format(name, 'unchanged' if enabled else 'switched off'))
+            complete_data.update(catalogs_from_json(record['outputs'], basin_dir))
+        elif name == 'sort_data':
+            complete_data = hl.sort_data_short(output_dir, metadata)
+
+    return complete_data
+
+
+def _run_stage(name, complete_data, data, metadata, global_data, output_dir, dates=None):
+    from WA_Hyperloop import hyperloop as hl
+    if name == 'sort_data':
+        complete_data.update(hl.sort_data(data, metadata, global_data, output_dir, overwrite=dates is None))
+    elif name == 'sheet4_6':
+        from WA_Hyperloop.sheet4_functions import sheet4_functions as sh4
+        complete_data = sh4.create_sheet4_6(complete_data, metadata, output_dir, global_data, dates=dates)
+    elif name == 'sheet2':
+        from WA_Hyperloop.sheet2_functions import sheet2_functions as sh2
+        complete_data = sh2.create_sheet2(complete_data, metadata, output_dir, dates=dates)
+    elif name == 'sheet3':
+        from WA_Hyperloop.sheet3_functions import sheet3_functions as sh3
+        complete_data = sh3.create_sheet3(complete_data, metadata, output_dir, dates=dates)
+    elif name == 'sheet5':
+        from WA_Hyperloop.sheet5_functions import sheet5_functions as sh5
+        complete_data = sh5.create_sheet5(complete_data, metadata, output_dir, global_data, dates=dates)
+    elif name == 'sheet1':
+        from WA_Hyperloop.sheet1_functions import sheet1_functions as sh1
+        complete_data = sh1.create_sheet1(complete_data, metadata, output_dir, global_data, dates=dates)[0]
+    elif name == 'sheet7':
+        from WA_Hyperloop.sheet7_functions import sheet7_functions as sh7
+        sh7.create_sheet7(complete_data, metadata, output_dir, global_data, data, dates=dates)
+    return complete_data
+
+
+def stage_key(name, complete_data, data, metadata, global_data, basin_dir, state):
+    """
+    Calculate the hash of everything a stage depends on.
+
+    Returns
+    -------
+    key : str
+        Hash of the parameters and inputs of the stage.
+    parameters : str
+        Hash of the parameters of the stage only.
+    months : dict
+        Hash of the inputs per month, with the dates as 'yyyy-mm-dd'. The
+        files inside the folders of the stage are included by filehandle.
+    """
+    stage = STAGES[name]
+    md5 = hashlib.md5()
+
+    keys = sorted(metadata.keys()) if stage['metadata'] is None else stage['metadata']
+    parameters = [(k, metadata.get(k)) for k in keys]
+    parameters += [(k, global_data.get(k)) for k in stage['global_data']]
+    parameters = value_hash(parameters, state)
+    md5.update(parameters.encode('utf-8'))
+
+    folders = [os.path.join(basin_dir, folder) for folder in stage['folders']]
+    if name == 'sort_data':
+        folders += [data[k] for k in sorted(data.keys())]
+
+    months = dict()
+    for folder in folders:
+        if not os.path.isdir(folder):
+            md5.update('{0}: missing'.format(folder).encode('utf-8'))
+            continue
+        for fn in sorted(os.listdir(folder)):
+            fh = os.path.join(folder, fn)
+            if os.path.isfile(fh) and not fn.startswith('.'):
+                months[fh] = file_hash(fh, state)
+    for var in stage['requires']:
+        if var not in complete_data:
+            md5.update('{0}: missing'.format(var).encode('utf-8'))
+            continue
+        fhs, dates = complete_data[var][0], complete_data[var][1]
+        for fh, date in zip(fhs, dates):
+            month = '{0:04d}-{1:02d}-{2:02d}'.format(date.year, date.month, date.day)
+            months[month] = months.get(month, '') + var + file_hash(fh, state)
+    months = dict((month, hashlib.md5(value.encode('utf-8')).hexdigest()) for month, value in months.items())
+    md5.update(json.dumps(months, sort_keys=True).encode('utf-8'))
+    return md5.hexdigest(), parameters, months
+
+
+def new_months(previous, months):
+    """
+    Find the months whose inputs were added or changed since the previous run.
+
+    Parameters
+    ----------
+    previous : dict
+        Hashes per month (or file) of the previous run, see stage_key.
+    months : dict
+        Hashes per month (or file) of the current run.
+
+    Returns
+    -------
+    dates : list or None
+        Sorted datetime.date objects of the new months. None when months were
+        removed, a file that is not linked to a month changed or a new file
+        has no date in its name, i.e. when the stage has to run for the
+        complete record.
+    """
+    if any(month not in months for month in previous):
+        return None
+    dates = set()
+    for month, value in months.items():
+        if previous.get(month) == value:
+            continue
+        try:
+            dates.add(datetime.datetime.strptime(month, '%Y-%m-%d').date())
+        except ValueError:
+            date = None if month in previous else _file_month(month)
+            if date is None:
+                return None
+            dates.add(date)
+    return sorted(dates)
+
+
+def _file_month(fh):
+    """
+    Get the month in the name of a file, e.g. 'P_monthly_2003.01.01.tif' or
+    'sheet5_2003_01.csv'. Returns None when the name contains no yyyymm or
+    yyyy{char}mm.
+    """
+    found = re.findall(r'((?:19|20)\d{2})[._-]?(0[1-9]|1[0-2])(?!\d)', os.path.basename(fh))
+    if not found:
+        return None
+    return datetime.date(int(found[-1][0]), int(found[-1][1]), 1)
+
+
+def file_hash(fh, state):
+    """
+    Get the md5 hash of the contents of a file, remembered in state as long as
+    the size and modification time of the file stay the same.
+    """
+    fh = os.path.abspath(fh)
+    stat = os.stat(fh)
+    known = state['files'].get(fh)
+    if known is None or known[0] != stat.st_size or known[1] != stat.st_mtime:
+        known = [stat.st_size, stat.st_mtime, becgis.content_hash(fh)]
+        state['files'][fh] = known
+    return known[2]
+
+
+def value_hash(value, state):
+    """
+    Hash a (nested) parameter value. Strings pointing to existing files or
+    folders are replaced by the hash of their contents.
+    """
+    if isinstance(value, dict):
+        value = [(str(k), value_hash(value[k], state)) for k in sorted(value.keys(), key=str)]
+    elif isinstance(value, (list, tuple)):
+        value = [value_hash(v, state) for v in value]
+    elif isinstance(value, str) and os.path.isfile(value):
+        value = file_hash(value, state)
+    elif isinstance(value, str) and os.path.isdir(value):
+        value = [(fn, file_hash(os.path.join(value, fn), state)) for fn in sorted(os.listdir(value))
+                 if os.path.isfile(os.path.join(value, fn)) and not fn.startswith('.')]
+    return hashlib.md5(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def catalogs_to_json(complete_data, variables):
+    """
+    Convert the time series in complete_data to a json serializable dict.
+    """
+    catalogs = dict()
+    for var in variables:
+        entry = complete_data[var]
+        if isinstance(entry, tuple) and len(entry) == 2:
+            catalogs[var] = [[str(fh) for fh in entry[0]], [date.toordinal() for date in entry[1]]]
+    return catalogs
+
+
+def catalogs_from_json(catalogs, basin_dir):
+    """
+    Create the time series stored with catalogs_to_json, cubes written by
+    sort_data are attached when available.
+    """
+    complete_data = dict()
+    for var, (fhs, ordinals) in catalogs.items():
+        dates = [datetime.date.fromordinal(ordinal) for ordinal in ordinals]
+        complete_data[var] = becgis.TimeSeriesCatalog(fhs, dates)
+        complete_data[var].attach_cube(os.path.join(basin_dir, 'data', 'cubes', '{0}.npy'.format(var)))
+    return complete_data
+
+
+def _outputs_valid(record, state):
+    checksums = record.get('checksums', dict())
+    fhs = set(fh for fhs, _ in record['outputs'].values() for fh in fhs) | set(checksums.keys())
+    for fh in fhs:
+        if not os.path.exists(fh) or (fh in checksums and file_hash(fh, state) != checksums[fh]):
+            return False
+    return True
+
+
+def begin_stage(state_fh, state, name, key, reset=False):
+    """
+    Start recording the completed items of a stage. Items recorded by an
+    earlier, interrupted, run of the stage with the same key are kept when
+    their outputs still exist and have the recorded checksums.
+
+    Parameters
+    ----------
+    state_fh : str
+        Filehandle of pipeline.json.
+    state : dict
+        Contents of pipeline.json, see load_state.
+    name : str
+        Name of the stage.
+    key : str
+        Hash of the inputs of the stage, see stage_key.
+    reset : boolean, optional
+        Forget the items of an earlier run, default is False.
+
+    Returns
+    -------
+    done : list
+        Items that do not need to be computed again.
+    """
+    checkpoints = state.setdefault('checkpoints', dict())
+    record = checkpoints.get(name)
+    if reset or record is None or record['key'] != key:
+        record = {'key': key, 'items': dict()}
+    for item, checksums in list(record['items'].items()):
+        if not all(os.path.exists(fh) and file_hash(fh, state) == checksum for fh, checksum in checksums.items()):
+            del record['items'][item]
+    checkpoints[name] = record
+    save_state(state_fh, state)
+    _CHECKPOINT.update(state_fh=state_fh, state=state, stage=name, done=set(record['items'].keys()))
+    if record['items']:
+        print('{0}: resuming, {1} item(s) completed before'.format(name, len(record['items'])))
+    return sorted(record['items'].keys())
+
+
+def checkpoint(item, fhs):
+    """
+    Record that an item (e.g. a month) of the running stage is completed,
+    together with the checksums of its outputs. Does nothing when no stage
+    is running, e.g. when the sheets are created outside run_pipeline.
+
+    Parameters
+    ----------
+    item : object or str
+        Datetime.date object of a month or a str identifying the item.
+    fhs : list
+        Filehandles of the outputs of the item, written completely.
+    """
+    if _CHECKPOINT['stage'] is None:
+        return
+    state = _CHECKPOINT['state']
+    fhs = [os.path.abspath(str(fh)) for fh in fhs]
+    state['checkpoints'][_CHECKPOINT['stage']]['items'][_item_key(item)] = \
+        dict((fh, file_hash(fh, state)) for fh in fhs)
+    _CHECKPOINT['done'].add(_item_key(item))
+    save_state(_CHECKPOINT['state_fh'], state)
+
+
+def reset_checkpoints():
+    """
+    Forget the completed items of the running stage, e.g. when the stage finds
+    out while running that the outputs of all months have to be recomputed.
+    Does nothing when no stage is running.
+    """
+    if _CHECKPOINT['stage'] is None:
+        return
+    state = _CHECKPOINT['state']
+    state['checkpoints'][_CHECKPOINT['stage']]['items'] = dict()
+    _CHECKPOINT['done'] = set()
+    save_state(_CHECKPOINT['state_fh'], state)
+
+
+def completed(item):
+    """
+    Check if an item of the running stage was completed by an earlier,
+    interrupted, run, see checkpoint.
+    """
+    return _CHECKPOINT['stage'] is not None and _item_key(item) in _CHECKPOINT['done']
+
+
+def pending_months(dates, selection=None):
+    """
+    Check which dates still need to be computed, i.e. the dates in selection
+    (see becgis.in_selection) that are not completed.
+
+    Parameters
+    ----------
+    dates : list
+        Contains datetime.date objects.
+    selection : list, optional
+        Contains datetime.date objects, default is None (all dates).
+
+    Returns
+    -------
+    pending : ndarray
+        Boolean array, True for the dates to compute.
+    """
+    done = np.array([completed(date) for date in dates], dtype=bool)
+    return becgis.in_selection(dates, selection) & ~done
+
+
+def _item_key(item):
+    if isinstance(item, (datetime.date, datetime.datetime)):
+        return '{0:04d}-{1:02d}'.format(item.year, item.month)
+    return str(item)
+
+
+def load_state(state_fh):
+    """
+    Open pipeline.json, returns an empty state when it does not exist.
+    """
+    if os.path.exists(state_fh):
+        with open(state_fh, 'r') as stream:
+            return json.load(stream)
+    return {'files': dict(), 'stages': dict(), 'checkpoints': dict()}
+
+
+def save_state(state_fh, state):
+    """
+    Write pipeline.json to a temporary file first, so that an interrupted run
+    never leaves a partially written state behind.
+    """
+    temp_fh = becgis.temp_filehandle(state_fh)
+    with open(temp_fh, 'w') as stream:
+        json.dump(state, stream, indent=1, sort_keys=True)
+    becgis.replace_file(temp_fh, state_fh)
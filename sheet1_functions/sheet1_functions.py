@@ -12,7 +12,6 @@ import calendar
 import csv
 import datetime
 import glob
-import cairosvg
 import numpy as np
 import pandas as pd
 import tempfile as tf
@@ -26,6 +25,7 @@ import WA_Hyperloop.get_dictionaries as gd
 from WA_Hyperloop import hyperloop as hl
 import WA_Hyperloop.pairwise_validation as pwv
 from WA_Hyperloop.paths import get_path
+from WA_Hyperloop import pipeline
 
 def sum_ts(flow_csvs):
     
@@ -51,7 +51,7 @@ def sum_ts(flow_csvs):
 
     return data, common_dates
 
-def create_sheet1(complete_data, metadata, output_dir, global_data):
+def create_sheet1(complete_data, metadata, output_dir, global_data, dates = None):
         
     output_folder = os.path.join(output_dir, metadata['name'], 'sheet1')
     if not os.path.exists(output_folder):
@@ -81,14 +81,15 @@ def create_sheet1(complete_data, metadata, output_dir, global_data):
     # Create list to store results.
     all_results = list()
     
+    tasks = list()
     for date in common_dates:
         # Summurize some data in a dictionary.
-        entries = {'Fractions': complete_data['fractions'][0][complete_data['fractions'][1] == date][0],
+        entries = {'Fractions': complete_data['fractions'].get(date),
                     'WPL': global_data["wpl_tif"],
                     'EWR': global_data["environ_water_req"],
-                    'P': complete_data['p'][0][complete_data['p'][1] == date][0],
-                    'ETblue': complete_data['etb'][0][complete_data['etb'][1] == date][0],
-                    'ETgreen': complete_data['etg'][0][complete_data['etg'][1] == date][0]}
+                    'P': complete_data['p'].get(date),
+                    'ETblue': complete_data['etb'].get(date),
+                    'ETgreen': complete_data['etg'].get(date)}
         
         # Select the required outflow value.
         q_outflow = outflow_values[outflow_dates == date][0]
@@ -98,38 +99,66 @@ def create_sheet1(complete_data, metadata, output_dir, global_data):
         else:
             q_inflow = 0.0
         
-        # Calculate the sheet values.
-        results = calc_sheet1(entries, metadata['lu'], sheet1_lucs, metadata['recycling_ratio'], q_outflow, q_out_avg, output_folder,
-                              q_in_sw=q_inflow, q_out_sw=q_transfer)
+        # Months from an earlier (or interrupted) run are only recalculated for the graphs.
+        write = pipeline.pending_months([date], dates)[0]
         
-        # Save the results of the current month.
-        all_results.append(results)    
-        
-        # Create the csv-file.
-        output_fh = os.path.join(output_folder,'sheet1_monthly','sheet1_{0}_{1}.csv'.format(date.year, str(date.month).zfill(2)))
-        create_csv(results, output_fh)
+        tasks.append((date, entries, q_outflow, q_inflow, q_transfer, write))
     
-        # Plot the actual sheet.
-        create_sheet1_png(metadata['name'], '{0}-{1}'.format(date.year, str(date.month).zfill(2)), 'km3/month', output_fh, output_fh.replace('.csv','.pdf'), template = get_path('sheet1_svg'), smart_unit = True)
+    # Calculate the monthly sheets in parallel (see becgis.set_month_processes).
+    context = (metadata['name'], metadata['lu'], sheet1_lucs, metadata['recycling_ratio'], q_out_avg, output_folder)
+    for task, (results, output_fhs) in zip(tasks, becgis.map_months(_sheet1_month, tasks, context)):
+        # Save the results of the current month.
+        all_results.append(results)
+        if output_fhs:
+            pipeline.checkpoint(task[0], output_fhs)
     
     # Create some graphs.
     plot_storages(all_results, common_dates, metadata['name'], output_folder)
     plot_parameter(all_results, common_dates, metadata['name'], output_folder, 'utilizable_outflow')
     
     # Create yearly csv-files.
-    yearly_csv_fhs = hl.create_csv_yearly(os.path.split(output_fh)[0], 
+    yearly_csv_fhs = hl.create_csv_yearly(os.path.join(output_folder, 'sheet1_monthly'), 
                                           os.path.join(output_folder, "sheet1_yearly"), 
                                           1, metadata['water_year_start_month'], 
                                           year_position = [-11,-7], month_position = [-6,-4], 
-                                          header_rows = 1, header_columns = 3)
+                                          header_rows = 1, header_columns = 3,
+                                          years = None if dates is None else becgis.water_years(dates, metadata['water_year_start_month']))
     
     # Plot yearly sheets.
     for csv_fh in yearly_csv_fhs:
+        if pipeline.completed('sheet1 {0}'.format(csv_fh[-8:-4])):
+            continue
         create_sheet1_png(metadata['name'], csv_fh[-8:-4], 'km3/year', csv_fh, csv_fh.replace('.csv','.pdf'), template = get_path('sheet1_svg'), smart_unit = True)
+        pipeline.checkpoint('sheet1 {0}'.format(csv_fh[-8:-4]), [csv_fh, csv_fh.replace('.csv','.pdf')])
         
     return complete_data, all_results
 
 
+def _sheet1_month(context, task):
+    """
+    Calculate the sheet values of one month and create its csv-file and
+    sheet (when write is True), returns the sheet values and the created
+    files.
+    """
+    name, lu_fh, sheet1_lucs, recycling_ratio, q_out_avg, output_folder = context
+    date, entries, q_outflow, q_inflow, q_transfer, write = task
+    
+    # Calculate the sheet values.
+    results = calc_sheet1(entries, lu_fh, sheet1_lucs, recycling_ratio, q_outflow, q_out_avg, output_folder,
+                          q_in_sw=q_inflow, q_out_sw=q_transfer)
+    
+    if not write:
+        return results, []
+    
+    # Create the csv-file.
+    output_fh = os.path.join(output_folder,'sheet1_monthly','sheet1_{0}_{1}.csv'.format(date.year, str(date.month).zfill(2)))
+    create_csv(results, output_fh)
+
+    # Plot the actual sheet.
+    create_sheet1_png(name, '{0}-{1}'.format(date.year, str(date.month).zfill(2)), 'km3/month', output_fh, output_fh.replace('.csv','.pdf'), template = get_path('sheet1_svg'), smart_unit = True)
+    
+    return results, [output_fh, output_fh.replace('.csv','.pdf')]
+
 def create_sheet1_png(basin, period, units, data, output, template=False , smart_unit = False):
     """
 
@@ -441,7 +470,7 @@ def create_sheet1_png(basin, period, units, data, output, template=False , smart
 #    # Export svg to pdf
     tempout_path = output.replace('.pdf', '_temporary.svg')
     tree.write(tempout_path)    
-    cairosvg.svg2pdf(url=tempout_path, write_to=output)    
+    becgis.svg_to_pdf(tempout_path, output)
     os.remove(tempout_path)
     # Return
     return output
@@ -451,8 +480,8 @@ def create_sheet1_in_outflows(sheet5_csv_folder, metadata, output_dir):
     output_fh_in = os.path.join(output_dir,"sheet1_inflow_km3_"+metadata['name']+'.csv')
     output_fh_out = os.path.join(output_dir,"sheet1_outflow_km3_"+metadata['name']+'.csv')
        
-    csv_file_in = open(output_fh_in, 'w')
-    csv_file_out = open(output_fh_out, 'w')
+    csv_file_in = open(becgis.temp_filehandle(output_fh_in), 'w')
+    csv_file_out = open(becgis.temp_filehandle(output_fh_out), 'w')
 
     writer_in = csv.writer(csv_file_in, delimiter=';', lineterminator = '\n')
     writer_in.writerow(['lat:',0,'lon:',0,'km3 (from Sheet5)'])
@@ -482,7 +511,9 @@ def create_sheet1_in_outflows(sheet5_csv_folder, metadata, output_dir):
 #        total_inflow += float(df_inf.VALUE)+ (float(df_tran.VALUE))
         total_inflow += float(df_inf.VALUE)
     csv_file_in.close()
+    becgis.replace_file(becgis.temp_filehandle(output_fh_in), output_fh_in)
     csv_file_out.close()
+    becgis.replace_file(becgis.temp_filehandle(output_fh_out), output_fh_out)
     
     if total_inflow == 0.0:
         output_fh_in = None
@@ -649,8 +680,9 @@ def calc_ETs(ET, lu_fh, sheet1_lucs):
     ----------
     ET : ndarray
         Array of the data for which the sum needs to be calculated.
-    lu_fh : str
-        Filehandle pointing to landusemap.
+    lu_fh : str or tuple
+        Filehandle pointing to landusemap or encoded landusemap with the same
+        shape as ET, see becgis.encode_classes.
     sheet1_lucs : dict
         Dictionary with landuseclasses per category.
     
@@ -659,12 +691,7 @@ def calc_ETs(ET, lu_fh, sheet1_lucs):
     et : dict
         Dictionary with the totals per landuse category.
     """
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
-    et = dict()
-    for key in sheet1_lucs:
-        classes = sheet1_lucs[key]
-        mask = np.logical_or.reduce([LULC == value for value in classes])
-        et[key] = np.nansum(ET[mask])
+    et = becgis.aggregate_per_categories(lu_fh, ET, sheet1_lucs)
     return et
 
 def calc_utilizedflow(incremental_et, other, non_recoverable, other_fractions, non_recoverable_fractions):
@@ -746,17 +773,18 @@ def calc_sheet1(entries, lu_fh, sheet1_lucs, recycling_ratio, q_outflow, q_out_a
     """
     results = dict()
     
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
-    P = becgis.open_as_array(entries['P'], nan_values = True)
-    ETgreen = becgis.open_as_array(entries['ETgreen'], nan_values = True)
-    ETblue = becgis.open_as_array(entries['ETblue'], nan_values = True)
+    # Only use the pixels inside the basin.
+    pixels = becgis.basin_pixels(lu_fh)
+    LULC = becgis.gather_zones(lu_fh, pixels)
+    P = becgis.open_as_vector(entries['P'], pixels)
+    ETgreen = becgis.open_as_vector(entries['ETgreen'], pixels)
+    ETblue = becgis.open_as_vector(entries['ETblue'], pixels)
     
-    pixel_area = becgis.map_pixel_area_km(lu_fh)
+    pixel_area = becgis.gather_pixels(becgis.map_pixel_area_km(lu_fh, per_row = True), pixels)
 
     gray_water_fraction = calc_basinmean(entries['WPL'], lu_fh)
     ewr_percentage = calc_basinmean(entries['EWR'], lu_fh)
     
-    P[np.isnan(LULC)] = ETgreen[np.isnan(LULC)] = ETblue[np.isnan(LULC)] = np.nan
     P, ETgreen, ETblue = np.array([P, ETgreen, ETblue]) * 0.000001 * pixel_area
     
     ET = np.nansum([ETblue, ETgreen], axis = 0)
@@ -769,8 +797,8 @@ def calc_sheet1(entries, lu_fh, sheet1_lucs, recycling_ratio, q_outflow, q_out_a
     
     results['other'] = 0.0
     
-    landscape_et = calc_ETs(ETgreen, lu_fh, sheet1_lucs)
-    incremental_et = calc_ETs(ETblue, lu_fh, sheet1_lucs)
+    landscape_et = calc_ETs(ETgreen, LULC, sheet1_lucs)
+    incremental_et = calc_ETs(ETblue, LULC, sheet1_lucs)
     
     results['manmade'] = incremental_et['Managed']
     results['natural'] = incremental_et['Modified'] + incremental_et['Protected'] + incremental_et['Utilized']    
@@ -791,7 +819,7 @@ def calc_sheet1(entries, lu_fh, sheet1_lucs, recycling_ratio, q_outflow, q_out_a
     consumed_water = np.nansum(list(landscape_et.values())) + np.nansum(list(incremental_et.values())) + results['other'] + results['non_recoverable']
     non_consumed_water = net_inflow - consumed_water
     
-    results['non_utilizable_outflow'] = min(non_consumed_water, max(0.0, calc_non_utilizable(P, ET, entries['Fractions'])))
+    results['non_utilizable_outflow'] = min(non_consumed_water, max(0.0, calc_non_utilizable(P, ET, entries['Fractions'], pixels = pixels)))
     results['reserved_outflow_actual'] = min(non_consumed_water - results['non_utilizable_outflow'], results['reserved_outflow_demand'])
     results['utilizable_outflow'] = max(0.0, non_consumed_water - results['non_utilizable_outflow'] - results['reserved_outflow_actual'])
     
@@ -868,7 +896,7 @@ def create_csv(results, output_fh):
     if not os.path.exists(os.path.split(output_fh)[0]):
         os.makedirs(os.path.split(output_fh)[0])
     
-    csv_file = open(output_fh, 'w')
+    csv_file = open(becgis.temp_filehandle(output_fh), 'w')
     writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n')
     writer.writerow(first_row)
 
@@ -908,8 +936,9 @@ def create_csv(results, output_fh):
     writer.writerow(['OUTFLOW', 'RESERVED', 'Environmental', 0.]) 
     
     csv_file.close()
+    becgis.replace_file(becgis.temp_filehandle(output_fh), output_fh)
 
-def calc_non_utilizable(P, ET, fractions_fh):
+def calc_non_utilizable(P, ET, fractions_fh, pixels = None):
     """
     Calculate non utilizable outflow.
     
@@ -922,13 +951,19 @@ def calc_non_utilizable(P, ET, fractions_fh):
     fractions_fh : str
         Filehandle pointing to a map with fractions indicating how much of the
         (P-ET) difference is non-utilizable.
+    pixels : tuple, optional
+        Pixels inside the basin (see becgis.basin_pixels) when P and ET are
+        vectors, default is None.
     
     Returns
     -------
     non_utilizable_runoff : float
         The total volume of non_utilizable runoff.
     """
-    fractions = becgis.open_as_array(fractions_fh, nan_values = True)
+    if pixels is None:
+        fractions = becgis.open_as_array(fractions_fh, nan_values = True)
+    else:
+        fractions = becgis.open_as_vector(fractions_fh, pixels)
     non_utilizable_runoff = np.nansum((P - ET) * fractions)
     return non_utilizable_runoff
 
@@ -949,11 +984,9 @@ def calc_basinmean(perc_fh, lu_fh):
     percentage : float
         The mean of the map within the border of the lu_fh.
     """
-    output_folder = tf.mkdtemp()
-    perc_fh = becgis.match_proj_res_ndv(lu_fh, np.array([perc_fh]), output_folder)
-    EWR = becgis.open_as_array(perc_fh[0], nan_values = True)
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
+    perc_fh = becgis.match_static_layer(perc_fh, lu_fh)
+    EWR = becgis.open_as_array(perc_fh, nan_values = True)
+    LULC = becgis.open_as_array(lu_fh, nan_values = True, cache = True)
     EWR[np.isnan(LULC)] = np.nan
     percentage = np.nanmean(EWR)
-    shutil.rmtree(output_folder)
     return percentage
\ No newline at end of file
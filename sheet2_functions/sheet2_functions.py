@@ -17,17 +17,27 @@ from scipy import ndimage
 import pandas as pd
 import xml.etree.ElementTree as ET
 import datetime
-import cairosvg
 
 from WA_Hyperloop import hyperloop as hl
 import WA_Hyperloop.becgis as becgis
 import WA_Hyperloop.get_dictionaries as gd
 from WA_Hyperloop.paths import get_path
+from WA_Hyperloop import pipeline
 
-def create_sheet2(complete_data, metadata, output_dir):
+def create_sheet2(complete_data, metadata, output_dir, save_maps = True, dates = None):
     
-    if not np.all(['i' in list(complete_data.keys()), 't' in list(complete_data.keys())]):
-        t_files, t_dates, i_files, i_dates = splitET_ITE(metadata['lu'],
+    split = not np.all(['i' in list(complete_data.keys()), 't' in list(complete_data.keys())])
+    split_dates = dates
+    
+    # Existing I and T maps are used, but the selected months that are not
+    # part of them yet still need to be calculated.
+    if not split and dates is not None:
+        available = becgis.common_dates([complete_data['i'][1], complete_data['t'][1]])
+        split_dates = np.array(dates)[~becgis.in_selection(dates, available)]
+        split = split_dates.size > 0
+    
+    if split:
+        t_data, t_dates, i_data, i_dates = splitET_ITE(metadata['lu'],
                                                          complete_data['et'][0], 
                                                          complete_data['et'][1], 
                                                          complete_data['lai'][0], 
@@ -41,10 +51,15 @@ def create_sheet2(complete_data, metadata, output_dir):
                                                          os.path.join(output_dir, metadata['name'], 'data'), 
                                                          ndm_max_original = metadata['ndm_max_original'], 
                                                          plot_graph = True, 
-                                                         save_e = False)
-    
-        complete_data['i'] = (i_files, i_dates)
-        complete_data['t'] = (t_files, t_dates)
+                                                         save_e = False,
+                                                         in_memory = not save_maps,
+                                                         dates = split_dates)
+        if save_maps:
+            complete_data['i'] = becgis.TimeSeriesCatalog(i_data, i_dates)
+            complete_data['t'] = becgis.TimeSeriesCatalog(t_data, t_dates)
+    else:
+        t_data, t_dates = complete_data['t'][0], complete_data['t'][1]
+        i_data, i_dates = complete_data['i'][0], complete_data['i'][1]
     
     output_dir = os.path.join(output_dir, metadata['name'], 'sheet2')
     if not os.path.exists(output_dir):
@@ -56,27 +71,36 @@ def create_sheet2(complete_data, metadata, output_dir):
     monthly_csvs, yearly_csvs = create_sheet2_csv(lulc_dict, classes_dict, metadata['lu'], 
                                                   metadata['water_year_start_month'],
                                                   complete_data['et'][0], complete_data['et'][1], 
-                                                  complete_data['t'][0], complete_data['t'][1], 
-                                                  complete_data['i'][0], complete_data['i'][1], 
+                                                  t_data, t_dates, 
+                                                  i_data, i_dates, 
                                                   output_dir, catchment_name = metadata['name'], 
-                                                  full_years = True)
+                                                  full_years = True, dates = dates)
 
     for fh in yearly_csvs:
         output_fh = fh.replace('csv', 'pdf')
         year = str(fh[-8:-4])
+        if dates is not None and int(year) not in becgis.water_years(dates, metadata['water_year_start_month']):
+            continue
+        if pipeline.completed('sheet2 {0}'.format(year)):
+            continue
         create_sheet2_png(metadata['name'], year, 'km3/year', fh, output_fh, template = get_path('sheet2_svg'), smart_unit = True)
+        pipeline.checkpoint('sheet2 {0}'.format(year), [fh, output_fh])
         
     for fh in monthly_csvs:
         output_fh = fh.replace('csv', 'pdf')
         month = str(fh[-6:-4])
         year = str(fh[-11:-7])
+        date = datetime.date(int(year), int(month), 1)
+        if pipeline.completed(date):
+            continue
         create_sheet2_png(metadata['name'], '{0}-{1}'.format(year, month), 'km3/month', fh, output_fh, template = get_path('sheet2_svg'), smart_unit = True)
+        pipeline.checkpoint(date, [fh, output_fh])
         
     return complete_data
 
 def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_dates, t_fhs,
                       t_dates, i_fhs, i_dates, output_dir, catchment_name = None,
-                      full_years = True):
+                      full_years = True, dates = None):
     """
     Create sheet 2 csv-files.
     
@@ -93,11 +117,13 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
     et_dates : ndarray     
         Array with datetime.date objects specifying the date of the ET maps.
     t_fhs : ndarray      
-        Array of filehandles pointing to T maps.
+        Array of filehandles pointing to T maps, or an array with the T values
+        of the pixels inside the basin for each date (see splitET_ITE).
     t_dates : ndarray        
         Array with datetime.date objects specifying the date of the T maps.
     i_fhs : ndarray
-        Array of filehandles pointing to I maps.
+        Array of filehandles pointing to I maps, or an array with the I values
+        of the pixels inside the basin for each date.
     i_dates : ndarray
         Array with datetime.date objects specifying the date of the I maps.    
     output_dir : str  
@@ -106,20 +132,27 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
         Name of the catchment, default is None.
     full_years : boolean, optional  
         Choose to also create yearly csv-files, default is True.
+    dates : list, optional
+        Only write the csv-files of these months and of the complete years
+        they belong to, default is None (all months).
     
     Returns
     -------
     csv_fhs : ndarray      
-        Array of filehandles pointing to monthly csv-files.
+        Array of filehandles pointing to monthly csv-files. When dates is
+        given, only the csv-files that were (re)written.
     csv_fhs_yearly : ndarray    
         Array of filehandles pointing to yearly csv-files.
     """
     
     # Check if all maps have the same projection, resolution and No-Data-Value.
-    becgis.assert_proj_res_ndv([lu_fh, et_fhs, t_fhs, i_fhs])
+    becgis.assert_proj_res_ndv([lu_fh, et_fhs] + [fhs for fhs in [t_fhs, i_fhs] if not _is_stack(fhs)])
+    
+    # Only use the pixels inside the basin.
+    pixels = becgis.basin_pixels(lu_fh)
     
     # Calculate the size of each pixel in km2.
-    MapArea = becgis.map_pixel_area_km(lu_fh)
+    MapArea = becgis.gather_pixels(becgis.map_pixel_area_km(lu_fh, per_row = True), pixels)
     
     # Create some constants.
     month_labels = {1:'01',2:'02',3:'03',4:'04',5:'05',6:'06',7:'07',8:'08',9:'09',10:'10',11:'11',12:'12'}
@@ -141,8 +174,11 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
         if w.month < start_month:
             water_dates[water_dates == w] = datetime.date(w.year-1, w.month, w.day)
     
-    # Open the landuse-map.
-    LULC = becgis.open_as_array(lu_fh)
+    # Open and encode the landuse-map.
+    LULC = becgis.gather_zones(lu_fh, pixels)
+    
+    # Create the matrices to aggregate the totals per landuse class into rows.
+    table = sheet2_table(lulc_dict, classes_dict)
     
     # Create some variables needed for yearly sheets.
     complete_years = [None]
@@ -158,24 +194,26 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
         complete_years = [int(year) for year, count in zip(yrs, counts) if count == 12]
         year_count = 1
     
-    # Start calculations.
-    for (date, w_date) in zip(common_dates, water_dates):
-        
-        # Create csv-file.
+    # Only calculate the selected months and the complete years they belong to.
+    selected = becgis.in_selection(common_dates, dates)
+    if dates is not None:
+        complete_years = [year for year in complete_years if year in becgis.water_years(common_dates[selected], start_month)]
+    needed = [bool(sel or (full_years and w_date.year in complete_years)) for sel, w_date in zip(selected, water_dates)]
+    
+    # Months whose sheet was completed before an interruption are not written again.
+    selected = selected & pipeline.pending_months(common_dates, dates)
+    
+    # Write the monthly csv-files in parallel (see becgis.set_month_processes).
+    context = (pixels, MapArea, LULC, table, first_row)
+    tasks = list()
+    for (date, w_date, sel) in zip(common_dates[needed], water_dates[needed], selected[needed]):
         csv_filename = os.path.join(directory_months, '{0}_{1}_{2}.csv'.format(catchment_name, date.year, month_labels[date.month]))
-        csv_file = open(csv_filename, 'w')
-        writer = csv.writer(csv_file, delimiter=';')
-        writer.writerow(first_row)
-        
-        # Open the T, ET and I maps and set NDV pixels to NaN.
-        T = becgis.open_as_array(t_fhs[t_dates == date][0], nan_values = True)
-        ET = becgis.open_as_array(et_fhs[et_dates == date][0], nan_values = True)
-        I = becgis.open_as_array(i_fhs[i_dates == date][0], nan_values = True)
-                
-        # Convert units from [mm/month] to [km3/month].
-        I = I * MapArea / 1000000
-        T = T * MapArea / 1000000
-        ET = ET * MapArea / 1000000        
+        yearly = bool(full_years and w_date.year in complete_years)
+        tasks.append((csv_filename, bool(sel), yearly, _select_date(t_fhs, t_dates, date), 
+                      _select_date(et_fhs, et_dates, date), _select_date(i_fhs, i_dates, date)))
+    
+    # Start calculations.
+    for (date, w_date), (T, ET, I) in zip(zip(common_dates[needed], water_dates[needed]), becgis.map_months(_sheet2_month, tasks, context)):
         
         # Add monthly values to yearly totals.
         if np.all([full_years, (w_date.year in complete_years), (year_count is 1)]):
@@ -190,17 +228,6 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
             ETyear += ET
             Iyear += I
             year_count += 1
-        
-        # Calculate evaporation.
-        E = ET - T - I
-        
-        # Write data to csv-file.
-        for LAND_USE in list(classes_dict.keys()):
-            for CLASS in list(classes_dict[LAND_USE].keys()):
-                write_sheet2_row(LAND_USE, CLASS, lulc_dict, classes_dict, LULC, T, I, E, writer)
-        
-        # Close the csv-file.
-        csv_file.close()
 
         # Start creating a yearly csv-file.
         if np.all([full_years, (w_date.year in complete_years), (year_count is 13)]):
@@ -209,23 +236,28 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
             
             # Create csv-file for yearly data.
             csv_filename = os.path.join(directory_years, '{0}_{1}.csv'.format(catchment_name, w_date.year))
-            csv_file_year = open(csv_filename, 'w')
+            csv_file_year = open(becgis.temp_filehandle(csv_filename), 'w')
             writer_year = csv.writer(csv_file_year, delimiter=';')
             writer_year.writerow(first_row)
             
+            # Calculate the totals per landuse class.
+            Tyear_lu, Iyear_lu, Eyear_lu = [totals_per_class(LULC, data) for data in [Tyear, Iyear, Eyear]]
+            
             # Write data to yearly csv-file.
-            for LAND_USE in list(classes_dict.keys()):
-                for CLASS in list(classes_dict[LAND_USE].keys()):
-                    write_sheet2_row(LAND_USE, CLASS, lulc_dict, classes_dict, LULC, Tyear, Iyear, Eyear, writer_year)
+            write_sheet2_rows(table, Tyear_lu, Iyear_lu, Eyear_lu, writer_year)
             
             # Close csv-file.
             csv_file_year.close()
+            becgis.replace_file(becgis.temp_filehandle(csv_filename), csv_filename)
             
             # Set counter back to one.
             year_count = 1
 
     # Create list of created files.
-    csv_fhs = becgis.list_files_in_folder(directory_months, extension = 'csv')
+    if dates is None:
+        csv_fhs = becgis.list_files_in_folder(directory_months, extension = 'csv')
+    else:
+        csv_fhs = [task[0] for task in tasks if task[1]]
     
     # Return list of filehandles.
     if full_years:
@@ -234,7 +266,49 @@ def create_sheet2_csv(lulc_dict, classes_dict, lu_fh, start_month, et_fhs, et_da
     else:
         return csv_fhs
 
-def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_fhs, n_dates, ndm_fhs, ndm_dates, output_dir, ndm_max_original = True, plot_graph = True, save_e = False):
+def _is_stack(data):
+    return isinstance(data, np.ndarray) and np.issubdtype(data.dtype, np.floating)
+
+def _select_date(data, dates, date):
+    if _is_stack(data):
+        return data[np.where(dates == date)[0][0]]
+    else:
+        return data[dates == date][0]
+
+def _sheet2_month(context, task):
+    """
+    Write the csv-file of one month (when write is True), returns the T, ET and
+    I vectors in km3 when they are needed for the yearly totals.
+    """
+    pixels, MapArea, LULC, table, first_row = context
+    csv_filename, write, yearly, t_data, et_data, i_data = task
+    
+    # Open the T, ET and I maps and set NDV pixels to NaN.
+    T, ET, I = [data if _is_stack(data) else becgis.open_as_vector(data, pixels) for data in [t_data, et_data, i_data]]
+    
+    # Convert units from [mm/month] to [km3/month].
+    I = I * MapArea / 1000000
+    T = T * MapArea / 1000000
+    ET = ET * MapArea / 1000000
+    
+    # Calculate evaporation.
+    E = ET - T - I
+    
+    # Write data to csv-file, months from an earlier run are only needed for the yearly totals.
+    if write:
+        T_lu, I_lu, E_lu = [totals_per_class(LULC, data) for data in [T, I, E]]
+        csv_file = open(becgis.temp_filehandle(csv_filename), 'w')
+        writer = csv.writer(csv_file, delimiter=';')
+        writer.writerow(first_row)
+        write_sheet2_rows(table, T_lu, I_lu, E_lu, writer)
+        csv_file.close()
+        becgis.replace_file(becgis.temp_filehandle(csv_filename), csv_filename)
+    
+    if yearly:
+        return T, ET, I
+    return None, None, None
+
+def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_fhs, n_dates, ndm_fhs, ndm_dates, output_dir, ndm_max_original = True, plot_graph = True, save_e = False, in_memory = False, block_size = 12, dates = None):
     """
     Split evapotranspiration into transpiration and interception.
     
@@ -264,17 +338,29 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
         Filehandle specifying the folder to save output.
     plot_graph : boolean, optional
         Plot a graph of the spatially averaged ET and the fractions of E, T and I, default is True.
+    in_memory : boolean, optional
+        Return the T and I values of the pixels inside the basin instead of
+        saving them as maps, default is False.
+    block_size : int, optional
+        Number of months to calculate at once, default is 12.
+    dates : list, optional
+        Only calculate the maps of these months, the maps of the other months
+        are expected to exist from an earlier run. The NDM maxima are still
+        based on all months. Ignored when in_memory is True. Default is None.
     
     Returns
     -------
-    i_fhs : ndarray
-        Array of filehandles pointing to I maps.
-    i_dates : ndarray
-        Array with datetime.date objects specifying the date of the I maps.
     t_fhs : ndarray
-        Array of filehandles pointing to T maps.
+        Array of filehandles pointing to T maps. If in_memory is True, an
+        array with the T values of the pixels inside the basin (see
+        becgis.basin_pixels) for each date.
     t_dates : ndarray
         Array with datetime.date objects specifying the date of the T maps.
+    i_fhs : ndarray
+        Array of filehandles pointing to I maps, or the I values if in_memory
+        is True.
+    i_dates : ndarray
+        Array with datetime.date objects specifying the date of the I maps.
     """
     # Check if all maps have the same projection, resolution and No-Data-Value.
     becgis.assert_proj_res_ndv([et_fhs, lai_fhs, p_fhs, n_fhs, ndm_fhs])
@@ -287,7 +373,7 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
     common_dates = becgis.common_dates([et_dates, lai_dates, p_dates, n_dates, ndm_dates])
     
     if not ndm_max_original:
-        ndm_months = np.array([date.month for date in ndm_dates])
+        climatology = becgis.monthly_climatology(ndm_fhs, ndm_dates)
         
         ndm_max_folder = os.path.join(output_dir, "ndm_max")
         if not os.path.exists(ndm_max_folder):
@@ -297,16 +383,11 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
 
         footprint = np.ones((10,10), dtype = np.bool)
         
-        for month in np.unique(ndm_months):
-            std, mean = becgis.calc_mean_std(ndm_fhs[ndm_months == month])
-            ndm_temporal_mean = mean #+ 2 * std
+        for month in sorted(climatology.keys()):
+            std, mean = climatology[month]
+            ndm_temporal_mean = np.copy(mean) #+ 2 * std
             ndm_temporal_mean [np.isnan(ndm_temporal_mean )] = 0.
-            ndm_spatial_max = ndm_temporal_mean * 0.0
-            for lu in np.unique(LU):
-                ndm_lu = ndm_temporal_mean * 0.0
-                ndm_lu[LU == lu] = ndm_temporal_mean[LU == lu]
-                intermediate = ndimage.maximum_filter(ndm_lu, footprint = footprint)
-                ndm_spatial_max[LU==lu] = intermediate[LU==lu]
+            ndm_spatial_max = maximum_filter_per_class(ndm_temporal_mean, LU, footprint)
             output_fh = os.path.join(ndm_max_folder, 'ndm_max_{0}.tif'.format(month_labels[month]))
             becgis.create_geotiff(output_fh, ndm_spatial_max, driver, NDV, xsize, ysize, GeoT, Projection)
             ndm_max_fhs[month] = output_fh
@@ -334,70 +415,100 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
         t = np.array([])
         e = np.array([])
     
-    # Start iterating over dates.
-    for date in common_dates:
+    # Only calculate the selected months, the graph needs all months.
+    if not in_memory and dates is not None:
+        common_dates = common_dates[becgis.in_selection(common_dates, dates)]
+        plot_graph = False
+    
+    # Only calculate the pixels inside the basin.
+    pixels = becgis.basin_pixels(lu_fh)
+    
+    # Create folders to store maps.
+    directory_t = os.path.join(output_dir, "t")
+    directory_i = os.path.join(output_dir, "i")
+    directory_e = os.path.join(output_dir, "e")
+    for directory, needed in [(directory_t, not in_memory), (directory_i, not in_memory), (directory_e, save_e)]:
+        if needed and not os.path.exists(directory):
+            os.makedirs(directory)
+    
+    if in_memory:
+        T_all = np.zeros((len(common_dates), pixels[0].size), dtype = np.float32)
+        I_all = np.zeros((len(common_dates), pixels[0].size), dtype = np.float32)
+    
+    # Start iterating over blocks of dates.
+    for start in range(0, len(common_dates), block_size):
+        block = common_dates[start:start + block_size]
+        
         # Open data to calculate I and set NDV pixels to NaN.
-        LAI = becgis.open_as_array(lai_fhs[lai_dates == date][0], nan_values = True)
-        P = becgis.open_as_array(p_fhs[p_dates == date][0], nan_values = True)
-        n = becgis.open_as_array(n_fhs[n_dates == date][0], nan_values = True)
+        LAI = np.array([becgis.open_as_vector(lai_fhs[lai_dates == date][0], pixels) for date in block])
+        P = np.array([becgis.open_as_vector(p_fhs[p_dates == date][0], pixels) for date in block])
+        n = np.array([becgis.open_as_vector(n_fhs[n_dates == date][0], pixels) for date in block])
         
-        # Calculate I.
-        I = LAI * (1 - (1 + (P/n) * (1 - np.exp(-0.5 * LAI)) * (1/LAI))**-1) * n
+        # Calculate I = LAI * (1 - (1 + (P/n) * (1 - exp(-0.5 * LAI)) * (1/LAI))**-1) * n.
+        with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+            I = np.multiply(LAI, -0.5)
+            np.exp(I, out = I)
+            np.subtract(1, I, out = I)
+            I *= P
+            I /= n
+            I /= LAI
+            I += 1
+            np.reciprocal(I, out = I)
+            np.subtract(1, I, out = I)
+            I *= LAI
+            I *= n
+        del P
         
         # Set boundary conditions.
         I[LAI == 0] = 0.
         I[n == 0] = 0.
         I[np.isnan(LAI)] = 0.
+        del LAI, n
         
         # Open ET and NDM maps and set NDV pixels to NaN.
-        ET = becgis.open_as_array(et_fhs[et_dates == date][0], nan_values = True)
+        ET = np.array([becgis.open_as_vector(et_fhs[et_dates == date][0], pixels) for date in block])
         
-        I = np.nanmin((I, ET), axis = 0)
+        np.fmin(I, ET, out = I)
         
-        NDM = becgis.open_as_array(ndm_fhs[ndm_dates == date][0], nan_values = True)
+        NDM = np.array([becgis.open_as_vector(ndm_fhs[ndm_dates == date][0], pixels) for date in block])
         
         if ndm_max_original:
-            NDMMAX = 0.95 / NDMmax[date.month]
+            NDMMAX = np.array([[0.95 / NDMmax[date.month]] for date in block])
         
         if not ndm_max_original:
-            NDMMAX = 1.00 / becgis.open_as_array(ndm_max_fhs[date.month], nan_values = True)
+            NDMMAX = 1.00 / np.array([becgis.open_as_vector(ndm_max_fhs[date.month], pixels) for date in block])
     
         # Calculate T.
-        T = np.nanmin(((NDM * NDMMAX),np.ones(np.shape(NDM)) * 0.95), axis = 0) * (ET - I)
-            
-        # Create folder to store maps.
-        directory_t = os.path.join(output_dir, "t")
-        if not os.path.exists(directory_t):
-            os.makedirs(directory_t)
+        NDM *= NDMMAX
+        T = np.fmin(NDM, 0.95, out = NDM)
+        T *= ET - I
         
-        directory_i = os.path.join(output_dir, "i")
-        if not os.path.exists(directory_i):
-            os.makedirs(directory_i)
-
-        if save_e:
-            directory_e = os.path.join(output_dir, "e")
-            if not os.path.exists(directory_e):
-                os.makedirs(directory_e)
-            E = ET - I - T
-            output_fh = os.path.join(directory_e, 'E_{0}{1}.tif'.format(date.year,month_labels[date.month]))
-            becgis.create_geotiff(output_fh, E, driver, NDV, xsize, ysize, GeoT, Projection)
-        
-        # Store values to plot a graph.
-        if plot_graph:
-            et = np.append(et, np.nanmean(ET))
-            i = np.append(i, np.nanmean(I))
-            t = np.append(t, np.nanmean(T))
-            e = np.append(e, np.nanmean(ET - I - T))
-        
-        # Save I map.
-        output_fh = os.path.join(directory_i, 'I_{0}{1}.tif'.format(date.year,month_labels[date.month]))
-        becgis.create_geotiff(output_fh, I, driver, NDV, xsize, ysize, GeoT, Projection)
-
-        # Save T map.
-        output_fh = os.path.join(directory_t, 'T_{0}{1}.tif'.format(date.year,month_labels[date.month]))
-        becgis.create_geotiff(output_fh, T, driver, NDV, xsize, ysize, GeoT, Projection)
-        
-        print("Finished E,T,I for {0}".format(date))
+        for j, date in enumerate(block):
+            if save_e:
+                E = ET[j] - I[j] - T[j]
+                output_fh = os.path.join(directory_e, 'E_{0}{1}.tif'.format(date.year,month_labels[date.month]))
+                becgis.create_geotiff(output_fh, becgis.scatter_pixels(E, pixels), driver, NDV, xsize, ysize, GeoT, Projection)
+            
+            # Store values to plot a graph.
+            if plot_graph:
+                et = np.append(et, np.nanmean(ET[j]))
+                i = np.append(i, np.nanmean(I[j]))
+                t = np.append(t, np.nanmean(T[j]))
+                e = np.append(e, np.nanmean(ET[j] - I[j] - T[j]))
+            
+            if in_memory:
+                T_all[start + j] = T[j]
+                I_all[start + j] = I[j]
+            else:
+                # Save I map.
+                output_fh = os.path.join(directory_i, 'I_{0}{1}.tif'.format(date.year,month_labels[date.month]))
+                becgis.create_geotiff(output_fh, becgis.scatter_pixels(I[j], pixels), driver, NDV, xsize, ysize, GeoT, Projection)
+                
+                # Save T map.
+                output_fh = os.path.join(directory_t, 'T_{0}{1}.tif'.format(date.year,month_labels[date.month]))
+                becgis.create_geotiff(output_fh, becgis.scatter_pixels(T[j], pixels), driver, NDV, xsize, ysize, GeoT, Projection)
+            
+            print("Finished E,T,I for {0}".format(date))
     
     # Plot graph of ET and E, T and I fractions.
     if plot_graph:
@@ -421,6 +532,9 @@ def splitET_ITE(lu_fh, et_fhs, et_dates, lai_fhs, lai_dates, p_fhs, p_dates, n_f
         [r.set_zorder(10) for r in ax.spines.values()]
         plt.savefig(os.path.join(output_dir,'ETfractions_ITE.png'))
 
+    if in_memory:
+        return T_all, np.array(common_dates), I_all, np.array(common_dates)
+    
     # Create arrays with filehandles and datetime.date objects on the created maps.
     t_fhs, t_dates, t_years, t_months, t_days = becgis.sort_files(directory_t, [-10,-6], month_position = [-6,-4])
     i_fhs, i_dates, i_years, i_months, i_days = becgis.sort_files(directory_i, [-10,-6], month_position = [-6,-4])
@@ -453,6 +567,199 @@ def calc_footprint(max_radius, pixel_size):
     footprint = test <= pixels
     return footprint
     
+def maximum_filter_per_class(DATA, LULC, footprint):
+    """
+    Calculate for each pixel the maximum value within a footprint, only
+    considering the pixels with the same landuse class. Gives the same
+    result as applying ndimage.maximum_filter to DATA masked (set to zero)
+    for each landuse class separately.
+    
+    The filter is separable: the pixels are sorted per landuse class and
+    row, a row pass calculates running maxima within blocks of footprint
+    width that reset at class changes, after which a column pass combines
+    the blocks covering the window of each pixel on the footprint rows.
+    
+    Parameters
+    ----------
+    DATA : ndarray
+        Array with the values to filter.
+    LULC : ndarray
+        Landusemap with the same shape as DATA.
+    footprint : ndarray
+        Boolean array with the footprint of the filter, should be True
+        everywhere (a rectangular window).
+        
+    Returns
+    -------
+    MAX : ndarray
+        Array with the maxima, zero for pixels without a landuse class.
+    """
+    ysize, xsize = np.shape(DATA)
+    size_y, size_x = np.shape(footprint)
+    index, classes = becgis.encode_classes(LULC)
+    index = index.reshape(ysize, xsize)
+    
+    # Pad the maps the same way ndimage.maximum_filter does ('reflect'), the
+    # window of pixel (i, j) then starts at (i, j) in the padded maps.
+    before = [size_y // 2, size_x // 2]
+    padding = [(before[0], size_y - 1 - before[0]), (before[1], size_x - 1 - before[1])]
+    LULC_pad = np.pad(index, padding, mode = 'symmetric')
+    DATA_pad = np.pad(DATA, padding, mode = 'symmetric')
+    rows_pad, columns_pad = LULC_pad.shape
+    nblocks = -(-columns_pad // size_x)
+    
+    # Sort the pixels per landuse class, then per row and column.
+    order = np.argsort(LULC_pad, axis = None, kind = 'stable')
+    labels = LULC_pad.ravel()[order]
+    order = order[labels < classes.size]
+    labels = labels[:order.size].astype(np.int64)
+    rows, columns = np.divmod(order, columns_pad)
+    
+    # Row pass, one block per class, row and size_x columns.
+    block = (labels * rows_pad + rows) * nblocks + columns // size_x
+    new = np.ones(block.size, dtype = bool)
+    new[1:] = block[1:] != block[:-1]
+    blocks = np.append(block[new], -1)
+    missing = blocks.size - 1
+    prefix = np.full((size_x, missing + 1), -np.inf, dtype = DATA.dtype)
+    prefix[columns % size_x, np.cumsum(new) - 1] = DATA_pad.ravel()[order]
+    suffix = np.copy(prefix)
+    for k in range(1, size_x):
+        np.maximum(prefix[k], prefix[k - 1], out = prefix[k])
+        np.maximum(suffix[-k - 1], suffix[-k], out = suffix[-k - 1])
+    prefix = prefix.ravel()
+    suffix = suffix.ravel()
+    
+    # Column pass, the window of a pixel covers the end of its first block
+    # and the start of the next block on each of the footprint rows.
+    inside = ((rows >= before[0]) & (rows < before[0] + ysize) &
+              (columns >= before[1]) & (columns < before[1] + xsize))
+    r = rows[inside] - before[0]
+    c = columns[inside] - before[1]
+    step = (c + size_x - 1) // size_x - c // size_x
+    crossing = step > 0
+    first = (c % size_x) * (missing + 1)
+    last = ((c + size_x - 1) % size_x) * (missing + 1)
+    key = (labels[inside] * rows_pad + r) * nblocks + c // size_x
+    MAX_sorted = np.full(key.size, -np.inf, dtype = DATA.dtype)
+    for row in range(size_y):
+        j = np.searchsorted(blocks[:-1], key)
+        hit = blocks[j] == key
+        k = j + (hit & crossing)
+        k[blocks[k] != key + step] = missing
+        j[~hit] = missing
+        np.maximum(MAX_sorted, suffix.take(first + j), out = MAX_sorted)
+        np.maximum(MAX_sorted, prefix.take(last + k), out = MAX_sorted)
+        key += nblocks
+    
+    MAX = np.zeros_like(DATA)
+    MAX[r, c] = MAX_sorted
+    
+    # Pixels of other classes within the window count as zero.
+    mixed = (ndimage.maximum_filter(index, size = (size_y, size_x)) !=
+             ndimage.minimum_filter(index, size = (size_y, size_x)))
+    mixed &= index < classes.size
+    MAX[mixed] = np.maximum(MAX[mixed], 0.0)
+    return MAX
+
+def totals_per_class(lulc, data):
+    """
+    Calculate the spatial sum of a map for each landuse class.
+    
+    Parameters
+    ----------
+    lulc : ndarray or tuple
+        The landusemap or the encoded landusemap, see becgis.encode_classes.
+    data : ndarray
+        The spatial data to be summed.
+        
+    Returns
+    -------
+    totals : dict
+        Dictionary with the sum per landuse class present on the map.
+    """
+    zones = becgis.encode_classes(lulc)
+    sums = becgis.sum_per_class(zones, data)[0]
+    totals = dict(zip(zones[1].tolist(), sums))
+    return totals
+
+def sheet2_table(lulc_dict, classes_dict):
+    """
+    Create the matrices to calculate all rows of a sheet2 csv-file from the
+    totals per landuse class.
+    
+    Parameters
+    ----------
+    lulc_dict : dict 
+        Describing the different land use classes, import using 'get_dictionaries'.
+    classes_dict : dict   
+        Describing the sheet 2 specific aggregation of classes from lulc_dict.
+        
+    Returns
+    -------
+    table : dict
+        Dictionary with the 'rows' (LAND_USE, CLASS), the landuse classes
+        ('lu_types'), the 'members' and 'counts' matrices (rows x classes) to
+        sum the totals per row, the 'water' rows and the 'beneficial' and
+        'service' fractions per class.
+    """
+    rows = [(LAND_USE, CLASS) for LAND_USE in list(classes_dict.keys()) for CLASS in list(classes_dict[LAND_USE].keys())]
+    lu_types = sorted(set(lu_type for LAND_USE, CLASS in rows for lu_type in classes_dict[LAND_USE][CLASS]))
+    positions = dict((lu_type, j) for j, lu_type in enumerate(lu_types))
+    
+    members = np.zeros((len(rows), len(lu_types)))
+    counts = np.zeros((len(rows), len(lu_types)))
+    for k, (LAND_USE, CLASS) in enumerate(rows):
+        for lu_type in classes_dict[LAND_USE][CLASS]:
+            members[k, positions[lu_type]] = 1
+            counts[k, positions[lu_type]] += 1
+            
+    table = {'rows': rows,
+             'lu_types': lu_types,
+             'members': members,
+             'counts': counts,
+             'water': np.array([CLASS in ['Natural water bodies', 'Managed water bodies'] for LAND_USE, CLASS in rows]),
+             'beneficial': np.array([lulc_dict[lu_type][3:6] for lu_type in lu_types], dtype = float).reshape(-1, 3) / 100,
+             'service': np.array([lulc_dict[lu_type][6:11] for lu_type in lu_types], dtype = float).reshape(-1, 5) / 100}
+    return table
+
+def write_sheet2_rows(table, T, I, E, writer):
+    """
+    Write all rows of a sheet2 csv-file from the totals per landuse class.
+    
+    Parameters
+    ----------
+    table : dict
+        Matrices describing the rows, see sheet2_table.
+    T : dict
+        The transpiration totals per landuse class, see totals_per_class.
+    I : dict
+        The interception totals per landuse class.
+    E : dict
+        The evaporation totals per landuse class.
+    writer : object
+        csv.writer object.
+    """
+    # Put the totals per landuse class in the order of the table.
+    TIE = np.array([[data.get(lu_type, 0.0) for lu_type in table['lu_types']] for data in [T, I, E]]).reshape(3, -1)
+    TIE[np.isnan(TIE)] = 0.0
+    
+    # Calculate the spatial sum of the different parameters.
+    transpiration, interception, evaporation = np.dot(table['members'], TIE.T).T
+    water_evaporation = np.where(table['water'], evaporation, 0.0)
+    soil_evaporation = np.where(table['water'], 0.0, evaporation)
+    
+    # Calculate the beneficial and non-beneficial ET per class and the service contributions per row.
+    beneficial = table['beneficial']
+    benef_et = TIE[0] * beneficial[:,0] + TIE[2] * beneficial[:,1] + TIE[1] * beneficial[:,2]
+    non_benef_et = TIE[0] * (1 - beneficial[:,0]) + TIE[2] * (1 - beneficial[:,1]) + TIE[1] * (1 - beneficial[:,2])
+    services = np.dot(table['counts'], benef_et[:,np.newaxis] * table['service'])
+    non_beneficial = np.dot(table['counts'], non_benef_et)
+    
+    for k, (LAND_USE, CLASS) in enumerate(table['rows']):
+        values = [transpiration[k], water_evaporation[k], soil_evaporation[k], interception[k]] + list(services[k]) + [non_beneficial[k]]
+        writer.writerow([LAND_USE, CLASS] + ["{0}".format(np.nansum([0, value])) for value in values])
+
 def write_sheet2_row(LAND_USE, CLASS, lulc_dict, classes_dict, lulc, T, I, E, writer):
     """
     Write a row with spatial aggregates to a sheet2 csv-file.
@@ -467,25 +774,27 @@ def write_sheet2_row(LAND_USE, CLASS, lulc_dict, classes_dict, lulc, T, I, E, wr
         Describing the different land use classes, import using 'get_dictionaries'.
     classes_dict   : dict   
         Describing the sheet 2 specific aggregation of classes from lulc_dict.
-    T : ndarray
-        The spatial transpiration data.
-    I : ndarray
-        The spatial interception data.        
-    E : ndarray
-        The spatial evaporation data.
+    lulc : ndarray or tuple
+        The landusemap or the encoded landusemap, see becgis.encode_classes.
+    T : ndarray or dict
+        The spatial transpiration data or its totals per landuse class.
+    I : ndarray or dict
+        The spatial interception data or its totals per landuse class.        
+    E : ndarray or dict
+        The spatial evaporation data or its totals per landuse class.
     writer : object
         csv.writer object.
     """
     # Get a list of the different landuse classes to be aggregated.
     lulcs = classes_dict[LAND_USE][CLASS]
     
-    # Create a mask to ignore non relevant pixels.
-    mask=np.logical_or.reduce([lulc == value for value in lulcs])
+    # Calculate the totals per landuse class.
+    T, I, E = [data if isinstance(data, dict) else totals_per_class(lulc, data) for data in [T, I, E]]
     
     # Calculate the spatial sum of the different parameters.
-    transpiration = np.nansum(T[mask])
-    interception = np.nansum(I[mask])
-    evaporation = np.nansum(E[mask])
+    transpiration = np.nansum([T.get(lu_type, 0.0) for lu_type in set(lulcs)])
+    interception = np.nansum([I.get(lu_type, 0.0) for lu_type in set(lulcs)])
+    evaporation = np.nansum([E.get(lu_type, 0.0) for lu_type in set(lulcs)])
     
     # Set special cases.
     if np.any([CLASS == 'Natural water bodies', CLASS == 'Managed water bodies']):
@@ -511,9 +820,9 @@ def write_sheet2_row(LAND_USE, CLASS, lulc_dict, classes_dict, lulc, T, I, E, wr
         service_contributions = np.array(lulc_dict[lu_type][6:11]) / 100         
           
         # Calculate the beneficial ET.
-        benef_et = np.nansum([np.nansum(T[lulc == lu_type]) * beneficial_percentages[0],
-               np.nansum(E[lulc == lu_type]) * beneficial_percentages[1],
-               np.nansum(I[lulc == lu_type]) * beneficial_percentages[2]])
+        benef_et = np.nansum([T.get(lu_type, 0.0) * beneficial_percentages[0],
+               E.get(lu_type, 0.0) * beneficial_percentages[1],
+               I.get(lu_type, 0.0) * beneficial_percentages[2]])
                
         # Determine the service contributions.
         agriculture += benef_et * service_contributions[0] 
@@ -523,9 +832,9 @@ def write_sheet2_row(LAND_USE, CLASS, lulc_dict, classes_dict, lulc, T, I, E, wr
         leisure += benef_et * service_contributions[4]
        
         # Determine non-beneficial ET.
-        non_beneficial += (np.nansum([np.nansum(T[lulc == lu_type]) * (1 - beneficial_percentages[0]),
-               np.nansum(E[lulc == lu_type]) * (1 - beneficial_percentages[1]),
-               np.nansum(I[lulc == lu_type]) * (1 - beneficial_percentages[2])]))
+        non_beneficial += (np.nansum([T.get(lu_type, 0.0) * (1 - beneficial_percentages[0]),
+               E.get(lu_type, 0.0) * (1 - beneficial_percentages[1]),
+               I.get(lu_type, 0.0) * (1 - beneficial_percentages[2])]))
     
     # Create the row to be written
     row = [LAND_USE, CLASS, "{0}".format(np.nansum([0, transpiration])), "{0}".format(np.nansum([0, water_evaporation])), "{0}".format(np.nansum([0, soil_evaporation])), "{0}".format(np.nansum([0, interception])), "{0}".format(np.nansum([0, agriculture])), "{0}".format(np.nansum([0, environment])), "{0}".format(np.nansum([0, economy])), "{0}".format(np.nansum([0, energy])), "{0}".format(np.nansum([0, leisure])), "{0}".format(np.nansum([0, non_beneficial]))]
@@ -1505,7 +1814,7 @@ def create_sheet2_png(basin, period, units, data, output, template=False,
     # Export svg to png
     tempout_path = output.replace('.pdf', '_temporary.svg')
     tree.write(tempout_path)    
-    cairosvg.svg2pdf(url=tempout_path, write_to=output)    
+    becgis.svg_to_pdf(tempout_path, output)
     os.remove(tempout_path)
 
 
@@ -19,13 +19,13 @@ import matplotlib.lines as mlines
 import matplotlib.patches as mpatches
 import pandas as pd
 import xml.etree.ElementTree as ET
-import cairosvg
 
 import WA_Hyperloop.becgis as becgis
 import WA_Hyperloop.get_dictionaries as gd
 from WA_Hyperloop.paths import get_path
+from WA_Hyperloop import pipeline
 
-def create_sheet3(complete_data, metadata, output_dir):
+def create_sheet3(complete_data, metadata, output_dir, dates = None):
     
     output_dir = os.path.join(output_dir, metadata['name'], 'sheet3')
     if not os.path.exists(output_dir):
@@ -37,10 +37,18 @@ def create_sheet3(complete_data, metadata, output_dir):
 
     LULC = becgis.open_as_array(metadata['lu'], nan_values = True)
     
+    seasons = dict((crop[4], import_growing_seasons(crop[0])) for crop in metadata['crops'] if crop[4] in LULC)
+    
+    # Read the monthly maps once for the pixels of all crops on the LU-map.
+    layer = crop_data_layer(metadata['lu'], list(seasons.keys()),
+                            complete_data['etg'], complete_data['etb'], complete_data['ndm'], complete_data['p'],
+                            ([date for season in seasons.values() for date in season[0]],
+                             [date for season in seasons.values() for date in season[1]]))
+    
     for crop in metadata['crops']:
         if crop[4] in LULC:
-            start_dates, end_dates = import_growing_seasons(crop[0])
-            result_seasonly = calc_Y_WP_seasons(start_dates, end_dates, metadata['lu'], crop[4], crop[1], complete_data['etg'][0], complete_data['etg'][1], complete_data['etb'][0], complete_data['etb'][1], complete_data['ndm'][0], complete_data['ndm'][1], complete_data['p'][0], complete_data['p'][1], os.path.join(output_dir, 'WP_Y_Seasonly_csvs'), HIWC_dict, ab = (1.0,0.9))
+            start_dates, end_dates = seasons[crop[4]]
+            result_seasonly = calc_Y_WP_seasons(start_dates, end_dates, metadata['lu'], crop[4], crop[1], complete_data['etg'][0], complete_data['etg'][1], complete_data['etb'][0], complete_data['etb'][1], complete_data['ndm'][0], complete_data['ndm'][1], complete_data['p'][0], complete_data['p'][1], os.path.join(output_dir, 'WP_Y_Seasonly_csvs'), HIWC_dict, ab = (1.0,0.9), layer = layer)
             result = calc_Y_WP_year(result_seasonly, os.path.join(output_dir, 'WP_Y_Yearly_csvs'), crop[1])
             plot_Y_WP(result, os.path.join(output_dir,'WP_Y_Yearly_graphs'), croptype = crop[1], catchment_name = metadata['name'], filetype = 'png')
             plot_Y_WP(result_seasonly, os.path.join(output_dir,'WP_Y_Seasonly_graphs'), croptype = crop[1], catchment_name = metadata['name'], filetype = 'png')
@@ -67,11 +75,19 @@ def create_sheet3(complete_data, metadata, output_dir):
         wp_y_non_crop_dictionary['Fish (Aquaculture)']['-'] = metadata['non_crop']['aquaculture']
         wp_y_non_crop_dictionary['Timber']['-'] = metadata['non_crop']['timber']
 
+    # The growing seasons are always calculated for the complete record, only
+    # the yearly sheets of years with new months are created again.
+    if dates is not None:
+        years = [year for year in years if year in set(date.year for date in dates)]
+
     for year in years:
+        if pipeline.completed('sheet3 {0}'.format(year)):
+            continue
         csv_fh_a, csv_fh_b = create_sheet3_csv(wp_y_irrigated_dictionary, wp_y_rainfed_dictionary, wp_y_non_crop_dictionary, year, output_dir)
         output_fh_a = csv_fh_a[:-3] + 'pdf'
         output_fh_b = csv_fh_b[:-3] + 'pdf'
         sheet3a_fh, sheet3b_fh = create_sheet3_png(metadata['name'], str(year), ['km3/year', 'kg/ha/year', 'kg/m3'], [csv_fh_a, csv_fh_b], [output_fh_a, output_fh_b], template = [get_path('sheet3_1_svg'),get_path('sheet3_2_svg')])
+        pipeline.checkpoint('sheet3 {0}'.format(year), [csv_fh_a, csv_fh_b, output_fh_a, output_fh_b])
      
     return complete_data
 
@@ -137,11 +153,11 @@ def create_sheet3_csv(wp_y_irrigated_dictionary, wp_y_rainfed_dictionary, wp_y_n
     first_row_b = ["USE","CLASS","SUBCLASS","TYPE","SUBTYPE","LAND_PRODUCTIVITY","WATER_PRODUCTIVITY"]
     first_row_a = ["USE","CLASS","SUBCLASS","TYPE","SUBTYPE","WATER_CONSUMPTION"]
     
-    csv_file_b = open(output_csv_fh_b, 'w')
+    csv_file_b = open(becgis.temp_filehandle(output_csv_fh_b), 'w')
     writer_b = csv.writer(csv_file_b, delimiter=';', lineterminator = '\n')
     writer_b.writerow(first_row_b)
     
-    csv_file_a = open(output_csv_fh_a, 'w')
+    csv_file_a = open(becgis.temp_filehandle(output_csv_fh_a), 'w')
     writer_a = csv.writer(csv_file_a, delimiter=';', lineterminator = '\n')
     writer_a.writerow(first_row_a)
     
@@ -204,6 +220,9 @@ def create_sheet3_csv(wp_y_irrigated_dictionary, wp_y_rainfed_dictionary, wp_y_n
                     writer_b.writerow(["NON-CROP","IRRIGATED","Total yield",TYPE,SUBTYPE,"nan","nan"])
     
     csv_file_b.close()
+    becgis.replace_file(becgis.temp_filehandle(output_csv_fh_b), output_csv_fh_b)
+    csv_file_a.close()
+    becgis.replace_file(becgis.temp_filehandle(output_csv_fh_a), output_csv_fh_a)
     
     return output_csv_fh_a, output_csv_fh_b
 
@@ -235,7 +254,7 @@ def calc_Y_WP_year(csv_fh, output_dir, croptype):
     years = np.unique(np.array([date.year for date in np.append(start_dates, end_dates)]))
     
     csv_filename = os.path.join(output_dir, r'Yearly_'+ os.path.basename(csv_fh))
-    csv_file = open(csv_filename, 'w')
+    csv_file = open(becgis.temp_filehandle(csv_filename), 'w')
     writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n')
     writer.writerow(["Startdate", "Enddate", "Yield [kg/ha]", "Yield_pr [kg/ha]", "Yield_irr [kg/ha]", "WP [kg/m3]", "WP_blue [kg/m3]", "WP_green [kg/m3]", "WC [km3]", "WC_blue [km3]", "WC_green [km3]"])
     
@@ -269,6 +288,7 @@ def calc_Y_WP_year(csv_fh, output_dir, croptype):
         writer.writerow([datetime.date(year,1,1), datetime.date(year,12,31), y, ypr, yirr, wp, wpblue, wpgreen, wc, wcblue, wcgreen])
     
     csv_file.close()
+    becgis.replace_file(becgis.temp_filehandle(csv_filename), csv_filename)
     
     return csv_filename
 
@@ -374,7 +394,7 @@ def read_csv(csv_fh):
 
     return start_dates, end_dates, Y, Yirr, Ypr, WP, WPblue, WPgreen, WC, WC_blue, WC_green
     
-def calc_Y_WP_seasons(start_dates, end_dates, lu_fh, lu_class, croptype, etgreen_fhs, etgreen_dates, etblue_fhs, etblue_dates, ndm_fhs, ndm_dates, p_fhs, p_dates, output_dir, HIWC_dict, ab = (1.0,1.0)):
+def calc_Y_WP_seasons(start_dates, end_dates, lu_fh, lu_class, croptype, etgreen_fhs, etgreen_dates, etblue_fhs, etblue_dates, ndm_fhs, ndm_dates, p_fhs, p_dates, output_dir, HIWC_dict, ab = (1.0,1.0), layer = None):
     """
     Calculate Yields and WPs per season and save results in a csv-file.
     
@@ -412,26 +432,36 @@ def calc_Y_WP_seasons(start_dates, end_dates, lu_fh, lu_class, croptype, etgreen
         Dictionary with Harvest indices and Water Contents, see get_dictionaries.get_hi_and_ec().
     ab : tuple, optional
         Two parameters used to split Yield into irrigation and precipitation yield, see split_Yield.
+    layer : dict, optional
+        Monthly data of the crop pixels, see crop_data_layer. Default is None,
+        in which case it is created for lu_class.
         
     Returns
     -------
     csv_filename : str
         Path to newly created csv-file.        
     """
+    if layer is None:
+        layer = crop_data_layer(lu_fh, [lu_class], (etgreen_fhs, etgreen_dates), (etblue_fhs, etblue_dates),
+                                (ndm_fhs, ndm_dates), (p_fhs, p_dates), (start_dates, end_dates))
+    
+
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)    
     
     csv_filename = os.path.join(output_dir, 'Yields_WPs_{0}_{1}.csv'.format(croptype, int(lu_class)))
-    csv_file = open(csv_filename, 'w')
+    csv_file = open(becgis.temp_filehandle(csv_filename), 'w')
     writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n' )
     
     writer.writerow(["Startdate", "Enddate", "Yield [kg/ha]", "Yield_pr [kg/ha]", "Yield_irr [kg/ha]", "WP [kg/m3]", "WP_blue [kg/m3]", "WP_green [kg/m3]", "WC [km3]", "WC_blue [km3]", "WC_green [km3]"])
-    for startdate, enddate in zip(start_dates, end_dates):
-        Yield, Yield_pr, Yield_irr, Wp, Wp_blue, Wp_green, Wc, Wc_blue, Wc_green = calc_Y_WP_season(startdate, enddate, lu_fh, lu_class, croptype, etgreen_fhs, etgreen_dates, etblue_fhs, etblue_dates, ndm_fhs, ndm_dates, p_fhs, p_dates, HIWC_dict, ab = ab, output_dir = output_dir)
+    results = calc_Y_WP_layer(start_dates, end_dates, layer, lu_class, croptype, HIWC_dict, ab = ab, output_dir = output_dir)
+    for startdate, enddate, result in zip(start_dates, end_dates, results):
+        Yield, Yield_pr, Yield_irr, Wp, Wp_blue, Wp_green, Wc, Wc_blue, Wc_green = result
         
         writer.writerow([startdate, enddate, Yield, Yield_pr, Yield_irr, Wp, Wp_blue, Wp_green, Wc, Wc_blue, Wc_green])
     
     csv_file.close()
+    becgis.replace_file(becgis.temp_filehandle(csv_filename), csv_filename)
     return csv_filename
 
 def split_Yield(pfraction, etbfraction, a, b):
@@ -519,11 +549,28 @@ def calc_Y_WP_season(startdate, enddate, lu_fh, lu_class, croptype, etgreen_fhs,
     Wc_green : float
         The green water consumption for the croptype.
     """
-    common_dates = becgis.common_dates([etblue_dates, etgreen_dates, p_dates, ndm_dates])
+    layer = crop_data_layer(lu_fh, [lu_class], (etgreen_fhs, etgreen_dates), (etblue_fhs, etblue_dates),
+                            (ndm_fhs, ndm_dates), (p_fhs, p_dates), ([startdate], [enddate]),
+                            dates = season_months(startdate, enddate))
     
-    harvest_index = HIWC_dict[croptype][0]  
-    moisture_content = HIWC_dict[croptype][1]
+    return calc_Y_WP_layer([startdate], [enddate], layer, lu_class, croptype, HIWC_dict, ab = ab, output_dir = output_dir)[0]
+
+def season_months(startdate, enddate):
+    """
+    List the months of a growing season.
     
+    Parameters
+    ----------
+    startdate : object
+        datetime.date object specifying the startdate of the growing season.
+    enddate : object
+        datetime.date object specifying the enddate of the growing season.
+        
+    Returns
+    -------
+    req_dates : ndarray
+        Array with a datetime.date object for the first day of each month.
+    """
     current = datetime.date(startdate.year, startdate.month, 1)
     end_month = datetime.date(enddate.year, enddate.month, 1)
     
@@ -531,40 +578,198 @@ def calc_Y_WP_season(startdate, enddate, lu_fh, lu_class, croptype, etgreen_fhs,
     while current < end_month:
         current = current + relativedelta(months = 1)
         req_dates = np.append(req_dates, current)
+    return req_dates
+
+def season_fractions(start_dates, end_dates, dates, verbose = True):
+    """
+    Create a matrix with the fraction of each month that falls within each
+    growing season, so that seasonal totals can be calculated from monthly
+    values with a matrix product.
     
-    season_complete = True
-    for date in req_dates:
-        season_complete = np.all([season_complete, date in common_dates])
-        if not season_complete:
-            print("{0} missing in input data, skipping this season".format(date))
-            
-    if season_complete:
+    Parameters
+    ----------
+    start_dates : ndarray
+        Array with datetime.date objects specifying the startdates of the growing seasons.
+    end_dates : ndarray
+        Array with datetime.date objects specifying the enddates of the growing seasons.
+    dates : ndarray
+        Array with datetime.date objects of the available months.
+    verbose : boolean, optional
+        Print the seasons that are skipped, default is True.
+        
+    Returns
+    -------
+    fractions : ndarray
+        Array (seasons x months) with the fractions.
+    complete : ndarray
+        Boolean array indicating for each season if all its months are available.
+    """
+    positions = dict(((date.year, date.month), j) for j, date in enumerate(dates))
+    fractions = np.zeros((len(start_dates), len(dates)))
+    complete = np.ones(len(start_dates), dtype = bool)
     
-        fractions = np.ones(np.shape(req_dates))
+    for k, (startdate, enddate) in enumerate(zip(start_dates, end_dates)):
+        req_dates = season_months(startdate, enddate)
+        
+        missing = [date for date in req_dates if (date.year, date.month) not in positions]
+        if missing:
+            if verbose:
+                print("{0} missing in input data, skipping this season".format(missing[0]))
+            complete[k] = False
+            continue
+        
+        season = np.ones(np.shape(req_dates))
         
         start_month_length = float(calendar.monthrange(startdate.year, startdate.month)[1])
         end_month_length = float(calendar.monthrange(enddate.year, enddate.month)[1])
         
-        fractions[0] = (start_month_length - startdate.day + 1) / start_month_length
-        fractions[-1] = (enddate.day -1) / end_month_length
+        season[0] = (start_month_length - startdate.day + 1) / start_month_length
+        season[-1] = (enddate.day -1) / end_month_length
         
-        NDMs = np.stack([becgis.open_as_array(ndm_fhs[ndm_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
-        NDM = np.nansum(NDMs, axis=2)
-        del NDMs
+        for date, fraction in zip(req_dates, season):
+            fractions[k, positions[(date.year, date.month)]] = fraction
+            
+    return fractions, complete
+
+def crop_data_layer(lu_fh, lu_classes, etgreen, etblue, ndm, p, seasons, dates = None):
+    """
+    Read the monthly ETgreen, ETblue, NDM and P maps once and keep only the
+    pixels of the crop landuse classes, so that seasonal totals of all crops
+    and seasons can be calculated without reading the maps again. While
+    reading the P maps, the seasonal P is summed over the whole map to find
+    its maximum for each growing season.
+    
+    Parameters
+    ----------
+    lu_fh : str
+        Landuse map.
+    lu_classes : list
+        Landuseclasses of the crops.
+    etgreen : tuple
+        Tuple with an array of ETgreen maps and an array with their dates.
+    etblue : tuple
+        Tuple with an array of ETblue maps and an array with their dates.
+    ndm : tuple
+        Tuple with an array of Net-Dry-Matter maps and an array with their dates.
+    p : tuple
+        Tuple with an array of P maps and an array with their dates.
+    seasons : tuple
+        Tuple with an array of startdates and an array of enddates of the
+        growing seasons of all crops.
+    dates : ndarray, optional
+        Only read the maps of these months, default is None (all common months).
         
-        ETGREENs = np.stack([becgis.open_as_array(etgreen_fhs[etgreen_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
-        ETGREEN = np.nansum(ETGREENs, axis=2)
-        del ETGREENs
+    Returns
+    -------
+    layer : dict
+        Dictionary with the 'dates', the 'lulc' and 'areas' of the crop
+        pixels, arrays (months x pixels) with the values of the crop pixels
+        for 'etg', 'etb', 'ndm' and 'p' (missing values are zero), and the
+        maximum seasonal P on the whole map per (startdate, enddate) of each
+        complete growing season ('p_max').
+    """
+    LULC = becgis.open_as_array(lu_fh, nan_values = True, cache = True)
+    pixels = (np.where(np.isin(LULC.ravel(), lu_classes))[0], LULC.shape)
+    
+    common_dates = becgis.common_dates([etblue[1], etgreen[1], p[1], ndm[1]])
+    if dates is not None:
+        common_dates = becgis.common_dates([common_dates, dates])
+    
+    layer = {'dates': common_dates,
+             'lulc': becgis.gather_pixels(LULC, pixels),
+             'areas': becgis.gather_pixels(becgis.map_pixel_area_km(lu_fh, per_row = True), pixels),
+             'p_max': dict()}
+    
+    for name, (fhs, fh_dates) in [('etg', etgreen), ('etb', etblue), ('ndm', ndm)]:
+        series = becgis.TimeSeriesCatalog(fhs, fh_dates)
+        DATA = np.zeros((len(common_dates), pixels[0].size))
+        for j, date in enumerate(common_dates):
+            DATA[j] = becgis.open_as_vector(series.get(date), pixels)
+        DATA[np.isnan(DATA)] = 0.0
+        layer[name] = DATA
+    
+    # Sum the P maps of each season while they are read, a season is
+    # finished (and its sum dropped) after its last month.
+    seasons = sorted(set(zip(*seasons)))
+    starts = [season[0] for season in seasons]
+    ends = [season[1] for season in seasons]
+    fractions, complete = season_fractions(starts, ends, common_dates, verbose = False)
+    fractions[~complete] = 0.0
+    last_month = dict((k, np.flatnonzero(fractions[k])[-1]) for k in np.flatnonzero(np.any(fractions, axis = 1)))
+    
+    series = becgis.TimeSeriesCatalog(*p)
+    DATA = np.zeros((len(common_dates), pixels[0].size))
+    P_MAPS = dict()
+    for j, date in enumerate(common_dates):
+        P_MONTH = becgis.open_as_array(series.get(date), nan_values = True)
+        DATA[j] = becgis.gather_pixels(P_MONTH, pixels)
+        P_MONTH = np.where(np.isnan(P_MONTH), 0.0, P_MONTH)
+        for k in np.flatnonzero(fractions[:, j]):
+            P_MAPS[k] = P_MAPS.get(k, 0.0) + P_MONTH * fractions[k, j]
+            if last_month[k] == j:
+                layer['p_max'][(starts[k], ends[k])] = np.nanmax(P_MAPS.pop(k))
+    DATA[np.isnan(DATA)] = 0.0
+    layer['p'] = DATA
+    
+    return layer
+
+def calc_Y_WP_layer(start_dates, end_dates, layer, lu_class, croptype, HIWC_dict, ab = (1.0,1.0), output_dir = None):
+    """
+    Calculate Yields and WPs for several seasons from the monthly data of the
+    crop pixels.
+    
+    Parameters
+    ----------
+    start_dates : ndarray
+        Array with datetime.date objects specifying the startdates of the growing seasons.
+    end_dates : ndarray
+        Array with datetime.date objects specifying the enddates of the growing seasons.
+    layer : dict
+        Monthly data of the crop pixels, see crop_data_layer.
+    lu_class : int
+        Landuseclass for which to calculate Y and WP.
+    croptype : str
+        Name of croptype, should be present in HIWC_dict.keys().
+    HIWC_dict : dict
+        Dictionary with Harvest indices and Water Contents, see get_dictionaries.get_hi_and_ec().
+    ab : tuple, optional
+        Two parameters used to split Yield into irrigation and precipitation yield, see split_Yield.
+    output_dir : str, optional
+        Folder to save results.
         
-        ETBLUEs = np.stack([becgis.open_as_array(etblue_fhs[etblue_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
-        ETBLUE = np.nansum(ETBLUEs, axis=2)
-        del ETBLUEs
+    Returns
+    -------
+    results : list
+        List with for each season a tuple with the Yield, Yield_pr, Yield_irr,
+        Wp, Wp_blue, Wp_green, Wc, Wc_blue and Wc_green, see calc_Y_WP_season.
+    """
+    harvest_index = HIWC_dict[croptype][0]  
+    moisture_content = HIWC_dict[croptype][1]
+    
+    fractions, complete = season_fractions(start_dates, end_dates, layer['dates'])
+    
+    # Calculate the seasonal totals of all seasons at once.
+    NDMs, ETGREENs, ETBLUEs, Ps = [np.dot(fractions, layer[name]) for name in ['ndm', 'etg', 'etb', 'p']]
+    
+    LULC = layer['lulc']
+    areas = layer['areas']
+    
+    results = list()
+    for k, (startdate, enddate) in enumerate(zip(start_dates, end_dates)):
         
-        Ps = np.stack([becgis.open_as_array(p_fhs[p_dates == date][0], nan_values = True) * fraction for date, fraction in zip(req_dates, fractions)], axis=2)
-        P = np.nansum(Ps, axis=2)
-        del Ps
+        if not complete[k]:
+            results.append((np.nan,) * 9)
+            continue
         
-        LULC = becgis.open_as_array(lu_fh)
+        req_dates = season_months(startdate, enddate)
+        
+        NDM = NDMs[k]
+        ETGREEN = ETGREENs[k]
+        ETBLUE = ETBLUEs[k]
+        P = Ps[k]
+        
+        # The precipitation is normalized with its maximum on the whole map.
+        P_MAX = layer['p_max'][(startdate, enddate)]
         
         NDM[NDM == 0] = np.nan
         NDM[LULC != lu_class] = ETBLUE[LULC != lu_class] = ETGREEN[LULC != lu_class] =  np.nan
@@ -572,7 +777,7 @@ def calc_Y_WP_season(startdate, enddate, lu_fh, lu_class, croptype, etgreen_fhs,
         Y = (harvest_index * NDM) / (1 - moisture_content)
         
         etbfraction = ETBLUE / (ETBLUE + ETGREEN)
-        pfraction = P / np.nanmax(P)
+        pfraction = P / P_MAX
         fraction = split_Yield(pfraction, etbfraction, ab[0], ab[1])
         
         Yirr = Y * fraction
@@ -604,23 +809,19 @@ def calc_Y_WP_season(startdate, enddate, lu_fh, lu_class, croptype, etgreen_fhs,
         Et_blue = np.nanmean(ETBLUE)
         Et_green = np.nanmean(ETGREEN)
         
-        areas = becgis.map_pixel_area_km(lu_fh)
         Wc_blue = np.nansum(ETBLUE / 1000**2 * areas)
         Wc_green = np.nansum(ETGREEN / 1000**2 * areas)
         Wc = Wc_blue + Wc_green
         
-        areas[LULC != lu_class] = np.nan
-        print('{0}: {1} km2'.format(croptype, np.nansum(areas)))
+        print('{0}: {1} km2'.format(croptype, np.nansum(np.where(LULC == lu_class, areas, np.nan))))
         
         Wp = Yield / ((Et_blue + Et_green) * 10)
         Wp_blue = np.where(Et_blue == 0, [np.nan], [Yield_irr / (Et_blue * 10)])[0]
         Wp_green = np.where(Et_green == 0, [np.nan], [Yield_pr / (Et_green * 10)])[0]
         
-    else:
-        
-        Yield = Yield_pr = Yield_irr = Wp = Wp_blue = Wp_green = Wc = Wc_blue = Wc_green = np.nan
+        results.append((Yield, Yield_pr, Yield_irr, Wp, Wp_blue, Wp_green, Wc, Wc_blue, Wc_green))
         
-    return Yield, Yield_pr, Yield_irr, Wp, Wp_blue, Wp_green, Wc, Wc_blue, Wc_green
+    return results
 
 def plot_Y_WP(csv_fh, output_dir, croptype = None, catchment_name = None, filetype = 'png'):
     """
@@ -1442,12 +1643,12 @@ def create_sheet3_png(basin, period, units, data, output, template=False):
     # Export svg to png
     tempout_path = output[0].replace('.pdf', '_temporary.svg')
     tree1.write(tempout_path)    
-    cairosvg.svg2pdf(url=tempout_path, write_to=output[0])    
+    becgis.svg_to_pdf(tempout_path, output[0])
     os.remove(tempout_path)
     
     tempout_path = output[1].replace('.pdf', '_temporary.svg')
     tree2.write(tempout_path)    
-    cairosvg.svg2pdf(url=tempout_path, write_to=output[1])    
+    becgis.svg_to_pdf(tempout_path, output[1])
     os.remove(tempout_path)
 
     return output
@@ -19,27 +19,31 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import xml.etree.ElementTree as ET
-import cairosvg
 
 import WA_Hyperloop.becgis as becgis
 from WA_Hyperloop import hyperloop as hl
 import WA_Hyperloop.get_dictionaries as gd
 from WA_Hyperloop.paths import get_path
 from WA_Hyperloop.grace_tr_correction import correct_var
+from WA_Hyperloop import pipeline
 
-def sw_ret_wpix(non_consumed_dsro, non_consumed_dperc, lu, ouput_dir_ret_frac):
-    DSRO = becgis.open_as_array(non_consumed_dsro, nan_values = True)
-    DPERC = becgis.open_as_array(non_consumed_dperc, nan_values = True)
+def sw_return_fraction(DSRO, DPERC):
     DSRO[np.isnan(DSRO)] = 0
     DPERC[np.isnan(DPERC)] = 0
-    LU = becgis.open_as_array(lu, nan_values = True)
     DTOT = DSRO + DPERC
-    SWRETFRAC = LU * 0
+    SWRETFRAC = np.zeros(np.shape(DTOT), dtype = DTOT.dtype)
     SWRETFRAC[DTOT > 0] = (DSRO/(DTOT))[DTOT > 0]
+    return SWRETFRAC
+
+def sw_ret_wpix(non_consumed_dsro, non_consumed_dperc, lu, ouput_dir_ret_frac):
+    pixels = becgis.basin_pixels(lu)
+    DSRO = becgis.open_as_vector(non_consumed_dsro, pixels)
+    DPERC = becgis.open_as_vector(non_consumed_dperc, pixels)
+    SWRETFRAC = sw_return_fraction(DSRO, DPERC)
     
     geo_info = becgis.get_geoinfo(non_consumed_dsro)
     fh = os.path.join(ouput_dir_ret_frac, 'sw_return_fraction' + os.path.basename(non_consumed_dsro)[-13:])
-    becgis.create_geotiff(fh, SWRETFRAC, *geo_info)
+    becgis.create_geotiff(fh, becgis.scatter_pixels(SWRETFRAC, pixels), *geo_info)
     return fh    
 
 def multiply_raster_by_c(sw_supply_fraction_tif, alpha):
@@ -90,20 +94,25 @@ def calc_recharge(perc, dperc):
     output_folder2.insert(1, os.path.sep)
     output_folder2 = os.path.join(*output_folder2)
     
-    rchrg = becgis.average_series(diff[0], diff[1], 1, 
-                                 output_folder2, para_name = 'rchrg')
+    rchrg = becgis.TimeSeriesCatalog(*becgis.average_series(diff[0], diff[1], 1, 
+                                 output_folder2, para_name = 'rchrg'))
 #    shutil.rmtree(output_folder1)
     
     return rchrg
 
-def create_gw_supply(metadata, complete_data, output_dir):
+def create_gw_supply(metadata, complete_data, output_dir, dates = None):
     
     common_dates = becgis.common_dates([complete_data['supply_total'][1], complete_data['supply_sw'][1],
                                         complete_data['p'][1]])
-    for date in common_dates:
+
+    folder = os.path.join(output_dir, 'data', 'supply_gw')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    for date in common_dates[becgis.in_selection(common_dates, dates)]:
         
-        total_supply_tif = complete_data['supply_total'][0][complete_data['supply_total'][1] == date][0]
-        supply_sw_tif = complete_data['supply_sw'][0][complete_data['supply_sw'][1] == date][0]
+        total_supply_tif = complete_data['supply_total'].get(date)
+        supply_sw_tif = complete_data['supply_sw'].get(date)
         
         SUP = becgis.open_as_array(total_supply_tif, nan_values = True)
         SW = becgis.open_as_array(supply_sw_tif, nan_values = True)
@@ -111,21 +120,17 @@ def create_gw_supply(metadata, complete_data, output_dir):
         GW = SUP - SW
         
         geo_info = becgis.get_geoinfo(supply_sw_tif)
-        
-        folder = os.path.join(output_dir, 'data', 'supply_gw')
-        if not os.path.exists(folder):
-            os.makedirs(folder)
 
         supply_gw_tif = os.path.join(folder, 'supply_gw_{0}{1}.tif'.format(date.year, str(date.month).zfill(2)))
         
         becgis.create_geotiff(supply_gw_tif, GW, *geo_info)
         
-    meta = becgis.sort_files(folder, [-10,-6], month_position = [-6,-4])[0:2]
+    meta = becgis.TimeSeriesCatalog(*becgis.sort_files(folder, [-10,-6], month_position = [-6,-4])[0:2])
     
     return meta
    
     
-def create_sheet4_6(complete_data, metadata, output_dir, global_data):
+def create_sheet4_6(complete_data, metadata, output_dir, global_data, dates = None):
 
     output_dir = os.path.join(output_dir, metadata['name'])
     if not os.path.exists(output_dir):
@@ -162,6 +167,7 @@ def create_sheet4_6(complete_data, metadata, output_dir, global_data):
                                        complete_data['etref'][1],
                                        complete_data['p'][1],
                                        complete_data['bf'][1]])
+    selected = becgis.in_selection(common_dates, dates)
 
     other_consumed_tif = None
     non_conventional_et_tif = None
@@ -177,12 +183,14 @@ def create_sheet4_6(complete_data, metadata, output_dir, global_data):
         becgis.create_geotiff(sw_supply_fraction_tif, mask, driver, NDV, xsize, ysize, GeoT, Projection)
         
     for date in common_dates:
-        conventional_et_tif = complete_data['etb'][0][complete_data['etb'][1] == date][0]
+        conventional_et_tif = complete_data['etb'].get(date)
         ###
         # Calculate supply and split into GW and SW supply
         ###
-        total_supply_tif = complete_data['supply_total'][0][complete_data['supply_total'][1] == date][0]
-        if lu_based_supply_split:
+        total_supply_tif = complete_data['supply_total'].get(date)
+        if lu_based_supply_split and not becgis.in_selection([date], dates)[0]:
+            supply_swa = np.append(supply_swa, flow_fh(os.path.join(output_dir, 'data'), date, 'supply_swa'))
+        elif lu_based_supply_split:
             supply_sw_tif, supply_gw_tif = split_flows(total_supply_tif, sw_supply_fraction_tif, 
                                                        os.path.join(output_dir, 'data'), date, 
                                                        flow_names = ['supply_swa','supply_gw'])
@@ -191,7 +199,7 @@ def create_sheet4_6(complete_data, metadata, output_dir, global_data):
             supply_swa = np.append(supply_swa, supply_sw_tif)
         else:
             supply_swa = np.append(supply_swa, total_supply_tif)
-        complete_data['supply_swa'] = (supply_swa, common_dates)
+        complete_data['supply_swa'] = becgis.TimeSeriesCatalog(supply_swa, common_dates)
     
     # Correct sw/gw split to match with GRACE storage
     if grace_supply_split: 
@@ -199,148 +207,209 @@ def create_sheet4_6(complete_data, metadata, output_dir, global_data):
         assert np.all(inp[0] < inp[1]), "invalid bounds"
         bounds = (np.clip(inp[0], [0.,0.,0.], [1.,1.,12.]), np.clip(inp[1], [0.,0.,0.], [1.,1.,12.]))
 
+        refit = grace_refit_required(metadata, common_dates, dates)
         a, complete_data['supply_sw'] = correct_var(metadata, complete_data,
                         os.path.split(output_dir)[0], 'p-et-tr+supply_swa',
-                        'supply_sw', slope = True,  bounds = bounds)
+                        'supply_sw', slope = True,  bounds = bounds,
+                        dates = dates, refit = refit)
 
         print('-----> alpha = {0}, beta = {1}, theta = {2}'.format(a[0], a[1], a[2]))
+        
+        # A new fit changes the surface water supply of all months, so all
+        # months (and years) are computed again.
+        if refit and dates is not None:
+            dates = None
+            pipeline.reset_checkpoints()
 
         # multiply_raster_by_c(sw_supply_fraction_tif, a[0]) #claire - update sw_fraction_tif
     else: 
         complete_data['supply_sw'] = complete_data['supply_swa']
         
-    complete_data['supply_gw'] = create_gw_supply(metadata, complete_data, output_dir)
+    complete_data['supply_gw'] = create_gw_supply(metadata, complete_data, output_dir, dates = dates)
     
 #    complete_data = bf_reduction_with_gwsup(metadata, complete_data)
     
-    for date in common_dates:    
-        total_supply_tif = complete_data['supply_total'][0][complete_data['supply_total'][1] == date][0]
-        supply_sw_tif = complete_data['supply_sw'][0][complete_data['supply_sw'][1] == date][0]
-        supply_gw_tif = complete_data['supply_gw'][0][complete_data['supply_gw'][1] == date][0]
-        conventional_et_tif = complete_data['etb'][0][complete_data['etb'][1] == date][0]
-
-        non_consumed_dsro = complete_data['dro'][0][complete_data['dro'][1] == date][0] 
-        non_consumed_dperc = complete_data['dperc'][0][complete_data['dperc'][1] == date][0]     
-        ouput_dir_ret_frac = os.path.join(output_dir,'data','return_fractions')
-        if not os.path.exists(ouput_dir_ret_frac):
-            os.makedirs(ouput_dir_ret_frac)
-        sw_return_fraction_tif = sw_ret_wpix(non_consumed_dsro, non_consumed_dperc, metadata['lu'], ouput_dir_ret_frac)
-
-        ###
-        # Calculate non-consumed supplies per source
-        ###
-        non_consumed_tif = calc_delta_flow(total_supply_tif, conventional_et_tif, output_dir, date)
-        non_consumed_sw_tif, non_consumed_gw_tif = split_flows(non_consumed_tif, sw_supply_fraction_tif, output_dir, date, flow_names = ['NONCONSUMEDsw', 'NONCONSUMEDgw'])
-
-        ###
-        # Calculate (non-)recoverable return flows per source
-        ###
-        non_recov_tif, recov_tif = split_flows(non_consumed_tif, non_recov_fraction_tif, output_dir, date, flow_names = ['NONRECOV', 'RECOV'])
-        recov_sw_tif, recov_gw_tif = split_flows(recov_tif, sw_return_fraction_tif, output_dir, date, flow_names = ['RECOVsw', 'RECOVgw'])
-        non_recov_sw_tif, non_recov_gw_tif = split_flows(non_recov_tif, sw_return_fraction_tif, output_dir, date, flow_names = ['NONRECOVsw', 'NONRECOVgw'])
+    pixels = becgis.basin_pixels(metadata['lu'])
+    LULC = becgis.gather_zones(metadata['lu'], pixels)
+    AREA = becgis.gather_pixels(becgis.map_pixel_area_km(metadata['lu'], per_row = True), pixels)
+    SW_SUPPLY_FRACTION = becgis.open_as_vector(sw_supply_fraction_tif, pixels)
+    NON_RECOV_FRACTION = becgis.open_as_vector(non_recov_fraction_tif, pixels)
+
+    # Create the monthly sheets in parallel (see becgis.set_month_processes).
+    population_tif = global_data["population_tif"] if "population_tif" in list(global_data.keys()) else None
+    context = {'lu': metadata['lu'], 'name': metadata['name'], 'pixels': pixels, 'LULC': LULC, 'AREA': AREA, 
+               'AREAS': AREAS, 'SW_SUPPLY_FRACTION': SW_SUPPLY_FRACTION, 'NON_RECOV_FRACTION': NON_RECOV_FRACTION, 
+               'lucs': lucs, 'population_tif': population_tif, 'other_consumed_tif': other_consumed_tif, 
+               'non_conventional_et_tif': non_conventional_et_tif, 'output_dir': output_dir, 
+               'output_dir2': output_dir2, 'output_dir3': output_dir3}
+    keys = ['supply_total', 'supply_sw', 'supply_gw', 'etb', 'dro', 'dperc', 'lai', 'etref', 'p', 'bf', 'recharge']
+    pending = pipeline.pending_months(common_dates, dates)
+    tasks = [(date, dict([(key, complete_data[key].get(date)) for key in keys])) for date in common_dates[pending]]
+    return_flow_tifs = dict()
+    for date, tifs in zip(common_dates[pending], becgis.map_months(_sheet4_6_month, tasks, context)):
+        return_flow_tifs[date] = tifs
+        pipeline.checkpoint(date, tifs)
+        print("sheet 4 and 6 finished for {0} (going to {1})".format(date, common_dates[-1]))
 
-        ###
-        # Caculate return flows to gw and sw
-        ###
-        return_flow_sw_sw_tif, return_flow_sw_gw_tif = split_flows(non_consumed_sw_tif, sw_return_fraction_tif, os.path.join(output_dir, 'data'), date, flow_names = ['return_swsw', 'return_swgw'])
-        return_flow_gw_sw_tif, return_flow_gw_gw_tif = split_flows(non_consumed_gw_tif, sw_return_fraction_tif, os.path.join(output_dir, 'data'), date, flow_names = ['return_gwsw', 'return_gwgw'])
-
-        ###
-        # Calculate the blue water demand
-        ###
-        demand_tif = calc_demand(complete_data['lai'][0][complete_data['lai'][1] == date][0], complete_data['etref'][0][complete_data['etref'][1] == date][0], complete_data['p'][0][complete_data['p'][1] == date][0], metadata['lu'], date, os.path.join(output_dir, 'data'))
-        if "population_tif" in list(global_data.keys()):
-            population_tif = global_data["population_tif"]
-            residential_demand = include_residential_supply(population_tif, metadata['lu'], AREAS, total_supply_tif, date, lucs, 110, wcpc_minimal = 100)
-            becgis.set_classes_to_value(demand_tif, metadata['lu'], lucs['Residential'], value = residential_demand)
-
-        ###
-        # Create sheet 4
-        ###
-        entries_sh4 = {'SUPPLY_SURFACEWATER' : supply_sw_tif,
-                       'SUPPLY_GROUNDWATER' : supply_gw_tif,
-                       'CONSUMED_ET' : conventional_et_tif,
-                       'CONSUMED_OTHER' : other_consumed_tif,
-                       'NON_CONVENTIONAL_ET' : non_conventional_et_tif,
-                       'RECOVERABLE_SURFACEWATER' : recov_sw_tif,
-                       'RECOVERABLE_GROUNDWATER' : recov_gw_tif,
-                       'NON_RECOVERABLE_SURFACEWATER': non_recov_sw_tif,
-                       'NON_RECOVERABLE_GROUNDWATER': non_recov_gw_tif,
-                       'DEMAND': demand_tif}
-        
-        sheet4_csv =create_sheet4_csv(entries_sh4, metadata['lu'], AREAS, lucs, date, os.path.join(output_dir2, 'sheet4_monthly'), convert_unit = 1)
-        
-        create_sheet4(metadata['name'], '{0}-{1}'.format(date.year, str(date.month).zfill(2)), ['km3/month', 'km3/month'], [sheet4_csv, sheet4_csv], 
-                          [sheet4_csv.replace('.csv','_a.pdf'), sheet4_csv.replace('.csv','_b.pdf')], template = [get_path('sheet4_1_svg'), get_path('sheet4_2_svg')], smart_unit = True)
+    for date in common_dates:
+        if date not in return_flow_tifs:
+            # Month from an earlier run, its maps are still on disk.
+            return_flow_tifs[date] = tuple([flow_fh(os.path.join(output_dir, 'data'), date, flow_name) 
+                                            for flow_name in ['return_swsw', 'return_swgw', 'return_gwsw', 'return_gwgw']])
+        return_flow_sw_sw_tif, return_flow_sw_gw_tif, return_flow_gw_sw_tif, return_flow_gw_gw_tif = return_flow_tifs[date]
         
         return_flow_sw_sw = np.append(return_flow_sw_sw, return_flow_sw_sw_tif)
         return_flow_sw_gw = np.append(return_flow_sw_gw, return_flow_sw_gw_tif)
         return_flow_gw_sw = np.append(return_flow_gw_sw, return_flow_gw_sw_tif)
         return_flow_gw_gw = np.append(return_flow_gw_gw, return_flow_gw_gw_tif)
-        
-        print("sheet 4 finished for {0} (going to {1})".format(date, common_dates[-1]))
-        
-        recharge_tif = complete_data["recharge"][0][complete_data["recharge"][1] == date][0]
-        baseflow = accumulate_per_classes(metadata['lu'], AREAS, complete_data["bf"][0][complete_data["bf"][1] == date][0], list(range(1,81)), scale = 1e-6)
-        capillaryrise = 0.01 * accumulate_per_classes(metadata['lu'], AREAS, supply_gw_tif, list(range(1,81)), scale = 1e-6)
-
-        entries_sh6 = {'VERTICAL_RECHARGE': recharge_tif,
-                       'VERTICAL_GROUNDWATER_WITHDRAWALS': supply_gw_tif,
-                       'RETURN_FLOW_GROUNDWATER': return_flow_gw_gw_tif,
-                       'RETURN_FLOW_SURFACEWATER':return_flow_sw_gw_tif}
-
-        entries_2_sh6 = {'CapillaryRise': capillaryrise,
-                         'DeltaS': 'nan',
-                         'ManagedAquiferRecharge': 'nan',
-                         'Baseflow': baseflow,
-                         'GWInflow': 'nan',
-                         'GWOutflow': 'nan'}
     
-        sheet6_csv = create_sheet6_csv(entries_sh6, entries_2_sh6, metadata['lu'], AREAS, lucs, date, os.path.join(output_dir3,'sheet6_monthly'), convert_unit = 1)
-        
-        create_sheet6(metadata['name'], '{0}-{1}'.format(date.year, str(date.month).zfill(2)), 'km3/month', sheet6_csv, sheet6_csv.replace('.csv', '.pdf'), template = get_path('sheet6_svg'), smart_unit = True)
-        
-        print("sheet 6 finished")
+    years = None if dates is None else becgis.water_years(common_dates[selected], metadata['water_year_start_month'])
         
     csv4_folder = os.path.join(output_dir2, 'sheet4_monthly')
     csv4_yearly_folder = os.path.join(output_dir2, 'sheet4_yearly')
     sheet4_csv_yearly = hl.create_csv_yearly(csv4_folder, csv4_yearly_folder, 4, 
                                              metadata['water_year_start_month'], year_position = [-11,-7], month_position = [-6,-4],
-                                             header_rows = 1, header_columns = 1)
+                                             header_rows = 1, header_columns = 1, years = years)
     
     csv6_folder = os.path.join(output_dir3, 'sheet6_monthly')
     csv6_yearly_folder = os.path.join(output_dir3, 'sheet6_yearly')
-    csv6 = hl.create_csv_yearly(csv6_folder, csv6_yearly_folder, 6, metadata['water_year_start_month'], year_position = [-11,-7], month_position = [-6,-4], header_rows = 1, header_columns = 2)
+    csv6 = hl.create_csv_yearly(csv6_folder, csv6_yearly_folder, 6, metadata['water_year_start_month'], year_position = [-11,-7], month_position = [-6,-4], header_rows = 1, header_columns = 2, years = years)
     
     for csv_file in csv6:
         year = csv_file[-8:-4]
+        if pipeline.completed('sheet6 {0}'.format(year)):
+            continue
         create_sheet6(metadata['name'], year, 'km3/year', csv_file, csv_file.replace('.csv', '.pdf'), template = get_path('sheet6_svg'), smart_unit = True)
+        pipeline.checkpoint('sheet6 {0}'.format(year), [csv_file, csv_file.replace('.csv', '.pdf')])
     
     for cv in sheet4_csv_yearly:
         year = int(cv[-8:-4])
+        if pipeline.completed('sheet4 {0}'.format(year)):
+            continue
         create_sheet4(metadata['name'], '{0}'.format(year), ['km3/year', 'km3/year'], [cv, cv], 
                           [cv.replace('.csv','_a.pdf'), cv.replace('.csv','_b.pdf')], template = [get_path('sheet4_1_svg'), get_path('sheet4_2_svg')], smart_unit = True)
+        pipeline.checkpoint('sheet4 {0}'.format(year), [cv, cv.replace('.csv','_a.pdf'), cv.replace('.csv','_b.pdf')])
 
-    complete_data['return_flow_sw_sw'] = (return_flow_sw_sw, common_dates)
-    complete_data['return_flow_sw_gw'] = (return_flow_sw_gw, common_dates)
-    complete_data['return_flow_gw_sw'] = (return_flow_gw_sw, common_dates)
-    complete_data['return_flow_gw_gw'] = (return_flow_gw_gw, common_dates)
-    
-    ####
-    ## Remove some datasets
-    ####   
-    shutil.rmtree(os.path.split(non_consumed_tif)[0])
-    shutil.rmtree(os.path.split(non_consumed_sw_tif)[0])
-    shutil.rmtree(os.path.split(non_consumed_gw_tif)[0])
-    shutil.rmtree(os.path.split(non_recov_tif)[0])
-    shutil.rmtree(os.path.split(recov_tif)[0])
-    shutil.rmtree(os.path.split(non_recov_sw_tif)[0])
-    shutil.rmtree(os.path.split(non_recov_gw_tif)[0])
-    shutil.rmtree(os.path.split(recov_sw_tif)[0])
-    shutil.rmtree(os.path.split(recov_gw_tif)[0])
+    complete_data['return_flow_sw_sw'] = becgis.TimeSeriesCatalog(return_flow_sw_sw, common_dates)
+    complete_data['return_flow_sw_gw'] = becgis.TimeSeriesCatalog(return_flow_sw_gw, common_dates)
+    complete_data['return_flow_gw_sw'] = becgis.TimeSeriesCatalog(return_flow_gw_sw, common_dates)
+    complete_data['return_flow_gw_gw'] = becgis.TimeSeriesCatalog(return_flow_gw_gw, common_dates)
     
     return complete_data 
 
+def grace_refit_required(metadata, common_dates, dates):
+    """
+    Check if the GRACE supply correction needs to be fitted again, following
+    metadata['grace_refit']:
+        'always' : refit on every run (default).
+        'new_year' : refit when the new dates complete a water year.
+        'never' : only fit when no stored fit exists.
+    A run without a selection of dates always refits.
+    """
+    policy = metadata.get('grace_refit', 'always')
+    assert policy in ['always', 'new_year', 'never'], "invalid grace_refit policy"
+    if dates is None or policy == 'always':
+        return True
+    if policy == 'never':
+        return False
+    start_month = metadata['water_year_start_month']
+    new_years = becgis.water_years(common_dates[becgis.in_selection(common_dates, dates)], start_month)
+    all_years = [date.year - 1 if date.month < start_month else date.year for date in common_dates]
+    return any(all_years.count(year) == 12 for year in new_years)
+
+def _sheet4_6_month(context, task):
+    """
+    Calculate the return flows and create sheet 4 and 6 for one month, returns
+    the filehandles of the return flows.
+    """
+    date, fhs = task
+    pixels, LULC, AREA = context['pixels'], context['LULC'], context['AREA']
+    SW_SUPPLY_FRACTION, NON_RECOV_FRACTION = context['SW_SUPPLY_FRACTION'], context['NON_RECOV_FRACTION']
+    lucs, output_dir, output_dir2, output_dir3 = context['lucs'], context['output_dir'], context['output_dir2'], context['output_dir3']
+
+    total_supply_tif = fhs['supply_total']
+    supply_sw_tif = fhs['supply_sw']
+    supply_gw_tif = fhs['supply_gw']
+    conventional_et_tif = fhs['etb']
+
+    SUPPLY = becgis.open_as_vector(total_supply_tif, pixels)
+    CONSUMED = becgis.open_as_vector(conventional_et_tif, pixels)
+    SW_RETURN_FRACTION = sw_return_fraction(becgis.open_as_vector(fhs['dro'], pixels),
+                                            becgis.open_as_vector(fhs['dperc'], pixels))
+
+    ###
+    # Calculate non-consumed supplies per source
+    ###
+    NON_CONSUMED = SUPPLY - CONSUMED
+    NON_CONSUMED_SW = SW_SUPPLY_FRACTION * NON_CONSUMED
+    NON_CONSUMED_GW = (1. - SW_SUPPLY_FRACTION) * NON_CONSUMED
+
+    ###
+    # Calculate (non-)recoverable return flows per source
+    ###
+    NON_RECOV = NON_RECOV_FRACTION * NON_CONSUMED
+    RECOV = (1. - NON_RECOV_FRACTION) * NON_CONSUMED
+
+    ###
+    # Caculate return flows to gw and sw
+    ###
+    geo_info = becgis.get_geoinfo(total_supply_tif)
+    return_flow_sw_sw_tif = write_flow(SW_RETURN_FRACTION * NON_CONSUMED_SW, pixels, os.path.join(output_dir, 'data'), date, 'return_swsw', geo_info)
+    return_flow_sw_gw_tif = write_flow((1. - SW_RETURN_FRACTION) * NON_CONSUMED_SW, pixels, os.path.join(output_dir, 'data'), date, 'return_swgw', geo_info)
+    return_flow_gw_sw_tif = write_flow(SW_RETURN_FRACTION * NON_CONSUMED_GW, pixels, os.path.join(output_dir, 'data'), date, 'return_gwsw', geo_info)
+    return_flow_gw_gw_tif = write_flow((1. - SW_RETURN_FRACTION) * NON_CONSUMED_GW, pixels, os.path.join(output_dir, 'data'), date, 'return_gwgw', geo_info)
+
+    ###
+    # Calculate the blue water demand
+    ###
+    demand_tif = calc_demand(fhs['lai'], fhs['etref'], fhs['p'], context['lu'], date, os.path.join(output_dir, 'data'))
+    if context['population_tif'] is not None:
+        residential_demand = include_residential_supply(context['population_tif'], context['lu'], context['AREAS'], total_supply_tif, date, lucs, 110, wcpc_minimal = 100)
+        becgis.set_classes_to_value(demand_tif, context['lu'], lucs['Residential'], value = residential_demand)
+
+    ###
+    # Create sheet 4
+    ###
+    SUPPLY_SW = becgis.open_as_vector(supply_sw_tif, pixels)
+    SUPPLY_GW = becgis.open_as_vector(supply_gw_tif, pixels)
+
+    entries_sh4 = {'SUPPLY_SURFACEWATER' : SUPPLY_SW,
+                   'SUPPLY_GROUNDWATER' : SUPPLY_GW,
+                   'CONSUMED_ET' : CONSUMED,
+                   'CONSUMED_OTHER' : context['other_consumed_tif'],
+                   'NON_CONVENTIONAL_ET' : context['non_conventional_et_tif'],
+                   'RECOVERABLE_SURFACEWATER' : SW_RETURN_FRACTION * RECOV,
+                   'RECOVERABLE_GROUNDWATER' : (1. - SW_RETURN_FRACTION) * RECOV,
+                   'NON_RECOVERABLE_SURFACEWATER': SW_RETURN_FRACTION * NON_RECOV,
+                   'NON_RECOVERABLE_GROUNDWATER': (1. - SW_RETURN_FRACTION) * NON_RECOV,
+                   'DEMAND': becgis.open_as_vector(demand_tif, pixels)}
+    
+    sheet4_csv =create_sheet4_csv(entries_sh4, LULC, AREA, lucs, date, os.path.join(output_dir2, 'sheet4_monthly'), convert_unit = 1)
+    
+    create_sheet4(context['name'], '{0}-{1}'.format(date.year, str(date.month).zfill(2)), ['km3/month', 'km3/month'], [sheet4_csv, sheet4_csv], 
+                      [sheet4_csv.replace('.csv','_a.pdf'), sheet4_csv.replace('.csv','_b.pdf')], template = [get_path('sheet4_1_svg'), get_path('sheet4_2_svg')], smart_unit = True)
+    
+    baseflow = accumulate_per_classes(LULC, AREA, becgis.open_as_vector(fhs['bf'], pixels), list(range(1,81)), scale = 1e-6)
+    capillaryrise = 0.01 * accumulate_per_classes(LULC, AREA, SUPPLY_GW, list(range(1,81)), scale = 1e-6)
+
+    entries_sh6 = {'VERTICAL_RECHARGE': becgis.open_as_vector(fhs['recharge'], pixels),
+                   'VERTICAL_GROUNDWATER_WITHDRAWALS': SUPPLY_GW,
+                   'RETURN_FLOW_GROUNDWATER': (1. - SW_RETURN_FRACTION) * NON_CONSUMED_GW,
+                   'RETURN_FLOW_SURFACEWATER': (1. - SW_RETURN_FRACTION) * NON_CONSUMED_SW}
+
+    entries_2_sh6 = {'CapillaryRise': capillaryrise,
+                     'DeltaS': 'nan',
+                     'ManagedAquiferRecharge': 'nan',
+                     'Baseflow': baseflow,
+                     'GWInflow': 'nan',
+                     'GWOutflow': 'nan'}
+
+    sheet6_csv = create_sheet6_csv(entries_sh6, entries_2_sh6, LULC, AREA, lucs, date, os.path.join(output_dir3,'sheet6_monthly'), convert_unit = 1)
+    
+    create_sheet6(context['name'], '{0}-{1}'.format(date.year, str(date.month).zfill(2)), 'km3/month', sheet6_csv, sheet6_csv.replace('.csv', '.pdf'), template = get_path('sheet6_svg'), smart_unit = True)
+
+    return return_flow_sw_sw_tif, return_flow_sw_gw_tif, return_flow_gw_sw_tif, return_flow_gw_gw_tif
+
 def update_irrigation_fractions(lu_tif, fraction_tif, lucs, equiped_sw_irrigation_tif):
     """
     Update a fractions map used to split total supply into supply_sw and supply_gw with values for the irrigated
@@ -364,7 +433,7 @@ def update_irrigation_fractions(lu_tif, fraction_tif, lucs, equiped_sw_irrigatio
     """
     driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(fraction_tif)
     
-    sw_tif = becgis.match_proj_res_ndv(lu_tif, np.array([equiped_sw_irrigation_tif]), tf.mkdtemp())[0]
+    sw_tif = becgis.match_static_layer(equiped_sw_irrigation_tif, lu_tif)
     
     SW = becgis.open_as_array(sw_tif, nan_values = True) / 100
     LULC = becgis.open_as_array(lu_tif, nan_values = True)
@@ -403,7 +472,7 @@ def non_recoverable_fractions(lu_tif, wpl_tif, lucs, output_folder):
     """
     driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(lu_tif)
     
-    wpl_tif = becgis.match_proj_res_ndv(lu_tif, np.array([wpl_tif]), tf.mkdtemp())[0]
+    wpl_tif = becgis.match_static_layer(wpl_tif, lu_tif)
     
     WPL = becgis.open_as_array(wpl_tif, nan_values = True)
     LULC = becgis.open_as_array(lu_tif, nan_values = True)
@@ -516,12 +585,10 @@ def include_residential_supply(population_fh, lu_fh, AREAS, total_supply_fh, dat
         The accumulated minimal required water supply converted into [km3], only 
         returned if wcpc_minimal is not None.    
     """
-    temp_folder = tf.mkdtemp()
+    population_fh = becgis.match_static_layer(population_fh, lu_fh)
     
-    population_fh = becgis.match_proj_res_ndv(lu_fh, np.array([population_fh]), temp_folder)
-    
-    POP = becgis.open_as_array(population_fh[0], nan_values = True)
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
+    POP = becgis.open_as_array(population_fh, nan_values = True)
+    LULC = becgis.open_as_array(lu_fh, nan_values = True, cache = True)
     
     classes = sheet4_lucs['Residential']
     mask = np.logical_or.reduce([LULC == value for value in classes])
@@ -576,17 +643,15 @@ def accumulate_per_classes(lu_fh, AREAS, fh, classes, scale = 1e-6):
         The sum or mean (depending on scale) of the masked values in fh.
     
     """
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
-    mask = np.logical_or.reduce([LULC == value for value in classes])
     if np.any([type(fh) is str, type(fh) is np.string_, type(fh) is np.str_ ]):
         data = becgis.open_as_array(fh, nan_values = True)
     else:
         data = fh
         
     if scale == None:
-        accum = np.nanmean(data[mask])
+        accum = becgis.aggregate_per_categories(lu_fh, data, {'accum': classes}, statistic = 'mean')['accum']
     else:
-        accum = np.nansum(data[mask] * scale * AREAS[mask])
+        accum = becgis.aggregate_per_categories(lu_fh, data, {'accum': classes}, area = AREAS, scale = scale)['accum']
     return accum
 
 def accumulate_per_categories(lu_fh, AREAS, fh, dictionary, scale = 1e-6):
@@ -620,12 +685,15 @@ def accumulate_per_categories(lu_fh, AREAS, fh, dictionary, scale = 1e-6):
                       'Shrubland': [2, 12, 14, 15]}
     
     """
-    accumulated = dict()
-    for category in list(dictionary.keys()):
-        classes = dictionary[category]
-        if len(classes) == 0:
-            classes = [-99]
-        accumulated[category] = accumulate_per_classes(lu_fh, AREAS, fh, classes, scale = scale)
+    if np.any([type(fh) is str, type(fh) is np.string_, type(fh) is np.str_ ]):
+        data = becgis.open_as_array(fh, nan_values = True)
+    else:
+        data = fh
+    
+    if scale == None:
+        accumulated = becgis.aggregate_per_categories(lu_fh, data, dictionary, statistic = 'mean')
+    else:
+        accumulated = becgis.aggregate_per_categories(lu_fh, data, dictionary, area = AREAS, scale = scale)
     return accumulated
 
 def plot_per_category(fhs, dates, lu_fh, AREAS, dictionary, output_fh, scale = 1e-6, gradient_steepness = 2, quantity_unit = ['ET', 'mm/month']):
@@ -842,6 +910,61 @@ def split_flows(flow_fh, fraction_fh, output_folder, date, flow_names = ['sw','g
     return flow_one_fh, flow_two_fh
 
 
+def write_flow(FLOW, pixels, output_folder, date, flow_name, geo_info):
+    """
+    Save a flow calculated on the pixels inside the basin as a map, using
+    the same folder and filename as split_flows.
+    
+    Parameters
+    ----------
+    FLOW : ndarray
+        Values of the flow for the pixels inside the basin.
+    pixels : tuple
+        Pixels inside the basin, see becgis.basin_pixels.
+    output_folder : str
+        Folder to store results, the map is saved in a subfolder named flow_name.
+    date : object or str
+        Datetime.date object or str used to name the output file.
+    flow_name : str
+        Name of the flow.
+    geo_info : tuple
+        Geoinfo of the map, see becgis.get_geoinfo.
+        
+    Returns
+    -------
+    flow_fh : str
+        Filehandle pointing to the new map.
+    """
+    if not os.path.exists(os.path.join(output_folder, flow_name)):
+        os.makedirs(os.path.join(output_folder, flow_name))
+    fh = flow_fh(output_folder, date, flow_name)
+    becgis.create_geotiff(fh, becgis.scatter_pixels(FLOW, pixels), *geo_info)
+    return fh
+
+
+def flow_fh(output_folder, date, flow_name):
+    """
+    Filehandle of a flow map as written by split_flows and write_flow.
+    
+    Parameters
+    ----------
+    output_folder : str
+        Folder with a subfolder named flow_name.
+    date : object or str
+        Datetime.date object or str used to name the file.
+    flow_name : str
+        Name of the flow.
+        
+    Returns
+    -------
+    fh : str
+        Filehandle of the map.
+    """
+    if isinstance(date, datetime.date):
+        return os.path.join(output_folder, flow_name, '{0}_{1}{2}.tif'.format(flow_name, date.year, str(date.month).zfill(2)))
+    else:
+        return os.path.join(output_folder, flow_name, '{0}_{1}.tif'.format(flow_name, date))
+
 def insert_values(results, test, lu_category):
     """
     Insert values into dictionaries nested inside anther dictionary.
@@ -872,9 +995,10 @@ def create_results_dict(entries, lu_fh, AREAS, sheet4_lucs, aquaculture = None,
     Parameters
     ----------
     entries : dict
-        Dictionary with strings pointing to different tif-files, see example below.
-    lu_fh : str
-        Landusemap.
+        Dictionary with strings pointing to different tif-files or with arrays
+        that have the same shape as lu_fh, see example below.
+    lu_fh : str or tuple
+        Landusemap, or an encoded landusemap (see becgis.encode_classes).
     sheet4_lucs : dict
         Dictionary describing the sheet 4 and 6 landuse categories.
     aquaculture : dict
@@ -889,8 +1013,9 @@ def create_results_dict(entries, lu_fh, AREAS, sheet4_lucs, aquaculture = None,
     results : dict
         Dictionary with values to be saved by create_sheet4_csv in a csv-file.
     """
-    list_of_maps = [np.array(value) for value in list(entries.values()) if not np.any([value is None, type(value) is dict])]
-    becgis.assert_proj_res_ndv(list_of_maps)
+    list_of_maps = [np.array(value) for value in list(entries.values()) if not np.any([value is None, type(value) is dict, type(value) is np.ndarray])]
+    if list_of_maps:
+        becgis.assert_proj_res_ndv(list_of_maps)
     
     results = dict()
         
@@ -902,6 +1027,8 @@ def create_results_dict(entries, lu_fh, AREAS, sheet4_lucs, aquaculture = None,
             results[key] = null_dictionary
         if np.any([type(entries[key]) is str, type(entries[key]) is np.string_, type(entries[key]) is np.str_]):
             results[key] = accumulate_per_categories(lu_fh, AREAS, entries[key], sheet4_lucs, scale = 1e-6)
+        if type(entries[key]) is np.ndarray:
+            results[key] = accumulate_per_categories(lu_fh, AREAS, entries[key], sheet4_lucs, scale = 1e-6)
         if type(entries[key]) is dict:
             results[key] = entries[key]
     
@@ -973,7 +1100,7 @@ def create_sheet4_csv(entries, lu_fh, AREAS, sheet4_lucs, date, output_folder, a
                 
     first_row = ['LANDUSE_TYPE'] + list(results.keys())
     
-    csv_file = open(output_csv_fh, 'w')
+    csv_file = open(becgis.temp_filehandle(output_csv_fh), 'w')
     writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n')
     writer.writerow(first_row)
     
@@ -990,6 +1117,7 @@ def create_sheet4_csv(entries, lu_fh, AREAS, sheet4_lucs, date, output_folder, a
         writer.writerow([missing_lu_type, 'nan', 'nan', 'nan', 'nan', 'nan', 'nan', 'nan', 'nan', 'nan', 'nan'])
     
     csv_file.close()
+    becgis.replace_file(becgis.temp_filehandle(output_csv_fh), output_csv_fh)
     
     return output_csv_fh
 
@@ -1493,13 +1621,13 @@ def create_sheet4(basin, period, units, data, output, template=False, margin = 0
     if data[0] is not None:
         tempout_path = output[0].replace('.pdf', '_temporary.svg')
         tree1.write(tempout_path)
-        cairosvg.svg2pdf(url=tempout_path, write_to=output[0])
+        becgis.svg_to_pdf(tempout_path, output[0])
         os.remove(tempout_path)
        
     if data[1] is not None:
         tempout_path = output[1].replace('.pdf', '_temporary.svg')
         tree2.write(tempout_path)
-        cairosvg.svg2pdf(url=tempout_path, write_to=output[1])
+        becgis.svg_to_pdf(tempout_path, output[1])
         os.remove(tempout_path)
 
 def fractions(lu_fh, fractions, lucs, output_folder, filename = 'fractions.tif'):
@@ -1523,7 +1651,7 @@ def fractions(lu_fh, fractions, lucs, output_folder, filename = 'fractions.tif')
         Filehandle pointing to the map with fractions.
     """
     fraction_fh = os.path.join(output_folder, filename)
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
+    LULC = becgis.open_as_array(lu_fh, nan_values = True, cache = True)
     FRACTION = np.zeros(np.shape(LULC)) * np.nan
     driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(lu_fh)
     for key in list(fractions.keys()):
@@ -1631,7 +1759,7 @@ def create_sheet6_csv(entries, entries_2, lu_fh, AREAS, lucs, date, output_folde
                 
     first_row = ['TYPE', 'SUBTYPE', 'VALUE']
     
-    csv_file = open(output_csv_fh, 'w')
+    csv_file = open(becgis.temp_filehandle(output_csv_fh), 'w')
     writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n')
     writer.writerow(first_row)
     
@@ -1653,6 +1781,7 @@ def create_sheet6_csv(entries, entries_2, lu_fh, AREAS, lucs, date, output_folde
         writer.writerow(row)
             
     csv_file.close()
+    becgis.replace_file(becgis.temp_filehandle(output_csv_fh), output_csv_fh)
     
     return output_csv_fh
     
@@ -1837,7 +1966,7 @@ def create_sheet6(basin, period, unit, data, output, template=False, decimal = 1
     # Export svg to png    
     tempout_path = output.replace('.pdf', '_temporary.svg')
     tree1.write(tempout_path)    
-    cairosvg.svg2pdf(url=tempout_path, write_to=output)    
+    becgis.svg_to_pdf(tempout_path, output)
 #    os.remove(tempout_path)
 
 def plot_storages(ds_ts, bf_ts, cr_ts, vgw_ts, vr_ts, rfg_ts, rfs_ts, dates, output_folder, catchment_name, extension = 'png'):
@@ -1926,28 +2055,28 @@ def supply_return_natural_lu(metadata, complete_data):
                                       complete_data['dperc'][1], #,
                                       complete_data['tr'][1]])
     for date in common_dates:        
-        total_supply_tif = complete_data['supply_total'][0][complete_data['supply_total'][1] == date][0]
+        total_supply_tif = complete_data['supply_total'].get(date)
         SUP = becgis.open_as_array(total_supply_tif, nan_values = True)
         
-        dperc_tif = complete_data['dperc'][0][complete_data['dperc'][1] == date][0]
+        dperc_tif = complete_data['dperc'].get(date)
         DPERC = becgis.open_as_array(dperc_tif, nan_values = True)
         DPERC[np.isnan(DPERC)] = 0        
         
-        dro_tif = complete_data['dro'][0][complete_data['dro'][1] == date][0]
+        dro_tif = complete_data['dro'].get(date)
         DRO = becgis.open_as_array(dro_tif, nan_values = True)
         DRO[np.isnan(DRO)] = 0
         
-        sro_tif = complete_data['sr'][0][complete_data['sr'][1] == date][0]
+        sro_tif = complete_data['sr'].get(date)
         SRO = becgis.open_as_array(sro_tif, nan_values = True)
         SRO[np.isnan(SRO)] = 0
         
-#        et_blue_tif = complete_data['etb'][0][complete_data['etb'][1] == date][0]
+#        et_blue_tif = complete_data['etb'].get(date)
 #        ETB = becgis.open_as_array(et_blue_tif, nan_values = True)
 
-        tr_tif = complete_data['tr'][0][complete_data['tr'][1] == date][0]
+        tr_tif = complete_data['tr'].get(date)
         TR = becgis.open_as_array(tr_tif, nan_values = True)
         
-#        perc_tif = complete_data['perc'][0][complete_data['perc'][1] == date][0]
+#        perc_tif = complete_data['perc'].get(date)
 #        PERC = becgis.open_as_array(perc_tif, nan_values = True)
         
         natural_lus = ['Forests',
@@ -1989,12 +2118,12 @@ def supply_return_natural_lu(metadata, complete_data):
         becgis.create_geotiff(outfile_tr, TR, driver, NDV, xsize, ysize, GeoT, Projection)
 
 
-    complete_data['supply_total'] = becgis.sort_files(directory_sup, [-10,-6], month_position = [-6,-4])[0:2]
-    complete_data['dro'] = becgis.sort_files(directory_dro, [-10,-6], month_position = [-6,-4])[0:2]
-    complete_data['sr'] = becgis.sort_files(directory_sro, [-10,-6], month_position = [-6,-4])[0:2]
-    complete_data['dperc'] = becgis.sort_files(directory_dperc, [-10,-6], month_position = [-6,-4])[0:2]
-#    complete_data['perc'] = becgis.sort_files(directory_perc, [-10,-6], month_position = [-6,-4])[0:2]
-    complete_data['tr'] = becgis.sort_files(directory_tr, [-10,-6], month_position = [-6,-4])[0:2]
+    complete_data['supply_total'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_sup, [-10,-6], month_position = [-6,-4])[0:2])
+    complete_data['dro'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_dro, [-10,-6], month_position = [-6,-4])[0:2])
+    complete_data['sr'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_sro, [-10,-6], month_position = [-6,-4])[0:2])
+    complete_data['dperc'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_dperc, [-10,-6], month_position = [-6,-4])[0:2])
+#    complete_data['perc'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_perc, [-10,-6], month_position = [-6,-4])[0:2])
+    complete_data['tr'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_tr, [-10,-6], month_position = [-6,-4])[0:2])
 
     return complete_data
 
@@ -2013,15 +2142,15 @@ def bf_reduction_with_gwsup(metadata, complete_data):
                                       complete_data['bf'][1]])
 
     for date in common_dates:        
-        gw_supply_tif = complete_data['supply_gw'][0][complete_data['supply_gw'][1] == date][0]
+        gw_supply_tif = complete_data['supply_gw'].get(date)
         SUP_GW = becgis.open_as_array(gw_supply_tif, nan_values = True)
         
-        bf_tif = complete_data['bf'][0][complete_data['bf'][1] == date][0]
+        bf_tif = complete_data['bf'].get(date)
         BF = becgis.open_as_array(bf_tif, nan_values = True)
 
-        ro_tif = complete_data['tr'][0][complete_data['tr'][1] == date][0]
+        ro_tif = complete_data['tr'].get(date)
 
-        sro_tif = complete_data['sr'][0][complete_data['sr'][1] == date][0]
+        sro_tif = complete_data['sr'].get(date)
         SRO = becgis.open_as_array(sro_tif, nan_values = True)
         
         BF_new = BF - SUP_GW
@@ -2033,6 +2162,6 @@ def bf_reduction_with_gwsup(metadata, complete_data):
         becgis.create_geotiff(outfile_bf, BF_new, driver, NDV, xsize, ysize, GeoT, Projection)
         outfile_tr = os.path.join(directory_ro, os.path.basename(ro_tif))
         becgis.create_geotiff(outfile_tr, RO_new, driver, NDV, xsize, ysize, GeoT, Projection)
-    complete_data['bf'] = becgis.sort_files(directory_bf, [-10,-6], month_position = [-6,-4])[0:2]
-    complete_data['tr'] = becgis.sort_files(directory_ro, [-10,-6], month_position = [-6,-4])[0:2]
+    complete_data['bf'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_bf, [-10,-6], month_position = [-6,-4])[0:2])
+    complete_data['tr'] = becgis.TimeSeriesCatalog(*becgis.sort_files(directory_ro, [-10,-6], month_position = [-6,-4])[0:2])
     return complete_data
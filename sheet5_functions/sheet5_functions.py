@@ -24,17 +24,17 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from scipy import interpolate
 import ogr
-import cairosvg
 
 import WA_Hyperloop.becgis as becgis
 from WA_Hyperloop import hyperloop as hl
 import WA_Hyperloop.get_dictionaries as gd
 from WA_Hyperloop.paths import get_path
+from WA_Hyperloop import pipeline
 import gdal
 gdal.UseExceptions() 
 
 
-def create_sheet5(complete_data, metadata, output_dir, global_data):
+def create_sheet5(complete_data, metadata, output_dir, global_data, dates=None):
     output_folder = os.path.join(output_dir, metadata['name'], 'sheet5')
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
@@ -43,7 +43,7 @@ def create_sheet5(complete_data, metadata, output_dir, global_data):
     complete_data['fractions'] = calc_fractions(complete_data['p'],
                                                 os.path.join(output_dir, metadata['name'], 'data', 'fractions'),
                                                 global_data['dem'], metadata['lu'],
-                                                metadata['fraction_xs'])
+                                                metadata['fraction_xs'], dates=dates)
     if 'SWfile' in list(metadata.keys()):
         if isinstance(metadata['SWfile'], list):
             SW_dates = np.array([datetime.date.fromordinal(t)
@@ -65,58 +65,39 @@ def create_sheet5(complete_data, metadata, output_dir, global_data):
 
     sb_codes = sorted(metadata['masks'].keys())
     sb_fhs = [metadata['masks'][sb][1] for sb in sb_codes]
-    #reproject subbasin masks
-    sb_temp = os.path.join(output_folder, 'temp_sb')
-    sb_fhs = becgis.match_proj_res_ndv(lu_fh, sb_fhs, sb_temp)
-    sb_names = [metadata['masks'][sb][0] for sb in sb_codes]
-    sb_fhs_code_names = list(zip(sb_fhs, sb_codes, sb_names))
     
     # subbasin connectivity dictionaries
     dico_in = metadata['dico_in']
     dico_out = metadata['dico_out']
 
-    fractions_fhs = complete_data['fractions'][0]
-
     _, _, _, _, lu_dict, _ = gd.get_sheet7_classes()
 
     discharge_out_from_wp = metadata['discharge_out_from_wp']
 
-    surf_ro_fhs = complete_data['sr'][0].tolist()
-    base_ro_fhs = complete_data['bf'][0].tolist()
-    ro_fhs = complete_data['tr'][0].tolist()
-    withdr_fhs = complete_data['supply_sw'][0].tolist()
-    return_gw_sw_fhs = complete_data['return_flow_gw_sw'][0].tolist()
-    return_sw_sw_fhs = complete_data['return_flow_sw_sw'][0].tolist()
-    AREA = becgis.map_pixel_area_km(lu_fh)
+    pixels = becgis.basin_pixels(lu_fh)
+    AREA = becgis.gather_pixels(becgis.map_pixel_area_km(lu_fh), pixels)
+    zones = becgis.gather_zones(lu_fh, pixels)
+    #label each pixel with the index of its subbasin
+    sb_labels = becgis.gather_pixels(becgis.label_masks(lu_fh, sb_fhs), pixels)
     if discharge_out_from_wp:
         added_inflow = dict()
         discharge_sum = dict()
         interbasin_transfers = dict()
         deltaSW = dict()
 
-        for temp_sb, sb_code in zip(sb_fhs, sb_codes):
+        RO_sb = np.zeros((len(date_list), len(sb_codes)))
+        W_sb = np.zeros((len(date_list), len(sb_codes)))
+        for t, dt in enumerate(date_list):
+            RO_sb[t] = subbasin_sums(complete_data['tr'].vector(dt, pixels), AREA, zones, sb_labels, len(sb_codes)).sum(axis=1)
+            W_sb[t] = subbasin_sums(complete_data['supply_sw'].vector(dt, pixels), AREA, zones, sb_labels, len(sb_codes)).sum(axis=1)
+
+        for j, sb_code in enumerate(sb_codes):
             in_list = np.array(metadata['dico_in'][sb_code])
             out_list = np.array(metadata['dico_out'][sb_code])
-            AVAIL_sb = np.array([])
-            ro = []
-            wth = []
             interbasin_transfers[sb_code] = np.zeros(len(date_list))
-            mask = becgis.open_as_array(temp_sb, nan_values=True)
-
-            for dt in date_list:
-                rofh = np.array(ro_fhs)[complete_data['tr'][1] == dt.date()][0]
-                wfh = np.array(withdr_fhs)[complete_data['supply_sw'][1] == dt.date()][0]
-
-                RO = becgis.open_as_array(rofh, nan_values=True) * AREA / 1e6
-                RO[mask != 1] = np.nan
-
-                W = becgis.open_as_array(wfh, nan_values=True) * AREA / 1e6
-                W[mask != 1] = np.nan
-
-                AVAIL = np.nansum(RO)-np.nansum(W)
-                AVAIL_sb = np.append(AVAIL_sb, AVAIL)
-                ro.append(np.nansum(RO))
-                wth.append(np.nansum(W))
+            ro = RO_sb[:, j]
+            wth = W_sb[:, j]
+            AVAIL_sb = ro - wth
 
             # Add inflow from outside sources to available runoff
             # Add or remove interbasin transfers as well
@@ -205,8 +186,8 @@ def create_sheet5(complete_data, metadata, output_dir, global_data):
 
     #Splitting up the outflow into committed/ non_utilizable/ utilizable/ non_recoverable
     split_discharge = discharge_split(global_data["wpl_tif"], global_data["environ_water_req"],
-                                      discharge_sum, ro_fhs, AREA, fractions_fhs,
-                                      sb_fhs_code_names, date_list)
+                                      discharge_sum, complete_data['tr'], AREA, complete_data['fractions'],
+                                      lu_fh, zones, sb_labels, sb_codes, date_list)
     #Add arrows to template when possible (dependent on subbasin structure)
     svg_template = sheet_5_dynamic_arrows(dico_in, dico_out, template,
                                           os.path.join(output_folder, 'temp_sheet5.svg'))
@@ -214,9 +195,13 @@ def create_sheet5(complete_data, metadata, output_dir, global_data):
     dt = 0
     print("starting sheet 5 loop")
     for d in date_list:
+        # The discharges are routed over the complete record, but the sheets
+        # of months from an earlier (or interrupted) run are kept.
+        if not pipeline.pending_months([d], dates)[0]:
+            dt += 1
+            continue
         print('sheet 5 {0} started'.format(d))
         datestr1 = "%04d_%02d" %(d.year, d.month)
-        datestr2 = "%04d%02d" %(d.year, d.month)
         ystr = "%04d" %(d.year)
         mstr = "%02d" %(d.month)
         for sb in sb_codes:
@@ -234,25 +219,25 @@ def create_sheet5(complete_data, metadata, output_dir, global_data):
                 results[ystr][mstr]['inflows'][sb_codes[s-1]] = np.sum([outflow[sb_codes[j-1]] for j in dico_in[s]])
             else:
                 results[ystr][mstr]['inflows'][sb_codes[s-1]] = np.sum([outflow[sb_codes[j-1]] for j in dico_in[s] if j != 0]) + added_inflow[s][dt]
-        #define filehandles for the correct time
-        surf_ro_fh = surf_ro_fhs[np.where([datestr2 in surf_ro_fhs[i] for i in range(len(surf_ro_fhs))])[0][0]]
-        base_ro_fh = base_ro_fhs[np.where([datestr2 in base_ro_fhs[i] for i in range(len(base_ro_fhs))])[0][0]]
-        ro_fh = ro_fhs[np.where([datestr2 in ro_fhs[i] for i in range(len(ro_fhs))])[0][0]]
+        #totals per subbasin and landuse class for the correct time
+        surf_ro = subbasin_sums(complete_data['sr'].vector(d, pixels), AREA, zones, sb_labels, len(sb_codes))
+        base_ro = subbasin_sums(complete_data['bf'].vector(d, pixels), AREA, zones, sb_labels, len(sb_codes))
+        ro = subbasin_sums(complete_data['tr'].vector(d, pixels), AREA, zones, sb_labels, len(sb_codes))
 
-        withdr_fh = withdr_fhs[np.where([datestr2 in withdr_fhs[i] for i in range(len(withdr_fhs))])[0][0]]
+        withdr = subbasin_sums(complete_data['supply_sw'].vector(d, pixels), AREA, zones, sb_labels, len(sb_codes))
 
-        return_gw_sw_fh = return_gw_sw_fhs[np.where([datestr2 in return_gw_sw_fhs[i] for i in range(len(return_gw_sw_fhs))])[0][0]]
-        return_sw_sw_fh = return_sw_sw_fhs[np.where([datestr2 in return_sw_sw_fhs[i] for i in range(len(return_sw_sw_fhs))])[0][0]]
+        return_gw_sw = subbasin_sums(complete_data['return_flow_gw_sw'].vector(d, pixels), AREA, zones, sb_labels, len(sb_codes))
+        return_sw_sw = subbasin_sums(complete_data['return_flow_sw_sw'].vector(d, pixels), AREA, zones, sb_labels, len(sb_codes))
 
-        results[ystr][mstr]['surf_runoff'] = lu_type_sum_subbasins(surf_ro_fh, lu_fh, AREA, lu_dict, sb_fhs_code_names)
-        results[ystr][mstr]['base_runoff'] = lu_type_sum_subbasins(base_ro_fh, lu_fh, AREA, lu_dict, sb_fhs_code_names)
+        results[ystr][mstr]['surf_runoff'] = lu_type_sum_subbasins(surf_ro, zones, lu_dict, sb_codes)
+        results[ystr][mstr]['base_runoff'] = lu_type_sum_subbasins(base_ro, zones, lu_dict, sb_codes)
 
-        results[ystr][mstr]['total_runoff'] = sum_subbasins(ro_fh, AREA, sb_fhs_code_names)
+        results[ystr][mstr]['total_runoff'] = sum_subbasins(ro, sb_codes)
 
-        results[ystr][mstr]['withdrawls'] = lu_type_sum_subbasins(withdr_fh, lu_fh, AREA, man_dict, sb_fhs_code_names)
+        results[ystr][mstr]['withdrawls'] = lu_type_sum_subbasins(withdr, zones, man_dict, sb_codes)
 
-        results[ystr][mstr]['return_gw_sw'] = sum_subbasins(return_gw_sw_fh, AREA, sb_fhs_code_names)
-        results[ystr][mstr]['return_sw_sw'] = sum_subbasins(return_sw_sw_fh, AREA, sb_fhs_code_names)
+        results[ystr][mstr]['return_gw_sw'] = sum_subbasins(return_gw_sw, sb_codes)
+        results[ystr][mstr]['return_sw_sw'] = sum_subbasins(return_sw_sw, sb_codes)
 
         for j in list(results[ystr][mstr]['surf_runoff'][sb_codes[0]].keys()):
             results[ystr][mstr]['surf_runoff']['basin'][j] = np.nansum([results[ystr][mstr]['surf_runoff'][k][j] for k in sb_codes])
@@ -284,23 +269,25 @@ def create_sheet5(complete_data, metadata, output_dir, global_data):
         output = output_fh.replace('csv', 'pdf')
         create_sheet5_svg(metadata['name'], sb_codes, datestr1, 'km3',
                           output_fh, output, svg_template, smart_unit=True)
+        pipeline.checkpoint(d, [output_fh, output])
         dt += 1
-    fhs, dates, years, months, days = becgis.sort_files(os.path.join(output_folder, "sheet5_monthly"), [-11, -7], month_position=[-6, -4], extension='csv')
-    years, counts = np.unique(years, return_counts=True)
 
     fhs = hl.create_csv_yearly(os.path.join(output_folder, "sheet5_monthly"),
                                os.path.join(output_folder, "sheet5_yearly"), 5,
                                metadata['water_year_start_month'],
                                year_position=[-11, -7], month_position=[-6, -4],
                                header_rows=1, header_columns=2,
-                               minus_header_colums=-1)
+                               minus_header_colums=-1,
+                               years=None if dates is None else becgis.water_years(dates, metadata['water_year_start_month']))
 
     for fh in fhs:
         ystr = os.path.basename(fh).split('_')[-1][:4]
         output = fh.replace('csv', 'pdf')
+        if pipeline.completed('sheet5 {0}'.format(ystr)):
+            continue
         create_sheet5_svg(metadata['name'], sb_codes, ystr, 'km3',
                           fh, output, svg_template, smart_unit=False)
-    shutil.rmtree(os.path.split(sb_fhs[0])[0])
+        pipeline.checkpoint('sheet5 {0}'.format(ystr), [fh, output])
     os.remove(svg_template)
     print('Done')
     return complete_data
@@ -562,7 +549,7 @@ def linear_fractions(lu_fh, upstream_fh, proxy_fh, output_fh, xs, unit='km',
     f2 = interpolate.interp1d([xs[2], xs[3]], [1, 0], kind='linear',
                               bounds_error=False, fill_value=(1, 0))
 
-    LULC = becgis.open_as_array(lu_fh, nan_values=True)
+    LULC = becgis.open_as_array(lu_fh, nan_values=True, cache=True)
     distances[np.isnan(LULC)] = np.nan
 
     alpha = np.zeros(np.shape(distances))
@@ -663,7 +650,7 @@ def dryness_fractions(p_fh, std, mean, fractions_dryness_fh, base=-0.5, top=0.0)
     becgis.create_geotiff(fractions_dryness_fh, fractions, driver, NDV, xsize, ysize, GeoT, Projection)
 
 
-def calc_fractions(p_data, output_dir, dem_fh, lu_fh, fraction_altitude_xs):
+def calc_fractions(p_data, output_dir, dem_fh, lu_fh, fraction_altitude_xs, dates=None):
     p_fhs, p_dates = p_data
     dem_reproj_fhs = becgis.match_proj_res_ndv(lu_fh, np.array([dem_fh]), output_dir)
     upstream_fh = upstream_of_lu_class(dem_fh, lu_fh, output_dir, clss=None)
@@ -672,7 +659,7 @@ def calc_fractions(p_data, output_dir, dem_fh, lu_fh, fraction_altitude_xs):
                      fraction_altitude_xs, unit='m', quantity='Altitude',
                      plot_graph=False)
 
-    p_months = np.array([date.month for date in p_dates])
+    climatology = becgis.monthly_climatology(p_fhs, p_dates)
 
     fractions_fhs = np.array([])
 
@@ -680,9 +667,14 @@ def calc_fractions(p_data, output_dir, dem_fh, lu_fh, fraction_altitude_xs):
         # Create some filehandles to store results.
         fractions_dryness_fh = os.path.join(output_dir, 'fractions_dryness', 'fractions_dryness_{0}_{1}.tif'.format(pdate.year, str(pdate.month).zfill(2)))
         fractions_fh = os.path.join(output_dir, 'fractions', 'fractions_{0}_{1}.tif'.format(pdate.year, str(pdate.month).zfill(2)))
+        fractions_fhs = np.append(fractions_fhs, fractions_fh)
+
+        # Months outside the selection are only computed when missing.
+        if os.path.exists(fractions_fh) and not becgis.in_selection([pdate], dates)[0]:
+            continue
 
-        # If not done yet, calculate the mean and std of the precipitation for the current month of the year.
-        std, mean = becgis.calc_mean_std(p_fhs[p_months == pdate.month])
+        # Mean and std of the precipitation for the current month of the year.
+        std, mean = climatology[pdate.month]
 
         # Determine fractions regarding dryness to determine non-utilizable outflow.
         dryness_fractions(p_fhs[p_dates == pdate][0], std, mean,
@@ -695,9 +687,7 @@ def calc_fractions(p_data, output_dir, dem_fh, lu_fh, fraction_altitude_xs):
             os.makedirs(os.path.split(fractions_fh)[0])
         driver, NDV, xsize, ysize, GeoT, Projection = becgis.get_geoinfo(fractions_altitude_fh)
         becgis.create_geotiff(fractions_fh, FH3, driver, NDV, xsize, ysize, GeoT, Projection)
-
-        fractions_fhs = np.append(fractions_fhs, fractions_fh)
-    return (fractions_fhs, p_dates)
+    return becgis.TimeSeriesCatalog(fractions_fhs, p_dates)
 
 
 def dictionary():
@@ -810,7 +800,7 @@ def create_sheet5_svg(basin, sb_codes, period, units, data, output, template=Fal
 
     tempout_path = output.replace('.pdf', '_temporary.svg')
     tree.write(tempout_path)    
-    cairosvg.svg2pdf(url=tempout_path, write_to=output)    
+    becgis.svg_to_pdf(tempout_path, output)
     os.remove(tempout_path)
 
     return
@@ -820,59 +810,59 @@ class Vividict(dict):
         value = self[key] = type(self)()
         return value
 
-def lu_type_sum_subbasins(data_fh, lu_fh, AREA, lu_dict, sb_fhs_code_names):
+def subbasin_sums(data, AREA, zones, sb_labels, nsb):
+    """
+    Returns totals in km3 per subbasin and landuse class in one pass
+    Parameters
+    ----------
+    data : ndarray
+        vector with the data to split in mm
+    AREA : ndarray
+        vector with the area of each pixel in km2
+    zones : tuple
+        encoded landusemap, see becgis.gather_zones
+    sb_labels : ndarray
+        vector with the subbasin index of each pixel, see becgis.label_masks
+    nsb : int
+        number of subbasins
+    """
+    return becgis.sum_per_label_class(sb_labels, zones, data, nsb, area=AREA, scale=1e-6)[0]
+
+def lu_type_sum_subbasins(sums, zones, lu_dict, sb_codes):
     """
     Returns totals in a dict split by subbasin and land use type (PLU, ULU etc)
     Parameters
     ----------
-    data_fh : str
-        location of the map of the data to split
-    lu_fh : str
-        location of landuse map
+    sums : ndarray
+        totals per subbasin and landuse class, see subbasin_sums
+    zones : tuple
+        encoded landusemap, see becgis.gather_zones
     lu_dict : dict
         lu_class : list of landuses in class
-    sb_fhs_code_names : list of tuples
-        (sb_fhs,sb_codes,sb_names)
+    sb_codes : list
+        subbasin codes in the order of the rows of sums
     """
-    LULC = becgis.open_as_array(lu_fh)
-    in_data = becgis.open_as_array(data_fh, nan_values=True) * AREA / 1e6
     out_data = Vividict()
-    sb_fhs = list(zip(*sb_fhs_code_names))[0]
-    sb_codes = list(zip(*sb_fhs_code_names))[1]
-    for j in range(len(sb_fhs)):
-        sb_fh = sb_fhs[j]
-        sb_code = sb_codes[j]
-        sb_mask = becgis.open_as_array(sb_fh)
-        sb_mask[sb_mask != 1] = 0
-        sb_mask = sb_mask.astype('bool')
-        for lu_class in list(lu_dict.keys()):
-            mask = [LULC == value for value in lu_dict[lu_class]]
-            mask = (np.sum(mask, axis=0)).astype(bool)
-            mask = mask * sb_mask
-            out_data[sb_code][lu_class] = np.nansum(in_data[mask])
+    for lu_class in list(lu_dict.keys()):
+        totals = np.sum(sums[:, becgis.class_positions(zones, lu_dict[lu_class])], axis=1)
+        for j, sb_code in enumerate(sb_codes):
+            out_data[sb_code][lu_class] = totals[j]
     return out_data
 
-def sum_subbasins(data_fh, AREA, sb_fhs_code_names):
+def sum_subbasins(sums, sb_codes):
     """
     Returns totals in a dict split by subbasin
     Parameters
     ----------
-    data_fh : str
-        location of the map of the data to split
-    sb_fhs_code_names : list of tuples
-        (sb_fhs,sb_codes,sb_names)
+    sums : ndarray
+        totals per subbasin and landuse class, see subbasin_sums
+    sb_codes : list
+        subbasin codes in the order of the rows of sums
     """
-    in_data = becgis.open_as_array(data_fh, nan_values=True) * AREA / 1e6
+    totals = np.sum(sums, axis=1)
     out_data = Vividict()
-    sb_fhs = list(zip(*sb_fhs_code_names))[0]
-    sb_codes = list(zip(*sb_fhs_code_names))[1]
-    for j in range(len(sb_fhs)):
-        sb_fh = sb_fhs[j]
-        sb_code = sb_codes[j]
-        sb_mask = becgis.open_as_array(sb_fh)
-        sb_mask[sb_mask != 1] = 0
-        sb_mask = sb_mask.astype('bool')
-        out_data[sb_code] = np.nansum(in_data[sb_mask])
+    for j, sb_code in enumerate(sb_codes):
+        out_data[sb_code] = totals[j]
     return out_data
 
 def read_inflow_file(inflowtext, date_list):
@@ -909,48 +899,32 @@ def discharge_at_points(PointShapefile, SWpath):
     return sw_time, discharge_natural, discharge_end, stat_name
 
 def discharge_split(wpl_fh, ewr_fh, discharge_sum, ro_fhs, AREA, fractions_fhs,
-                    sb_fhs_code_names, date_list):
+                    lu_fh, zones, sb_labels, sb_codes, date_list):
     results = Vividict()
-    gray_water_fraction = {}
-    ewr_percentage = {}
-
-    sb_fhs = list(zip(*sb_fhs_code_names))[0]
-    sb_codes = list(zip(*sb_fhs_code_names))[1]
+    pixels = becgis.basin_pixels(lu_fh)
+    nsb = len(sb_codes)
 
     long_disch_mean = np.mean([discharge_sum[k] for k in sb_codes], axis=1)
 
-    for i in range(len(sb_fhs)):
-        sb_fh = sb_fhs[i]
-        sb_code = sb_codes[i]
-        gray_water_fraction[sb_code] = calc_basinmean(wpl_fh, sb_fh)
-        ewr_percentage[sb_code] = calc_basinmean(ewr_fh, sb_fh)
+    gray_water_fraction = subbasin_means(becgis.match_static_layer(wpl_fh, lu_fh), pixels, zones, sb_labels, nsb)
+    ewr_percentage = subbasin_means(becgis.match_static_layer(ewr_fh, lu_fh), pixels, zones, sb_labels, nsb)
     t = 0
     for d in date_list:
-        datestr1 = "%04d_%02d" %(d.year, d.month)
-        datestr2 = "%04d%02d" %(d.year, d.month)
         ystr = "%04d" %(d.year)
         mstr = "%02d" %(d.month)
-        ro_fh = ro_fhs[np.where([datestr2 in ro_fhs[i] for i in range(len(ro_fhs))])[0][0]]
-        runoff = becgis.open_as_array(ro_fh, nan_values=True) * AREA / 1e6
-        fractions_fh = fractions_fhs[np.where([datestr1 in fractions_fhs[i] for i in range(len(fractions_fhs))])[0][0]]
-        fractions = becgis.open_as_array(fractions_fh, nan_values=True)
-
-        non_utilizable_runoff = runoff * fractions
-        non_utilizable_sum = {}
-        for i in range(len(sb_fhs)):
-            sb_fh = sb_fhs[i]
+        runoff = ro_fhs.vector(d, pixels)
+        fractions = fractions_fhs.vector(d, pixels)
+
+        non_utilizable_sum = np.sum(subbasin_sums(runoff * fractions, AREA, zones, sb_labels, nsb), axis=1)
+        for i in range(nsb):
             sb_code = sb_codes[i]
-            sb_mask = becgis.open_as_array(sb_fh)
-            sb_mask[sb_mask != 1] = 0
-            sb_mask = sb_mask.astype('bool')
-            non_utilizable_sum[sb_code] = np.nansum(non_utilizable_runoff[sb_mask])
 
-            results[ystr][mstr]['non_recoverable_outflow'][sb_code] = gray_water_fraction[sb_code] * discharge_sum[sb_code][t]
-            reserved_outflow_demand = long_disch_mean[i] * ewr_percentage[sb_code]
+            results[ystr][mstr]['non_recoverable_outflow'][sb_code] = gray_water_fraction[i] * discharge_sum[sb_code][t]
+            reserved_outflow_demand = long_disch_mean[i] * ewr_percentage[i]
 
             non_consumed_water = discharge_sum[sb_code][t] - results[ystr][mstr]['non_recoverable_outflow'][sb_code]
 
-            results[ystr][mstr]['non_utilizable_outflow'][sb_code] = min(non_consumed_water, max(0.0, non_utilizable_sum[sb_code]))
+            results[ystr][mstr]['non_utilizable_outflow'][sb_code] = min(non_consumed_water, max(0.0, non_utilizable_sum[i]))
             # note: committed = reserved_outflow_actual
             results[ystr][mstr]['committed_outflow'][sb_code] = min(non_consumed_water - results[ystr][mstr]['non_utilizable_outflow'][sb_code], reserved_outflow_demand)
             results[ystr][mstr]['utilizable_outflow'][sb_code] = max(0.0, non_consumed_water - results[ystr][mstr]['non_utilizable_outflow'][sb_code] - results["%04d" %(d.year)]["%02d" %(d.month)]['committed_outflow'][sb_code])
@@ -973,7 +947,7 @@ def create_csv(dresults, output_fh):
     first_row = ['SUBBASIN', 'VARIABLE', 'VALUE', 'UNITS']
     if not os.path.exists(os.path.split(output_fh)[0]):
         os.makedirs(os.path.split(output_fh)[0])
-    csv_file = open(output_fh, 'w')
+    csv_file = open(becgis.temp_filehandle(output_fh), 'w')
     writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n')
     writer.writerow(first_row)
     lu_classes = ['PROTECTED', 'UTILIZED', 'MODIFIED', 'MANAGED']
@@ -997,8 +971,35 @@ def create_csv(dresults, output_fh):
         writer.writerow([sb,'Interbasin Transfer','{0}'.format(dresults['interbasin_transfers'][sb]),'km3'])
         writer.writerow([sb, 'SW storage change', '{0}'.format(dresults['deltaS'][sb]), 'km3'])
     csv_file.close()
+    becgis.replace_file(becgis.temp_filehandle(output_fh), output_fh)
     return
 
+def subbasin_means(perc_fh, pixels, zones, sb_labels, nsb):
+    """
+    Calculate the mean of a map inside each subbasin.
+    
+    Parameters
+    ----------
+    perc_fh : str
+        Filehandle pointing to the map for which the means need to be determined.
+    pixels : tuple
+        Pixels inside the basin, see becgis.basin_pixels.
+    zones : tuple
+        Encoded landusemap, see becgis.gather_zones.
+    sb_labels : ndarray
+        Vector with the subbasin index of each pixel, see becgis.label_masks.
+    nsb : int
+        Number of subbasins.
+    
+    Returns
+    -------
+    means : ndarray
+        The mean of the map inside each subbasin.
+    """
+    sums, counts = becgis.sum_per_label_class(sb_labels, zones, becgis.open_as_vector(perc_fh, pixels), nsb)
+    counts = np.sum(counts, axis=1)
+    return np.where(counts > 0, np.sum(sums, axis=1) / np.maximum(counts, 1), np.nan)
+
 def calc_basinmean(perc_fh, lu_fh):
     """
     Calculate the mean of a map after masking out the areas outside an basin defined by
@@ -1016,11 +1017,9 @@ def calc_basinmean(perc_fh, lu_fh):
     percentage : float
         The mean of the map within the border of the lu_fh.
     """
-    output_folder = tf.mkdtemp()
-    perc_fh = becgis.match_proj_res_ndv(lu_fh, np.array([perc_fh]), output_folder)
-    EWR = becgis.open_as_array(perc_fh[0], nan_values = True)
-    LULC = becgis.open_as_array(lu_fh, nan_values = True)
+    perc_fh = becgis.match_static_layer(perc_fh, lu_fh)
+    EWR = becgis.open_as_array(perc_fh, nan_values = True)
+    LULC = becgis.open_as_array(lu_fh, nan_values = True, cache = True)
     EWR[np.isnan(LULC)] = np.nan
     percentage = np.nanmean(EWR)
-    shutil.rmtree(output_folder)
     return percentage
\ No newline at end of file
@@ -7,7 +7,6 @@ Created on Thu Jun 15 15:45:59 2017
 from builtins import range
 import os
 import csv
-import cairosvg
 import numpy as np
 import pandas as pd
 import xml.etree.ElementTree as ET
@@ -20,10 +19,11 @@ import watools.General.data_conversions as DC
 import WA_Hyperloop.becgis as becgis
 from WA_Hyperloop.paths import get_path
 from WA_Hyperloop import hyperloop as hl
+from WA_Hyperloop import pipeline
 
 #%%
 
-def create_sheet7(complete_data, metadata, output_dir, global_data, data):
+def create_sheet7(complete_data, metadata, output_dir, global_data, data, dates=None):
     template_m = get_path('sheet7m_svg')
     template_y = get_path('sheet7y_svg')
     lu_fh = metadata['lu']
@@ -71,40 +71,46 @@ def create_sheet7(complete_data, metadata, output_dir, global_data, data):
     dry_bf_fhs = []
     gw_rchg_fhs = []
     for d in date_list2:
-        ndm_fhs.extend(complete_data['ndm'][0][complete_data['ndm'][1] == d])
-        ro_fhs.extend(complete_data['tr'][0][complete_data['tr'][1] == d])
-        et_blue_fhs.extend(complete_data['etb'][0][complete_data['etb'][1] == d])
-        et_green_fhs.extend(complete_data['etg'][0][complete_data['etg'][1] == d])
-        p_fhs.extend(complete_data['p'][0][complete_data['p'][1] == d])
-        dry_bf_fhs.extend(complete_data['bf'][0][complete_data['bf'][1] == d])
-        gw_rchg_fhs.extend(complete_data['recharge'][0][complete_data['recharge'][1] == d])
+        ndm_fhs.append(complete_data['ndm'].get(d))
+        ro_fhs.append(complete_data['tr'].get(d))
+        et_blue_fhs.append(complete_data['etb'].get(d))
+        et_green_fhs.append(complete_data['etg'].get(d))
+        p_fhs.append(complete_data['p'].get(d))
+        dry_bf_fhs.append(complete_data['bf'].get(d))
+        gw_rchg_fhs.append(complete_data['recharge'].get(d))
 
     # Make fraction maps to split feed and fuel yields in landscape and incremental ET
     fraction_fhs = split_yield(output_folder, p_fhs, et_blue_fhs, et_green_fhs,
-                               ab=(1.0, 1.0))
+                               ab=(1.0, 1.0), fhdates=date_list2, dates=dates)
 
     # calculate feed production and return filehandles of saved tif files
     feed_fhs_landscape, feed_fhs_incremental = livestock_feed(output_folder, lu_fh, AREA,
                                                               ndm_fhs, feed_dict,
                                                               live_feed, cattle_fh,
-                                                              fraction_fhs, date_list2)
+                                                              fraction_fhs, date_list2,
+                                                              dates=dates)
 
     # calculate fuel production and return filehandles of saved tif files
     fuel_fhs_landscape, fuel_fhs_incremental = fuel_wood(output_folder, lu_fh, AREA,
                                                          ndm_fhs, fraction_fhs,
-                                                         date_list2)
+                                                         date_list2, dates=dates)
 
     # calculate root_storage and return filehandles of saved tif files
     rz_depth_fh = global_data['root_depth']
-    rz_depth_tif = becgis.match_proj_res_ndv(lu_fh, np.array([rz_depth_fh]), tf.mkdtemp())[0]
+    rz_depth_tif = becgis.match_static_layer(rz_depth_fh, lu_fh)
     rz_sm_fhs = complete_data['rzsm'][0]
 
-    root_storage_fhs = root_zone_storage_Wpx(output_folder, rz_sm_fhs, rz_depth_tif)
+    root_storage_fhs = becgis.TimeSeriesCatalog(root_zone_storage_Wpx(output_folder, rz_sm_fhs, rz_depth_tif,
+                                                                      rz_sm_dates=complete_data['rzsm'][1],
+                                                                      dates=dates),
+                                                complete_data['rzsm'][1])
 
     atm_recy_landscape_fhs = recycle(output_folder, et_green_fhs, recy_ratio,
-                                     lu_fh, 'landscape')
+                                     lu_fh, 'landscape', et_dates=date_list2,
+                                     dates=dates)
     atm_recy_incremental_fhs = recycle(output_folder, et_blue_fhs, recy_ratio,
-                                       lu_fh, 'incremental')
+                                       lu_fh, 'incremental', et_dates=date_list2,
+                                       dates=dates)
 
     class Vividict(dict):
         def __missing__(self, key):
@@ -112,58 +118,77 @@ def create_sheet7(complete_data, metadata, output_dir, global_data, data):
             return value
 
     results = Vividict()
-    for d in date_list:
-        datestr1 = "%04d_%02d" %(d.year, d.month)
-        datestr2 = "%04d%02d" %(d.year, d.month)
-        ystr = "%04d" %(d.year)
-        mstr = "%02d" %(d.month)
-
-        ro_fh = ro_fhs[np.where([datestr2 in ro_fhs[i] for i in range(len(ro_fhs))])[0][0]]
-        feed_fh_landscape = feed_fhs_landscape[np.where([datestr1 in feed_fhs_landscape[i] for i in range(len(feed_fhs_landscape))])[0][0]]
-        feed_fh_incremental = feed_fhs_incremental[np.where([datestr1 in feed_fhs_incremental[i] for i in range(len(feed_fhs_incremental))])[0][0]]
-        fuel_fh_landscape = fuel_fhs_landscape[np.where([datestr1 in fuel_fhs_landscape[i] for i in range(len(fuel_fhs_landscape))])[0][0]]
-        fuel_fh_incremental = fuel_fhs_incremental[np.where([datestr1 in fuel_fhs_incremental[i] for i in range(len(fuel_fhs_incremental))])[0][0]]
-
-        baseflow_fh = dry_bf_fhs[np.where([datestr2 in dry_bf_fhs[i] for i in range(len(dry_bf_fhs))])[0][0]]
-        gw_recharge_fh = gw_rchg_fhs[np.where([datestr2 in gw_rchg_fhs[i] for i in range(len(gw_rchg_fhs))])[0][0]]
-
-        root_storage_fh = root_storage_fhs[np.where([datestr2 in root_storage_fhs[i] for i in range(len(root_storage_fhs))])[0][0]]
-        atm_recy_landscape_fh = atm_recy_landscape_fhs[np.where([datestr2 in atm_recy_landscape_fhs[i] for i in range(len(atm_recy_landscape_fhs))])[0][0]]
-        atm_recy_incremental_fh = atm_recy_incremental_fhs[np.where([datestr2 in atm_recy_incremental_fhs[i] for i in range(len(atm_recy_incremental_fhs))])[0][0]]
-
-        results[ystr][mstr]['tot_runoff'] = lu_type_sum(ro_fh, lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
-      #  results['fish'] =
-        results[ystr][mstr]['feed_incremental'] = lu_type_sum(feed_fh_incremental, lu_fh, AREA, sheet7_lulc_classes)
-        results[ystr][mstr]['feed_landscape'] = lu_type_sum(feed_fh_landscape, lu_fh, AREA, sheet7_lulc_classes)
-        results[ystr][mstr]['fuel_incremental'] = lu_type_sum(fuel_fh_incremental, lu_fh, AREA, sheet7_lulc_classes)
-        results[ystr][mstr]['fuel_landscape'] = lu_type_sum(fuel_fh_landscape, lu_fh, AREA, sheet7_lulc_classes)
-
-        results[ystr][mstr]['baseflow'] = lu_type_sum(baseflow_fh, lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
-        results[ystr][mstr]['gw_rech'] = lu_type_sum(gw_recharge_fh, lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
-        results[ystr][mstr]['root_storage'] = lu_type_sum(root_storage_fh, lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
-        results[ystr][mstr]['atm_recycl_landscape'] = lu_type_sum(atm_recy_landscape_fh, lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
-        results[ystr][mstr]['atm_recycl_incremental'] = lu_type_sum(atm_recy_incremental_fh, lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
-
-        output_fh = output_folder +"\\sheet7_monthly\\sheet7_"+datestr1+".csv"
-        create_csv(results[ystr][mstr], output_fh)
-        output = output_folder + '\\sheet7_monthly\\sheet7_'+datestr1+'.pdf'
-        create_sheet7_svg(metadata['name'], datestr1, output_fh, output, 
-                          template=template_m)
+    # All lists of filehandles are ordered like date_list.
+    tasks = list()
+    for t, d in enumerate(date_list):
+        if not pipeline.pending_months([d], dates)[0]:
+            continue
+        fhs = {'tot_runoff': ro_fhs[t],
+               'feed_incremental': feed_fhs_incremental[t],
+               'feed_landscape': feed_fhs_landscape[t],
+               'fuel_incremental': fuel_fhs_incremental[t],
+               'fuel_landscape': fuel_fhs_landscape[t],
+               'baseflow': dry_bf_fhs[t],
+               'gw_rech': gw_rchg_fhs[t],
+               'root_storage': root_storage_fhs.get(d),
+               'atm_recycl_landscape': atm_recy_landscape_fhs[t],
+               'atm_recycl_incremental': atm_recy_incremental_fhs[t]}
+        tasks.append((d, fhs))
+
+    # Calculate the monthly sheets in parallel (see becgis.set_month_processes).
+    context = (metadata['name'], lu_fh, AREA, sheet7_lulc_classes, output_folder, template_m)
+    for d, (month_results, output_fhs) in zip([task[0] for task in tasks], becgis.map_months(_sheet7_month, tasks, context)):
+        results["%04d" %(d.year)]["%02d" %(d.month)] = month_results
+        pipeline.checkpoint(d, output_fhs)
 
     fhs = hl.create_csv_yearly(os.path.join(output_folder, "sheet7_monthly"),
                                os.path.join(output_folder, "sheet7_yearly"), 7,
                                metadata['water_year_start_month'],
                                year_position=[-11, -7], month_position=[-6, -4],
                                header_rows=1, header_columns=3,
-                               minus_header_colums=-1)
+                               minus_header_colums=-1,
+                               years=None if dates is None else becgis.water_years(dates, metadata['water_year_start_month']))
     for csv_fh in fhs:
         year = csv_fh[-8:-4] 
+        if pipeline.completed('sheet7 {0}'.format(year)):
+            continue
         create_sheet7_svg(metadata['name'], year, 
                           csv_fh, csv_fh.replace('.csv','.pdf'), template=template_y)
+        pipeline.checkpoint('sheet7 {0}'.format(year), [csv_fh, csv_fh.replace('.csv','.pdf')])
 
 
+def _sheet7_month(context, task):
+    """
+    Calculate the totals per landuse category of one month and create its
+    csv-file and sheet, returns the totals and the created files.
+    """
+    name, lu_fh, AREA, sheet7_lulc_classes, output_folder, template_m = context
+    d, fhs = task
+    datestr1 = "%04d_%02d" %(d.year, d.month)
+
+    results = dict()
+    results['tot_runoff'] = lu_type_sum(fhs['tot_runoff'], lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
+  #  results['fish'] =
+    results['feed_incremental'] = lu_type_sum(fhs['feed_incremental'], lu_fh, AREA, sheet7_lulc_classes)
+    results['feed_landscape'] = lu_type_sum(fhs['feed_landscape'], lu_fh, AREA, sheet7_lulc_classes)
+    results['fuel_incremental'] = lu_type_sum(fhs['fuel_incremental'], lu_fh, AREA, sheet7_lulc_classes)
+    results['fuel_landscape'] = lu_type_sum(fhs['fuel_landscape'], lu_fh, AREA, sheet7_lulc_classes)
+
+    results['baseflow'] = lu_type_sum(fhs['baseflow'], lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
+    results['gw_rech'] = lu_type_sum(fhs['gw_rech'], lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
+    results['root_storage'] = lu_type_sum(fhs['root_storage'], lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
+    results['atm_recycl_landscape'] = lu_type_sum(fhs['atm_recycl_landscape'], lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
+    results['atm_recycl_incremental'] = lu_type_sum(fhs['atm_recycl_incremental'], lu_fh, AREA, sheet7_lulc_classes, convert='mm_to_km3')
+
+    output_fh = output_folder +"\\sheet7_monthly\\sheet7_"+datestr1+".csv"
+    create_csv(results, output_fh)
+    output = output_folder + '\\sheet7_monthly\\sheet7_'+datestr1+'.pdf'
+    create_sheet7_svg(name, datestr1, output_fh, output, 
+                      template=template_m)
+    return results, [output_fh, output]
+
 ## PROVISIONING SERVICES
-def livestock_feed(output_folder, lu_fh, AREA, ndm_fhs, feed_dict, live_feed, cattle_fh, fraction_fhs, ndmdates):
+def livestock_feed(output_folder, lu_fh, AREA, ndm_fhs, feed_dict, live_feed, cattle_fh, fraction_fhs, ndmdates, dates=None):
     """
     Calculate natural livestock feed production
 
@@ -181,6 +206,9 @@ def livestock_feed(output_folder, lu_fh, AREA, ndm_fhs, feed_dict, live_feed, ca
         dictionnary 'pasture class':[percent available as feed]
     cattle_fh : str
         filehandle for cattle map
+    dates : list, optional
+        Months to compute, other months are only computed when their maps
+        do not exist yet. Default is None, i.e. all months.
     """
     Data_Path_Feed = "Feed"
     out_folder = os.path.join(output_folder, Data_Path_Feed)
@@ -206,10 +234,14 @@ def livestock_feed(output_folder, lu_fh, AREA, ndm_fhs, feed_dict, live_feed, ca
         year = '%d' %date1.year
         month = '%02d' %date1.month
 
-        yield_fract = RC.Open_tiff_array(fraction_fh)
-
         out_fh_l = out_folder+'\\feed_prod_landscape_%s_%s.tif' %(year, month)
         out_fh_i = out_folder+'\\feed_prod_incremental_%s_%s.tif' %(year, month)
+        feed_fhs_landscape.append(out_fh_l)
+        feed_fhs_incremental.append(out_fh_i)
+        if os.path.exists(out_fh_l) and os.path.exists(out_fh_i) and not becgis.in_selection([date1], dates)[0]:
+            continue
+
+        yield_fract = RC.Open_tiff_array(fraction_fh)
 #        out_fh2 = out_folder+'\\Feed_prod_pH_%s_%s.tif' %(year, month)
         NDM = becgis.open_as_array(ndm_fh, nan_values=True)
         NDM_feed = NDM * f_pct
@@ -219,11 +251,9 @@ def livestock_feed(output_folder, lu_fh, AREA, ndm_fhs, feed_dict, live_feed, ca
         DC.Save_as_tiff(out_fh_i, NDM_feed_incremental, geo_out)
 #        NDM_feed_perHead = NDM_feed / cattle
 #        DC.Save_as_tiff(out_fh2, NDM_feed, geo_out)
-        feed_fhs_landscape.append(out_fh_l)
-        feed_fhs_incremental.append(out_fh_i)
     return feed_fhs_landscape, feed_fhs_incremental
 
-def fuel_wood(output_folder, lu_fh, AREA, ndm_fhs, fraction_fhs, ndmdates):
+def fuel_wood(output_folder, lu_fh, AREA, ndm_fhs, fraction_fhs, ndmdates, dates=None):
     """
     Calculate natural livestock feed production
 
@@ -235,6 +265,9 @@ def fuel_wood(output_folder, lu_fh, AREA, ndm_fhs, fraction_fhs, ndmdates):
         array of filehandles of NDM maps
     abv_grnd_biomass_ratio: dict
         dictionnary 'LULC':[above ground biomass]
+    dates : list, optional
+        Months to compute, other months are only computed when their maps
+        do not exist yet. Default is None, i.e. all months.
     """
     Data_Path_Fuel = "Fuel"
     out_folder = os.path.join(output_folder, Data_Path_Fuel)
@@ -256,7 +289,6 @@ def fuel_wood(output_folder, lu_fh, AREA, ndm_fhs, fraction_fhs, ndmdates):
     for d in range(len(ndm_fhs)):
         ndm_fh = ndm_fhs[d]
         fraction_fh = fraction_fhs[d]
-        yield_fract = RC.Open_tiff_array(fraction_fh)
         date1 = ndmdates[d]
         year = '%d' %date1.year
         month = '%02d' %date1.month
@@ -264,14 +296,17 @@ def fuel_wood(output_folder, lu_fh, AREA, ndm_fhs, fraction_fhs, ndmdates):
 #        month = ndm_fh[-9:-7]
         out_fh_l = out_folder+'\\fuel_prod_landscape_%s_%s.tif' %(year, month)
         out_fh_i = out_folder+'\\fuel_prod_incremental_%s_%s.tif' %(year, month)
+        fuel_fhs_landscape.append(out_fh_l)
+        fuel_fhs_incremental.append(out_fh_i)
+        if os.path.exists(out_fh_l) and os.path.exists(out_fh_i) and not becgis.in_selection([date1], dates)[0]:
+            continue
+        yield_fract = RC.Open_tiff_array(fraction_fh)
         NDM = becgis.open_as_array(ndm_fh, nan_values=True)
 
         NDM_fuel_incremental = NDM * .05 * fuel_mask * yield_fract * area_ha/1e6
         NDM_fuel_landscape = NDM  * .05 * fuel_mask *(1-yield_fract) * area_ha/1e6
         DC.Save_as_tiff(out_fh_i, NDM_fuel_incremental, geo_out)
         DC.Save_as_tiff(out_fh_l, NDM_fuel_landscape, geo_out)
-        fuel_fhs_landscape.append(out_fh_l)
-        fuel_fhs_incremental.append(out_fh_i)
 
     return fuel_fhs_landscape, fuel_fhs_incremental
 
@@ -302,7 +337,7 @@ def dry_season_bf(output_folder, WPixOutFile, dry_months):
     DC.Save_as_tiff(dry_bf_fh, dry_bf, geo_out)
     return  dry_bf_fh
 
-def root_zone_storage_Wpx(output_folder, rz_sm_fhs, rz_depth_fh):
+def root_zone_storage_Wpx(output_folder, rz_sm_fhs, rz_depth_fh, rz_sm_dates=None, dates=None):
     Data_Path_RZ = "RZstor"
     out_folder = os.path.join(output_folder, Data_Path_RZ)
     if not os.path.exists(out_folder):
@@ -310,12 +345,14 @@ def root_zone_storage_Wpx(output_folder, rz_sm_fhs, rz_depth_fh):
     root_depth = becgis.open_as_array(rz_depth_fh, nan_values=True)
     geo = becgis.get_geoinfo(rz_depth_fh)
     root_storage_fhs = []
-    for rz_sm_fh in rz_sm_fhs:
+    for i, rz_sm_fh in enumerate(rz_sm_fhs):
+        out_fh = os.path.join(out_folder, 'RZ_storage_mm_%s' %(rz_sm_fh[-10:]))
+        root_storage_fhs.append(out_fh)
+        if rz_sm_dates is not None and os.path.exists(out_fh) and not becgis.in_selection([rz_sm_dates[i]], dates)[0]:
+            continue
         root_depth_sm = becgis.open_as_array(rz_sm_fh, nan_values=True)
         root_storage = root_depth * root_depth_sm
-        out_fh = os.path.join(out_folder, 'RZ_storage_mm_%s' %(rz_sm_fh[-10:]))
         becgis.create_geotiff(out_fh, root_storage, *geo)
-        root_storage_fhs.append(out_fh)
     return root_storage_fhs
 
 #def carbon_seq(output_folder,lu_fh,ndm_fhs,abv_grnd_biomass_ratio,c_fraction,abv_grnd_biomass_ratio):
@@ -336,46 +373,39 @@ def root_zone_storage_Wpx(output_folder, rz_sm_fhs, rz_depth_fh):
 #    return carbon_fhs
 
 
-def recycle(output_folder, et_bg_fhs, recy_ratio, lu_fh, et_type):
+def recycle(output_folder, et_bg_fhs, recy_ratio, lu_fh, et_type, et_dates=None, dates=None):
     Data_Path_rec = "temp_et_recycle"
     out_folder = os.path.join(output_folder, Data_Path_rec)
     geo_out, proj, size_X, size_Y = RC.Open_array_info(lu_fh)
     if not os.path.exists(out_folder):
         os.mkdir(out_folder)
     recycle_fhs = []
-    for et_fh in et_bg_fhs:
+    for i, et_fh in enumerate(et_bg_fhs):
         out_fh = out_folder + "\\recycled_et_"+et_type+et_fh[-11:-4]+".tif"
+        recycle_fhs.append(out_fh)
+        if et_dates is not None and os.path.exists(out_fh) and not becgis.in_selection([et_dates[i]], dates)[0]:
+            continue
         et = becgis.open_as_array(et_fh, nan_values=True)
         et_recy = et*recy_ratio
         DC.Save_as_tiff(out_fh, et_recy, geo_out)
-        recycle_fhs.append(out_fh)
     return recycle_fhs
 
 ### Other functions
 def lu_type_average(data_fh, lu_fh, lu_dict):
-    LULC = RC.Open_tiff_array(lu_fh)
     in_data = RC.Open_tiff_array(data_fh)
-    out_data = {}
-    for lu_class in list(lu_dict.keys()):
-        mask = [LULC == value for value in lu_dict[lu_class]]
-        mask = (np.sum(mask, axis=0)).astype(bool)
-        out_data[lu_class] = np.nanmean(in_data[mask])
+    out_data = becgis.aggregate_per_categories(lu_fh, in_data, lu_dict, statistic='mean')
     return out_data
 
 def lu_type_sum(data_fh, lu_fh, AREA, lu_dict, convert=None):
-    LULC = RC.Open_tiff_array(lu_fh)
     in_data = becgis.open_as_array(data_fh, nan_values=True)
 #    in_data = RC.Open_tiff_array(data_fh)
     if convert == 'mm_to_km3':
-        in_data *= AREA / 1e6
-    out_data = {}
-    for lu_class in list(lu_dict.keys()):
-        mask = [LULC == value for value in lu_dict[lu_class]]
-        mask = (np.sum(mask, axis=0)).astype(bool)
-        out_data[lu_class] = np.nansum(in_data[mask])
+        out_data = becgis.aggregate_per_categories(lu_fh, in_data, lu_dict, area=AREA, scale=1e-6)
+    else:
+        out_data = becgis.aggregate_per_categories(lu_fh, in_data, lu_dict)
     return out_data
 
-def split_yield(output_folder, p_fhs, et_blue_fhs, et_green_fhs, ab=(1.0, 1.0)):
+def split_yield(output_folder, p_fhs, et_blue_fhs, et_green_fhs, ab=(1.0, 1.0), fhdates=None, dates=None):
     Data_Path_split = "split_y"
     out_folder = os.path.join(output_folder, Data_Path_split)
     if not os.path.exists(out_folder):
@@ -384,6 +414,9 @@ def split_yield(output_folder, p_fhs, et_blue_fhs, et_green_fhs, ab=(1.0, 1.0)):
     geo_out, proj, size_X, size_Y = RC.Open_array_info(p_fhs[0])
     for m in range(len(p_fhs)):
         out_fh = out_folder+'\\split_yield'+et_blue_fhs[m][-12:]
+        sp_yield_fhs.append(out_fh)
+        if fhdates is not None and os.path.exists(out_fh) and not becgis.in_selection([fhdates[m]], dates)[0]:
+            continue
         P = RC.Open_tiff_array(p_fhs[m])
         ETBLUE = RC.Open_tiff_array(et_blue_fhs[m])
         ETGREEN = RC.Open_tiff_array(et_green_fhs[m])
@@ -391,7 +424,6 @@ def split_yield(output_folder, p_fhs, et_blue_fhs, et_green_fhs, ab=(1.0, 1.0)):
         pfraction = P / np.nanmax(P)
         fraction = sh3.split_Yield(pfraction, etbfraction, ab[0], ab[1])
         DC.Save_as_tiff(out_fh, fraction, geo_out)
-        sp_yield_fhs.append(out_fh)
     return sp_yield_fhs
 
 def get_sheet7_classes():
@@ -472,7 +504,7 @@ def create_csv(results, output_fh):
     if not os.path.exists(os.path.split(output_fh)[0]):
         os.makedirs(os.path.split(output_fh)[0])
 
-    csv_file = open(output_fh, 'w')
+    csv_file = open(becgis.temp_filehandle(output_fh), 'w')
     writer = csv.writer(csv_file, delimiter=';', lineterminator = '\n')
     
     writer.writerow(first_row)
@@ -502,6 +534,7 @@ def create_csv(results, output_fh):
         writer.writerow([lu_class, 'Atmospheric Water Recycling', 'Landscape ET',
                          '{0:.3f}'.format(results['atm_recycl_landscape'][lu_class]),'km3'])
     csv_file.close()
+    becgis.replace_file(becgis.temp_filehandle(output_fh), output_fh)
 
 def create_sheet7_svg(basin, period, data, output, template=False):
 
@@ -569,7 +602,7 @@ def create_sheet7_svg(basin, period, data, output, template=False):
     # Export svg to png    
     tempout_path = output.replace('.pdf', '_temporary.svg')
     tree.write(tempout_path)    
-    cairosvg.svg2pdf(url=tempout_path, write_to=output)    
+    becgis.svg_to_pdf(tempout_path, output)
     os.remove(tempout_path) 
 
     return